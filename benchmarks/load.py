@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+"""
+Load test for the webhook and the command executor
+
+Signed Viber callback payloads are replayed against the Flask application
+in this process, and execute messages are fed to the command executor loop
+of scripts/viber-command-executor. Redis is a local stand-in (redis-server
+if it is installed, otherwise fakeredis) and the Viber API is a local stub
+HTTP server, so the test does not need network access.
+
+The results are written as JSON with -o, so that the results of releases
+can be compared.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import hmac
+import http.server
+import importlib.machinery
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXECUTOR_SCRIPT = os.path.join(ROOT_DIR, 'scripts', 'viber-command-executor')
+
+AUTH_TOKEN = 'benchmark-authentication-token'
+USER_ID = 'benchmark-user-id'
+
+CONFIG = '''
+[Viber]
+authentication_token = {token}
+name = Benchmark
+avatar = https://example.com/avatar.jpg
+webhook = https://example.com/
+notify_user_id = {user_id}
+trusted_user_ids = {user_id}
+redis_host = 127.0.0.1
+redis_port = {redis_port}
+redis_channel = viber-benchmark
+command_executor = False
+config_reload_interval = 0
+
+[Logger]
+level = WARNING
+syslog = False
+
+[Outbound]
+url = {api_url}
+rate = 1000000
+burst = 1000000
+
+[Pool]
+workers = {workers}
+queue_size = 100000
+
+[Command bench]
+execute = {execute}
+help = Benchmark command.
+'''
+
+# Share of each callback type in the replayed requests.
+MIX = [('command', 0.5), ('echo', 0.2), ('delivered', 0.15), ('seen', 0.15)]
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description='Load test the webhook and '
+                                                 'the command executor')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='number of webhook requests')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='number of concurrent webhook clients')
+    parser.add_argument('-m', '--messages', type=int, default=200,
+                        help='number of messages for the command executor')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='command pool workers')
+    parser.add_argument('-e', '--execute', default='echo benchmark',
+                        help='command executed by /bench')
+    parser.add_argument('--redis-port', type=int,
+                        help='use Redis running in this local port instead '
+                             'of a stand-in')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the request mix')
+    parser.add_argument('-o', '--output', help='write results as JSON to '
+                                               'this file')
+    return parser.parse_args()
+
+
+def free_port():
+    """
+    Get a free local TCP port.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_redis(port):
+    """
+    Start local Redis stand-in.
+
+    :param port: TCP port
+    :return: tuple (name of the stand-in, function that stops it)
+    """
+    if shutil.which('redis-server'):
+        p = subprocess.Popen(['redis-server', '--port', str(port),
+                              '--bind', '127.0.0.1', '--save', '',
+                              '--appendonly', 'no'],
+                             stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        return 'redis-server', p.terminate
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        raise RuntimeError('redis-server or fakeredis is needed for the Redis '
+                           'stand-in, or use --redis-port')
+    server = TcpFakeServer(('127.0.0.1', port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'fakeredis', server.shutdown
+
+
+class ViberApiStub(http.server.BaseHTTPRequestHandler):
+    """
+    Viber API stub that accepts every message
+    """
+
+    received = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        ViberApiStub.received += 1
+        body = b'{"status": 0, "status_message": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_viber_api():
+    """
+    Start the Viber API stub.
+
+    :return: tuple (send_message URL, server)
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ViberApiStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/pa/send_message'.format(
+        server.server_address[1]), server
+
+
+class RoundTrips(object):
+    """
+    Counts the commands sent to Redis. A pipeline is sent as one packed
+    command, so the count is the number of round trips.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def install(self):
+        import redis.connection
+        send = redis.connection.AbstractConnection.send_packed_command
+        counter = self
+
+        def send_packed_command(connection, *args, **kwargs):
+            with counter.lock:
+                counter.count += 1
+            return send(connection, *args, **kwargs)
+
+        redis.connection.AbstractConnection.send_packed_command = \
+            send_packed_command
+
+
+def create_payloads(number, seed):
+    """
+    Create signed Viber callback payloads.
+
+    :param number: number of payloads
+    :param seed: random seed for the request mix
+    :return: list of tuples (event type, body, signature)
+    """
+    rnd = random.Random(seed)
+    kinds = [k for k, _ in MIX]
+    weights = [w for _, w in MIX]
+    payloads = list()
+    for i in range(number):
+        kind = rnd.choices(kinds, weights)[0]
+        token = 5000000000000000000 + i
+        timestamp = 1500000000000 + i
+        if kind in ['delivered', 'seen']:
+            event = {'event': kind, 'timestamp': timestamp,
+                     'message_token': token, 'user_id': USER_ID}
+        else:
+            text = '/bench' if kind == 'command' else '/echo hello'
+            event = {'event': 'message', 'timestamp': timestamp,
+                     'message_token': token,
+                     'sender': {'id': USER_ID, 'name': 'Benchmark',
+                                'language': 'en', 'country': 'FI',
+                                'api_version': 1},
+                     'message': {'type': 'text', 'text': text}}
+        body = json.dumps(event).encode()
+        signature = hmac.new(AUTH_TOKEN.encode('ascii'), body,
+                             hashlib.sha256).hexdigest()
+        payloads.append((kind, body, signature))
+    return payloads
+
+
+def percentile(values, p):
+    """
+    Get the pth percentile of the values.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latency_stats(latencies):
+    """
+    Create latency statistics in milliseconds.
+    """
+    return {'count': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'mean_ms': (statistics.mean(latencies) * 1000 if latencies
+                        else 0.0)}
+
+
+def wait_idle(command_pool, outbound, timeout=300):
+    """
+    Wait until the command pool and the outbound queue are idle.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = command_pool.stats()
+        if not stats['running'] and not stats['queue_depth']:
+            break
+        time.sleep(0.01)
+    outbound.flush(timeout=max(0, deadline - time.monotonic()))
+
+
+def benchmark_webhook(args, round_trips):
+    """
+    Replay the payloads against the Flask application.
+    """
+    from viber_command_bot.flask.application import app
+    from viber_command_bot.outbound import outbound
+    from viber_command_bot.pool import command_pool
+
+    payloads = create_payloads(args.requests, args.seed)
+    local = threading.local()
+    latencies = dict()
+    statuses = dict()
+    lock = threading.Lock()
+
+    def post(payload):
+        kind, body, signature = payload
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        response = client.post('/', data=body, headers={
+            'X-Viber-Content-Signature': signature})
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.setdefault(kind, list()).append(elapsed)
+            statuses[response.status_code] = statuses.get(
+                response.status_code, 0) + 1
+
+    # Warm up the connections and the lazily started threads.
+    post(payloads[0])
+    wait_idle(command_pool, outbound)
+    latencies.clear()
+    statuses.clear()
+    sent_before = ViberApiStub.received
+    pool_before = command_pool.stats()['completed']
+    trips_before = round_trips.count
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(post, payloads))
+    webhook_elapsed = time.perf_counter() - start
+    trips = round_trips.count - trips_before
+    wait_idle(command_pool, outbound)
+    elapsed = time.perf_counter() - start
+
+    commands = command_pool.stats()['completed'] - pool_before
+    all_latencies = [v for values in latencies.values() for v in values]
+    result = latency_stats(all_latencies)
+    result.update({
+        'requests_per_second': len(payloads) / webhook_elapsed,
+        'commands': commands,
+        'commands_per_second': commands / elapsed,
+        'redis_round_trips_per_request': trips / len(payloads),
+        'viber_api_messages': ViberApiStub.received - sent_before,
+        'statuses': dict((str(k), v) for k, v in sorted(statuses.items())),
+        'by_event': dict((k, latency_stats(v)) for k, v in
+                         sorted(latencies.items()))})
+    return result
+
+
+def load_executor():
+    """
+    Load the command executor script as a module without running it.
+    """
+    loader = importlib.machinery.SourceFileLoader('viber_command_executor',
+                                                  EXECUTOR_SCRIPT)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def wait_subscribed(cache, timeout=10):
+    """
+    Wait until Redis has confirmed the pubsub subscriptions of the cache, so
+    that the published messages are not lost.
+    """
+    if cache.pubsub is None:
+        return
+    channels = list(cache.pubsub.channels)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = dict(cache.redis.pubsub_numsub(*channels))
+        if all(counts.get(channel, 0) for channel in channels):
+            return
+        # Reading the pubsub connection handles the confirmations.
+        cache.pubsub.get_message(timeout=0.01)
+    raise RuntimeError('Redis did not confirm the subscriptions in {} '
+                       'seconds'.format(timeout))
+
+
+def benchmark_executor(args, round_trips, idle_timeout=30):
+    """
+    Feed execute messages to the command executor loop.
+    """
+    from viber_command_bot.cache import cache
+    from viber_command_bot.commands import command_options
+    from viber_command_bot.config import config
+    from viber_command_bot.outbound import outbound
+
+    executor = load_executor()
+    config.set('Viber', 'command_executor', 'True')
+    options = command_options('bench')
+    cache.listen(commands=True)
+    wait_subscribed(cache)
+    sent_before = ViberApiStub.received
+    trips_before = round_trips.count
+
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        cache.publish(USER_ID, options['execute'], message_type='execute',
+                      output_format=options['output_format'],
+                      command='bench')
+    latencies = list()
+    handled = 0
+    received = time.monotonic()
+    while handled < args.messages:
+        message = cache.get_message()
+        if not message:
+            if time.monotonic() - received > idle_timeout:
+                raise RuntimeError('Command executor got {} of {} messages, '
+                                   'no message in {} seconds'.format(
+                                       handled, args.messages, idle_timeout))
+            continue
+        received = time.monotonic()
+        if message.get('message_type') != 'execute':
+            cache.ack(message)
+            continue
+        t = time.perf_counter()
+        try:
+            executor.handle_message(message)
+        finally:
+            cache.ack(message)
+        latencies.append(time.perf_counter() - t)
+        handled += 1
+    outbound.flush(timeout=60)
+    elapsed = time.perf_counter() - start
+
+    result = latency_stats(latencies)
+    result.update({
+        'commands': handled,
+        'commands_per_second': handled / elapsed,
+        'redis_round_trips_per_command': ((round_trips.count - trips_before) /
+                                          max(1, handled)),
+        'viber_api_messages': ViberApiStub.received - sent_before})
+    return result
+
+
+def main():
+    args = parse_command_line_arguments()
+    api_url, api_server = start_viber_api()
+    redis_port = args.redis_port
+    redis_name, stop_redis = 'external', None
+    if redis_port is None:
+        redis_port = free_port()
+        redis_name, stop_redis = start_redis(redis_port)
+
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.conf',
+                                              delete=False)
+    with config_file:
+        config_file.write(CONFIG.format(
+            token=AUTH_TOKEN, user_id=USER_ID, redis_port=redis_port,
+            api_url=api_url, workers=args.workers, execute=args.execute))
+    os.environ['VIBER_CONF'] = config_file.name
+    round_trips = RoundTrips()
+    round_trips.install()
+
+    try:
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        webhook = benchmark_webhook(args, round_trips)
+        rss_webhook = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        executor = benchmark_executor(args, round_trips)
+        rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        os.unlink(config_file.name)
+        api_server.shutdown()
+        if stop_redis is not None:
+            stop_redis()
+
+    from viber_command_bot.version import __version__
+    results = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'redis': redis_name,
+        'parameters': {'requests': args.requests,
+                       'concurrency': args.concurrency,
+                       'messages': args.messages, 'workers': args.workers,
+                       'execute': args.execute},
+        'webhook': webhook,
+        'executor': executor,
+        # One process is the equivalent of one uWSGI worker.
+        'memory': {'max_rss_kb': rss_end,
+                   'startup_rss_kb': rss_start,
+                   'webhook_rss_kb': rss_webhook}}
+
+    print('Webhook:  {count} requests, p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} '
+          'ms, {requests_per_second:.0f} requests/s'.format(**webhook))
+    print('          {commands} commands, {commands_per_second:.1f} '
+          'commands/s, {redis_round_trips_per_request:.2f} Redis round '
+          'trips/request'.format(**webhook))
+    print('Executor: {commands} commands, p50 {p50_ms:.2f} ms, p99 '
+          '{p99_ms:.2f} ms, {commands_per_second:.1f} commands/s'.format(
+              **executor))
+    print('Memory:   {max_rss_kb} kB maximum RSS per worker'.format(
+        **results['memory']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
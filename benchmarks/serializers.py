@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark for the message serializers
+
+Compares encode and decode time and payload size of the serializers used
+for the messages published through the cache.
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import timeit
+
+from viber_command_bot.serializers import SERIALIZERS
+
+
+MESSAGES = {
+    'text': {'user_id': 'AbCdEfGhIjKlMnOpQrStUv==', 'text': '/uptime',
+             'media': None, 'name': 'John Doe', 'message_type': 'text',
+             'destination': [], 'output_format': 'text', 'command': None,
+             'date': datetime.datetime.now()},
+    'execute': {'user_id': 'AbCdEfGhIjKlMnOpQrStUv==',
+                'text': 'dig +short myip.opendns.com @resolver1.opendns.com',
+                'media': None, 'name': 'John Doe', 'message_type': 'execute',
+                'destination': ['host1', 'host2', 'host3'],
+                'output_format': 'text', 'command': 'ip',
+                'date': datetime.datetime.now()},
+    'output': {'user_id': 'AbCdEfGhIjKlMnOpQrStUv==',
+               'text': 'UID PID PPID C STIME TTY TIME CMD\n' * 200,
+               'media': None, 'name': 'viber-command-bot',
+               'message_type': 'text', 'destination': [],
+               'output_format': 'text', 'command': None,
+               'date': datetime.datetime.now()},
+}
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark message '
+                                                 'serializers')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='number of iterations')
+    parser.add_argument('-o', '--output', help='write results as JSON to '
+                                               'this file')
+    return parser.parse_args()
+
+
+def benchmark(serializer, message, number):
+    """
+    Benchmark serializer with the message.
+
+    :param serializer: serializer class
+    :param message: message dict
+    :param number: number of iterations
+    :return: dict with results
+    """
+    data = serializer.dumps(message)
+    encode = timeit.timeit(lambda: serializer.dumps(message), number=number)
+    decode = timeit.timeit(lambda: serializer.loads(data), number=number)
+    return {'serializer': serializer.name,
+            'encode_us': encode / number * 1000000,
+            'decode_us': decode / number * 1000000,
+            'size': len(data)}
+
+
+def main():
+    args = parse_command_line_arguments()
+    results = dict()
+    print('{:<8} {:<8} {:>10} {:>10} {:>8}'.format(
+        'message', 'format', 'encode us', 'decode us', 'bytes'))
+    for message_name, message in sorted(MESSAGES.items()):
+        results[message_name] = list()
+        for name, serializer in sorted(SERIALIZERS.items()):
+            result = benchmark(serializer, message, args.number)
+            results[message_name].append(result)
+            print('{:<8} {:<8} {encode_us:>10.2f} {decode_us:>10.2f} '
+                  '{size:>8}'.format(message_name, name, **result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
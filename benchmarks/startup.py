@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark for the command line scripts
+
+Measures the time it takes to load each script, i.e. to run its imports in
+a new Python process, and checks that the script does not load modules it
+does not need. The script main functions are not run.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts')
+
+# Modules that must not be loaded by the scripts.
+FORBIDDEN = {
+    'viber-send-message': ['flask', 'viber_command_bot.flask.application',
+                           'viber_command_bot.commands',
+                           'viber_command_bot.pool'],
+    'viber-receive-message': ['flask', 'viber_command_bot.flask.application',
+                              'viber_command_bot.commands',
+                              'viber_command_bot.viber'],
+    'viber-command-executor': ['flask',
+                               'viber_command_bot.flask.application'],
+}
+
+LOAD_SCRIPT = '''
+import json, runpy, sys
+runpy.run_path(sys.argv[1], run_name='startup')
+print(json.dumps(sorted(sys.modules)))
+'''
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark startup time of '
+                                                 'the command line scripts')
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help='number of runs per script')
+    parser.add_argument('-l', '--limit', type=float,
+                        help='fail if the median startup time of a script '
+                             'exceeds this many milliseconds')
+    parser.add_argument('-o', '--output', help='write results as JSON to '
+                                               'this file')
+    parser.add_argument('scripts', nargs='*', default=sorted(FORBIDDEN),
+                        help='scripts to benchmark')
+    return parser.parse_args()
+
+
+def load(script):
+    """
+    Load the script in a new Python process.
+
+    :param script: script name
+    :return: tuple (load time in seconds, list of loaded module names)
+    :raises RuntimeError: if loading the script fails
+    """
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, '-c', LOAD_SCRIPT,
+                        os.path.join(SCRIPTS_DIR, script)],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if p.returncode != 0:
+        raise RuntimeError(p.stderr.decode(errors='replace').strip())
+    return elapsed, json.loads(p.stdout.decode())
+
+
+def benchmark(script, number):
+    """
+    Benchmark startup of the script.
+
+    :param script: script name
+    :param number: number of runs
+    :return: dict with results
+    """
+    times = list()
+    modules = list()
+    for _ in range(number):
+        elapsed, modules = load(script)
+        times.append(elapsed)
+    forbidden = [m for m in FORBIDDEN.get(script, []) if m in modules]
+    return {'script': script,
+            'median_ms': statistics.median(times) * 1000,
+            'min_ms': min(times) * 1000,
+            'modules': len(modules),
+            'forbidden': forbidden}
+
+
+def main():
+    args = parse_command_line_arguments()
+    results = list()
+    failed = False
+    print('{:<24} {:>10} {:>10} {:>8}'.format(
+        'script', 'median ms', 'min ms', 'modules'))
+    for script in args.scripts:
+        try:
+            result = benchmark(script, args.number)
+        except RuntimeError as e:
+            print('{:<24} ERROR: {}'.format(script, e))
+            failed = True
+            continue
+        results.append(result)
+        print('{script:<24} {median_ms:>10.1f} {min_ms:>10.1f} '
+              '{modules:>8}'.format(**result))
+        if result['forbidden']:
+            print('{:<24} loads {}'.format(
+                '', ', '.join(result['forbidden'])))
+            failed = True
+        if args.limit is not None and result['median_ms'] > args.limit:
+            failed = True
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
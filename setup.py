@@ -85,7 +85,10 @@ setup(name='viber_command_bot',
       install_requires=['certifi', 'chardet', 'click', 'Flask', 'future',
                         'idna', 'itsdangerous', 'Jinja2', 'MarkupSafe',
                         'requests', 'urllib3', 'viberbot', 'Werkzeug', ],
-      packages=['viber_command_bot', 'viber_command_bot.flask', ],
+      extras_require={'asgi': ['aiohttp', 'redis>=4.2', 'uvicorn', ],
+                      'benchmark': ['fakeredis>=2.20', ], },
+      packages=['viber_command_bot', 'viber_command_bot.asgi',
+                'viber_command_bot.flask', ],
       scripts=['scripts/viber-command-bot-register',
                'scripts/viber-receive-message',
                'scripts/viber-send-message'],
@@ -0,0 +1,94 @@
+"""
+Tests for the admission control of the configured commands
+"""
+
+import unittest
+from unittest import mock
+
+from viber_command_bot.admission import admitted, command_buckets
+from viber_command_bot.admission import LocalBuckets
+from viber_command_bot.commands import parse_rate_limit
+
+
+class LocalBucketsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('viber_command_bot.admission.time.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buckets = LocalBuckets()
+
+    def test_burst_and_refill(self):
+        buckets = [('user:a', 0.5, 2)]
+        self.assertEqual([self.buckets.take_tokens(buckets) for _ in
+                          range(3)], [0, 0, 1])
+        self.now += 1
+        self.assertEqual(self.buckets.take_tokens(buckets), 1)
+        self.now += 1
+        self.assertEqual(self.buckets.take_tokens(buckets), 0)
+        self.assertEqual(self.buckets.take_tokens(buckets), 1)
+
+    def test_refill_up_to_burst(self):
+        buckets = [('user:a', 1.0, 2)]
+        self.buckets.take_tokens(buckets)
+        self.now += 3600
+        self.assertEqual([self.buckets.take_tokens(buckets) for _ in
+                          range(3)], [0, 0, 1])
+
+    def test_all_or_nothing(self):
+        user = ('user:a', 1.0, 5)
+        command = ('command:uptime', 1.0, 1)
+        self.assertEqual(self.buckets.take_tokens([user, command]), 0)
+        # The command bucket is empty, so no token is taken from the user
+        # bucket either.
+        for _ in range(10):
+            self.assertEqual(self.buckets.take_tokens([user, command]), 2)
+        self.assertEqual([self.buckets.take_tokens([user]) for _ in
+                          range(5)], [0, 0, 0, 0, 1])
+
+    def test_buckets_are_separate(self):
+        self.assertEqual(self.buckets.take_tokens([('user:a', 1.0, 1)]), 0)
+        self.assertEqual(self.buckets.take_tokens([('user:b', 1.0, 1)]), 0)
+        self.assertEqual(self.buckets.take_tokens([('user:a', 1.0, 1)]), 1)
+
+
+class AdmittedTest(unittest.TestCase):
+
+    def test_result(self):
+        buckets = [('user:a', 1.0, 1), ('command:uptime', 1.0, 1)]
+        self.assertTrue(admitted(buckets, 0))
+        self.assertFalse(admitted(buckets, 2))
+
+    def test_local_fallback(self):
+        buckets = [('command:uptime', 1.0, 1)]
+        with mock.patch('viber_command_bot.admission.local_buckets',
+                        LocalBuckets()):
+            self.assertTrue(admitted(buckets, None))
+            self.assertFalse(admitted(buckets, None))
+
+
+class CommandBucketsTest(unittest.TestCase):
+
+    @mock.patch('viber_command_bot.admission.user_rate_limit',
+                lambda user_id: (0.1, 6) if user_id == 'a' else None)
+    def test_command_buckets(self):
+        options = {'name': 'uptime', 'rate_limit': (1.0, 1)}
+        self.assertEqual(command_buckets('a', options),
+                         [('user:a', 0.1, 6), ('command:uptime', 1.0, 1)])
+        self.assertEqual(command_buckets('b', options),
+                         [('command:uptime', 1.0, 1)])
+        self.assertEqual(command_buckets('b', dict(options, rate_limit=None)),
+                         [])
+
+    def test_parse_rate_limit(self):
+        self.assertEqual(parse_rate_limit('6/60'), (0.1, 6))
+        self.assertEqual(parse_rate_limit('2'), (2.0, 2))
+        for value in ['0/60', '1/0', 'x/60', '']:
+            with self.assertRaises(ValueError):
+                parse_rate_limit(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Tests for the Redis circuit breaker
+"""
+
+import unittest
+from unittest import mock
+
+import redis.exceptions
+from viber_command_bot.breaker import CircuitBreaker, CircuitOpenError
+from viber_command_bot.breaker import PoolExhaustedError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('viber_command_bot.breaker.time.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failures=3, reset_timeout=10.0)
+
+    def call(self, error=None):
+        with self.breaker.call():
+            if error is not None:
+                raise error
+
+    def fail(self, count=1):
+        for _ in range(count):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                self.call(redis.exceptions.ConnectionError('down'))
+
+    def test_opens_after_failures(self):
+        self.fail(2)
+        self.assertTrue(self.breaker.closed)
+        self.fail()
+        self.assertFalse(self.breaker.closed)
+        with self.assertRaises(CircuitOpenError):
+            self.call()
+
+    def test_success_resets_count(self):
+        self.fail(2)
+        self.call()
+        self.fail(2)
+        self.assertTrue(self.breaker.closed)
+
+    def test_timeout_is_failure(self):
+        for _ in range(3):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                self.call(redis.exceptions.TimeoutError('slow'))
+        self.assertFalse(self.breaker.closed)
+
+    def test_error_answer_is_success(self):
+        self.fail(2)
+        with self.assertRaises(redis.exceptions.ResponseError):
+            self.call(redis.exceptions.ResponseError('WRONGTYPE'))
+        self.fail(2)
+        self.assertTrue(self.breaker.closed)
+
+    def test_pool_exhausted_is_not_failure(self):
+        for _ in range(5):
+            with self.assertRaises(PoolExhaustedError):
+                self.call(PoolExhaustedError('busy'))
+        self.assertTrue(self.breaker.closed)
+
+    def test_probe_closes(self):
+        self.fail(3)
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        # Only one probe at a time.
+        self.assertFalse(self.breaker.allow())
+        self.breaker.success()
+        self.assertTrue(self.breaker.closed)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        self.fail(3)
+        self.now += 10
+        self.fail()
+        self.assertFalse(self.breaker.closed)
+        self.now += 5
+        with self.assertRaises(CircuitOpenError):
+            self.call()
+        self.now += 5
+        self.call()
+        self.assertTrue(self.breaker.closed)
+
+    def test_released_probe(self):
+        self.fail(3)
+        self.now += 10
+        with self.assertRaises(PoolExhaustedError):
+            self.call(PoolExhaustedError('busy'))
+        self.assertFalse(self.breaker.closed)
+        self.assertTrue(self.breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for the command router
+"""
+
+import unittest
+
+from viber_command_bot.commands import CommandRouter, INTERNAL_COMMANDS
+from viber_command_bot.commands import split_destination
+
+
+class Commands(object):
+    """
+    Configured commands for the router
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+
+def create_handler(name):
+    def handler(viber_request, argument, destination):
+        pass
+    handler.__name__ = name
+    return handler
+
+
+HANDLER_NAMES = set(handler for _, handler, _, _ in INTERNAL_COMMANDS) | {
+    'execute_configured_command', 'unsupported_command'}
+
+UPTIME = {'name': 'uptime', 'output_mode': 'full'}
+DISK = {'name': 'disk', 'output_mode': 'diff'}
+
+
+class CommandRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = CommandRouter()
+        self.router.add_handlers(dict(
+            (name, create_handler(name)) for name in HANDLER_NAMES))
+        self.commands = Commands(uptime=UPTIME, disk=DISK)
+
+    def route(self, command):
+        handler, argument = self.router.route(command, self.commands)
+        return handler.__name__, argument
+
+    def test_internal_commands(self):
+        self.assertEqual(self.route(''), ('show_help', None))
+        self.assertEqual(self.route('help'), ('show_help', None))
+        self.assertEqual(self.route('version'), ('show_version', None))
+        self.assertEqual(self.route('notes'), ('show_all_notes', None))
+        self.assertEqual(self.route('more'), ('show_more', None))
+
+    def test_argument(self):
+        self.assertEqual(self.route('echo'), ('echo', None))
+        self.assertEqual(self.route('echo  hello there '),
+                         ('echo', 'hello there'))
+        self.assertEqual(self.route('note buy milk'),
+                         ('add_note', 'buy milk'))
+
+    def test_numbered(self):
+        self.assertEqual(self.route('note'), ('show_note', None))
+        self.assertEqual(self.route('note12'), ('show_note', 12))
+        self.assertEqual(self.route('removenote'), ('remove_note', None))
+        self.assertEqual(self.route('removenote3'), ('remove_note', 3))
+        self.assertEqual(self.route('profile5'), ('profile', 5))
+
+    def test_configured_commands(self):
+        self.assertEqual(self.route('uptime'),
+                         ('execute_configured_command', UPTIME))
+        self.assertEqual(self.route('uptime full'),
+                         ('unsupported_command', 'uptime full'))
+
+    def test_full_output_of_diff_command(self):
+        self.assertEqual(self.route('disk'),
+                         ('execute_configured_command', DISK))
+        self.assertEqual(self.route('disk full'),
+                         ('execute_configured_command',
+                          dict(DISK, refresh=True)))
+
+    def test_unsupported_commands(self):
+        for command in ['foo', 'notex', 'removenote x', 'echox', 'note-1']:
+            self.assertEqual(self.route(command),
+                             ('unsupported_command', command))
+
+    def test_internal_command_wins(self):
+        commands = Commands(version={'name': 'version',
+                                     'output_mode': 'full'})
+        handler, _ = self.router.route('version', commands)
+        self.assertEqual(handler.__name__, 'show_version')
+
+
+class SplitDestinationTest(unittest.TestCase):
+
+    def test_split_destination(self):
+        self.assertEqual(split_destination('uptime'), ('uptime', []))
+        self.assertEqual(split_destination('uptime @ host1, host2'),
+                         ('uptime', ['host1', 'host2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
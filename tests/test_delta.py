@@ -0,0 +1,50 @@
+"""
+Tests for the delta replies
+"""
+
+import unittest
+
+from viber_command_bot.delta import create_delta
+
+
+HEADER = ('Changes since the previous "/df", send "/df full" for the full '
+          'output:')
+
+OUTPUT = '\n'.join('/dev/sda{} {}% /mnt/{}'.format(i, 10 + i, i) for i in
+                   range(20))
+
+
+class CreateDeltaTest(unittest.TestCase):
+
+    def test_no_previous_output(self):
+        self.assertEqual(create_delta('df', None, OUTPUT), OUTPUT)
+
+    def test_no_changes(self):
+        self.assertEqual(create_delta('df', OUTPUT, OUTPUT),
+                         'No changes since the previous "/df".')
+
+    def test_changed_line(self):
+        text = OUTPUT.replace('/dev/sda3 13%', '/dev/sda3 95%')
+        self.assertEqual(create_delta('df', OUTPUT, text),
+                         '{}\n~ /dev/sda3 95% /mnt/3'.format(HEADER))
+
+    def test_added_and_removed_lines(self):
+        lines = OUTPUT.splitlines()
+        text = '\n'.join(lines[1:] + ['/dev/sdb1 1% /data'])
+        self.assertEqual(create_delta('df', OUTPUT, text),
+                         '{}\n- {}\n+ /dev/sdb1 1% /data'.format(
+                             HEADER, lines[0]))
+
+    def test_replaced_block(self):
+        lines = OUTPUT.splitlines()
+        text = '\n'.join(lines[:5] + ['new 1', 'new 2', 'new 3'] +
+                         lines[7:])
+        self.assertEqual(create_delta('df', OUTPUT, text),
+                         '{}\n~ new 1\n~ new 2\n+ new 3'.format(HEADER))
+
+    def test_full_output_when_shorter(self):
+        self.assertEqual(create_delta('df', 'a\nb', 'c\nd'), 'c\nd')
+
+
+if __name__ == '__main__':
+    unittest.main()
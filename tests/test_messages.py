@@ -0,0 +1,66 @@
+"""
+Tests for splitting the message text
+"""
+
+import unittest
+
+from viber_command_bot.messages import text_chunks, text_pages
+from viber_command_bot.messages import MAX_TEXT_MESSAGE_SIZE, MORE_NOTICE_SIZE
+
+
+class TextChunksTest(unittest.TestCase):
+
+    def assertChunks(self, text, size):
+        chunks = list(text_chunks(text, size))
+        self.assertEqual(''.join(chunks), text)
+        for chunk in chunks:
+            self.assertTrue(chunk)
+            self.assertLessEqual(len(chunk.encode()), size)
+        return chunks
+
+    def test_short_text(self):
+        self.assertEqual(list(text_chunks('hello\nworld\n', 100)),
+                         ['hello\nworld\n'])
+        self.assertEqual(list(text_chunks('', 100)), [])
+
+    def test_split_on_lines(self):
+        chunks = self.assertChunks('aaaa\nbbbb\ncccc\n', 10)
+        self.assertEqual(chunks, ['aaaa\nbbbb\n', 'cccc\n'])
+
+    def test_long_line(self):
+        chunks = self.assertChunks('x' * 25, 10)
+        self.assertEqual(chunks, ['x' * 10, 'x' * 10, 'x' * 5])
+
+    def test_utf8_size(self):
+        # "ä" is 2 bytes and "☃" is 3 bytes in UTF-8.
+        chunks = self.assertChunks('ä' * 9 + '\n', 10)
+        self.assertEqual(chunks, ['ä' * 5, 'ä' * 4 + '\n'])
+        chunks = self.assertChunks('☃' * 7, 10)
+        self.assertEqual(chunks, ['☃' * 3, '☃' * 3, '☃'])
+
+    def test_mixed_text(self):
+        text = ''.join('{} {}\n'.format(i, 'äö☃x' * (i % 13)) for i in
+                       range(500))
+        for size in [7, 16, 100, 1000]:
+            self.assertChunks(text, size)
+
+
+class TextPagesTest(unittest.TestCase):
+
+    def test_pages(self):
+        size = MAX_TEXT_MESSAGE_SIZE - MORE_NOTICE_SIZE
+        text = 'a' * (size * 5)
+        pages = list(text_pages(text, messages=2))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(''.join(''.join(page) for page in pages), text)
+
+    def test_first_page(self):
+        pages = text_pages('a' * (MAX_TEXT_MESSAGE_SIZE * 10), messages=1)
+        first = next(pages)
+        self.assertEqual(len(first), 1)
+        self.assertLessEqual(len(first[0].encode()),
+                             MAX_TEXT_MESSAGE_SIZE - MORE_NOTICE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Tests for the outbound message rate limiter
+"""
+
+import unittest
+from unittest import mock
+
+from viber_command_bot.outbound import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('viber_command_bot.outbound.time.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=2.0, burst=3)
+        self.assertEqual([limiter.take() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.take(), 0.5)
+
+    def test_refill(self):
+        limiter = RateLimiter(rate=2.0, burst=3)
+        for _ in range(3):
+            limiter.take()
+        self.now += 0.25
+        self.assertAlmostEqual(limiter.take(), 0.25)
+        self.now += 0.25
+        self.assertEqual(limiter.take(), 0)
+        self.assertAlmostEqual(limiter.take(), 0.5)
+
+    def test_refill_up_to_burst(self):
+        limiter = RateLimiter(rate=2.0, burst=3)
+        limiter.take()
+        self.now += 60
+        self.assertEqual([limiter.take() for _ in range(3)], [0, 0, 0])
+        self.assertGreater(limiter.take(), 0)
+
+    def test_no_limit(self):
+        limiter = RateLimiter(rate=0, burst=1)
+        self.assertEqual([limiter.take() for _ in range(100)], [0] * 100)
+
+    def test_acquire_waits(self):
+        limiter = RateLimiter(rate=4.0, burst=1)
+        limiter.take()
+        sleeps = list()
+
+        def sleep(delay):
+            sleeps.append(delay)
+            self.now += delay
+
+        with mock.patch('viber_command_bot.outbound.time.sleep', sleep):
+            limiter.acquire()
+        self.assertEqual(len(sleeps), 1)
+        self.assertAlmostEqual(sleeps[0], 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Tests for the cache message serializers
+"""
+
+import datetime
+import unittest
+
+from viber_command_bot.serializers import BinarySerializer, MessageCodec
+from viber_command_bot.serializers import SerializerError, MAGIC, VERSION
+
+
+MESSAGE = {'user_id': 'abc==',
+           'text': 'uptime\näö ☃ ' + 'x' * 300,
+           'media': None,
+           'name': 'Tommi',
+           'message_type': 'execute',
+           'output_format': 'text',
+           'command': 'uptime',
+           'destination': ['host1', 'host2'],
+           'date': datetime.datetime(2017, 5, 1, 12, 30, 15, 123456),
+           'request_id': '5012345678901234567'}
+
+
+class BinarySerializerTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = BinarySerializer.dumps(MESSAGE)
+        self.assertEqual(data[:2], MAGIC + bytes([VERSION]))
+        self.assertEqual(BinarySerializer.loads(data), MESSAGE)
+
+    def test_missing_fields_are_none(self):
+        message = BinarySerializer.loads(BinarySerializer.dumps(
+            {'user_id': 'abc==', 'text': 'hello', 'date': MESSAGE['date']}))
+        self.assertEqual(message['text'], 'hello')
+        self.assertIsNone(message['media'])
+        self.assertIsNone(message['request_id'])
+        self.assertEqual(message['destination'], [])
+
+    def test_version_1_is_decoded(self):
+        data = bytearray(BinarySerializer.dumps(MESSAGE))
+        # Version 1 is version 2 without the request id, the last field.
+        data[1] = 1
+        message = BinarySerializer.loads(bytes(data[:-len(
+            MESSAGE['request_id']) - 1]))
+        self.assertNotIn('request_id', message)
+        self.assertEqual(message['text'], MESSAGE['text'])
+        self.assertEqual(message['date'], MESSAGE['date'])
+
+    def test_unknown_field(self):
+        with self.assertRaises(SerializerError):
+            BinarySerializer.dumps(dict(MESSAGE, extra='x'))
+
+    def test_unsupported_version(self):
+        data = MAGIC + bytes([VERSION + 1]) + b'\x00'
+        with self.assertRaises(SerializerError):
+            BinarySerializer.loads(data)
+
+    def test_truncated_message(self):
+        data = BinarySerializer.dumps(MESSAGE)
+        for size in [2, 5, len(data) - 1]:
+            with self.assertRaises(SerializerError):
+                BinarySerializer.loads(data[:size])
+
+
+class MessageCodecTest(unittest.TestCase):
+
+    def test_decodes_all_formats(self):
+        binary = MessageCodec('binary')
+        for name in ['binary', 'json', 'pickle']:
+            data = MessageCodec(name).dumps(MESSAGE)
+            self.assertEqual(binary.loads(data), MESSAGE)
+
+    def test_pickle_not_accepted(self):
+        data = MessageCodec('pickle').dumps(MESSAGE)
+        with self.assertRaises(SerializerError):
+            MessageCodec('binary', accept_pickle=False).loads(data)
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(SerializerError):
+            MessageCodec('xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
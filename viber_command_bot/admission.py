@@ -0,0 +1,87 @@
+"""
+Admission control for the configured commands
+
+Each user and each configured command can have a rate limit. The limits
+are token buckets in Redis, checked and updated with one script call, so
+that they are shared by all the workers in all the hosts. If Redis is not
+available, the buckets are kept in the process.
+"""
+
+import threading
+import time
+from viber_command_bot.commands import user_rate_limit
+from viber_command_bot.metrics import metrics
+
+
+RATE_LIMITED_TEXT = 'Rate limited, try again later.'
+
+
+class LocalBuckets(object):
+    """
+    Class for the token buckets of one process
+    """
+
+    def __init__(self):
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def take_tokens(self, buckets):
+        """
+        Take a token from each token bucket, if every bucket has a token.
+
+        :param buckets: list of tuples (bucket name, tokens per second,
+                        burst)
+        :return: 0 if the tokens were taken, otherwise the number of the
+                 first empty bucket (1 is the first)
+        """
+        now = time.monotonic()
+        with self.lock:
+            available = list()
+            for i, (name, rate, burst) in enumerate(buckets, start=1):
+                tokens, updated = self.buckets.get(name, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                if tokens < 1:
+                    return i
+                available.append(tokens)
+            for (name, _, _), tokens in zip(buckets, available):
+                self.buckets[name] = (tokens - 1, now)
+        return 0
+
+
+def command_buckets(user_id, options):
+    """
+    Get the token buckets that limit the command of the user.
+
+    :param user_id: Viber user id
+    :param options: dict with the command options
+    :return: list of tuples (bucket name, tokens per second, burst)
+    """
+    buckets = list()
+    limit = user_rate_limit(user_id)
+    if limit is not None:
+        buckets.append(('user:{}'.format(user_id),) + limit)
+    if options.get('rate_limit') is not None:
+        buckets.append(('command:{}'.format(options['name']),) +
+                       options['rate_limit'])
+    return buckets
+
+
+def admitted(buckets, result):
+    """
+    Check the result of taking the tokens, and count the rejections.
+
+    :param buckets: list of tuples (bucket name, tokens per second, burst)
+    :param result: result of take_tokens(), or None if Redis was not
+                   available
+    :return: True, if the command is admitted
+    """
+    if result is None:
+        result = local_buckets.take_tokens(buckets)
+    if result == 0:
+        return True
+    metrics.inc('viber_rate_limited_total',
+                limit=buckets[result - 1][0].partition(':')[0])
+    return False
+
+
+local_buckets = LocalBuckets()
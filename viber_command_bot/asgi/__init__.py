@@ -0,0 +1,3 @@
+"""
+Viber command bot ASGI application module
+"""
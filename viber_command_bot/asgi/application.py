@@ -0,0 +1,687 @@
+"""
+Viber command bot ASGI application
+
+Asynchronous version of the Flask application. It uses the same command
+configuration and cache, but Redis, Viber API and the local commands are
+all handled in one event loop, so that one process can serve many
+concurrent webhook requests. Run it with an ASGI server, e.g.:
+
+    uvicorn viber_command_bot.asgi.application:app --uds /var/run/viber/...
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from viberbot.api.viber_requests import ViberConversationStartedRequest
+from viberbot.api.viber_requests import ViberFailedRequest
+from viberbot.api.viber_requests import ViberMessageRequest
+from viberbot.api.viber_requests import ViberSubscribedRequest
+from viberbot.api.viber_requests import ViberUnsubscribedRequest
+from viberbot.api.viber_requests import create_request
+
+from viber_command_bot.admission import admitted, command_buckets
+from viber_command_bot.admission import RATE_LIMITED_TEXT
+from viber_command_bot.asgi.cache import async_cache
+from viber_command_bot.asgi.messages import send_message, send_more
+from viber_command_bot.asgi.messages import sender
+from viber_command_bot.commands import cache_options, command_help
+from viber_command_bot.commands import command_options, command_result
+from viber_command_bot.commands import CommandRouter, gathers_outputs
+from viber_command_bot.commands import is_trusted_user, note_number
+from viber_command_bot.commands import notes_text, pool_status_text
+from viber_command_bot.commands import process_options, split_destination
+from viber_command_bot.commands import unsupported_text
+from viber_command_bot.commands import BUSY_TEXT, MAX_OUTPUT_SIZE
+from viber_command_bot.commands import NO_MORE_TEXT
+from viber_command_bot.config import add_init_listener, config, config_watcher
+from viber_command_bot.config import init_config, ParseError
+from viber_command_bot.cache import cache, CACHE_NOT_AVAILABLE_TEXT
+from viber_command_bot.delta import create_delta, LAST_OUTPUT_TTL
+from viber_command_bot.executor import format_output, record_result
+from viber_command_bot.executor import refreshed_hosts, refreshed_text
+from viber_command_bot.gather import aggregate
+from viber_command_bot.info import info
+from viber_command_bot.logger import init_logging, logger
+from viber_command_bot.metrics import metrics, webhook_event
+from viber_command_bot.output_cache import output_cache
+from viber_command_bot.process import run_command_async
+from viber_command_bot.scheduler import refresh_scheduler
+from viber_command_bot.tracing import current_request_id, tracer
+from viber_command_bot.webhook import event_sender, event_text, event_token
+from viber_command_bot.webhook import parse_event, seen_tokens
+from viber_command_bot.webhook import untrusted_users
+from viber_command_bot.webhook import verify_signature, IGNORED_EVENTS
+
+
+class AsyncCommandPool(object):
+    """
+    Class for limiting the number of concurrently executed commands
+
+    Same limits as in the command pool of the Flask application: number of
+    running commands, number of commands waiting and the per-command limit.
+    """
+
+    def __init__(self, workers=4, queue_size=20):
+        self.configure(workers, queue_size)
+        self.semaphore = None
+        self.pending = dict()
+        self.waiting = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def configure(self, workers, queue_size):
+        """
+        Set the pool size. Called before the pool is used.
+
+        :param workers: number of concurrently running commands
+        :param queue_size: number of commands that can wait
+        :return: None
+        """
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+
+    def submit(self, name, limit, coroutine):
+        """
+        Submit command coroutine to the pool.
+
+        :param name: command name
+        :param limit: maximum number of queued or running executions of the
+                      command, None or 0 means no limit
+        :param coroutine: coroutine executing the command
+        :return: True, if the command was submitted, False if the pool is
+                 full
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        if (limit and self.pending.get(name, 0) >= limit) or \
+                self.waiting >= self.queue_size:
+            self.rejected += 1
+            coroutine.close()
+            return False
+        self.pending[name] = self.pending.get(name, 0) + 1
+        self.waiting += 1
+        self.submitted += 1
+        spawn(self._run(name, coroutine))
+        return True
+
+    def stats(self):
+        """
+        Get pool statistics.
+
+        :return: dict with pool statistics
+        """
+        return {'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queue_depth': self.waiting,
+                'running': self.running,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_avg': (self.wait_total / self.completed
+                             if self.completed else 0.0),
+                'wait_max': self.wait_max}
+
+    def gauges(self):
+        """
+        Get pool gauges for the metrics.
+
+        :return: list of tuples (name, labels, value)
+        """
+        return [('viber_pool_running', dict(), self.running),
+                ('viber_pool_queue_depth', dict(), self.waiting)]
+
+    async def _run(self, name, coroutine):
+        queued = time.monotonic()
+        try:
+            async with self.semaphore:
+                self.waiting -= 1
+                wait = time.monotonic() - queued
+                metrics.observe('viber_command_queue_wait_seconds', wait,
+                                command=name)
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.running += 1
+                try:
+                    await coroutine
+                except Exception as e:
+                    logger.error('Command "%s" failed: %s', name, e)
+                finally:
+                    self.running -= 1
+                    self.completed += 1
+        finally:
+            self.pending[name] -= 1
+            if not self.pending[name]:
+                del self.pending[name]
+
+
+def configure_pool(config):
+    """
+    Configure the command pool from the bot configuration.
+
+    :param config: bot configuration
+    :return: None
+    """
+    command_pool.configure(
+        workers=config.getint('Pool', 'workers', fallback=4),
+        queue_size=config.getint('Pool', 'queue_size', fallback=20))
+
+
+command_pool = AsyncCommandPool()
+metrics.add_collector(command_pool.gauges)
+add_init_listener(configure_pool)
+
+tasks = set()
+
+# The application module is loaded by the ASGI server at startup.
+try:
+    init_config()
+except ParseError as e:
+    # Configuration parsing error is fatal.
+    print('FATAL: {}'.format(e))
+    sys.exit(1)
+init_logging()
+
+
+def spawn(coroutine):
+    """
+    Run coroutine in the background. A reference to the task is kept until
+    the task is done.
+
+    :param coroutine: coroutine to run
+    :return: task
+    """
+    task = asyncio.ensure_future(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application.
+
+    :param scope: connection scope
+    :param receive: coroutine for receiving events
+    :param send: coroutine for sending events
+    :return: None
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    root_path = scope.get('root_path', '').rstrip('/')
+    if scope['method'] != 'POST':
+        status = 405
+    elif scope['path'].rstrip('/') != root_path:
+        status = 404
+    else:
+        body = b''
+        more_body = True
+        while more_body:
+            event = await receive()
+            body += event.get('body', b'')
+            more_body = event.get('more_body', False)
+        signature = None
+        for k, v in scope['headers']:
+            if k.lower() == b'x-viber-content-signature':
+                signature = v.decode()
+        status = await bot_request(body, signature)
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-length', b'0')]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    """
+    Handle ASGI lifespan events: create and close the client sessions.
+
+    :param receive: coroutine for receiving events
+    :param send: coroutine for sending events
+    :return: None
+    """
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await sender.start()
+            config_watcher.start()
+            metrics.start_server()
+            if not config.getboolean('Viber', 'command_executor',
+                                     fallback=False):
+                # The scheduler runs the commands in a thread.
+                refresh_scheduler.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            if tasks:
+                await asyncio.wait(list(tasks), timeout=30)
+            await sender.close()
+            await async_cache.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def bot_request(body, signature):
+    """
+    Receive bot request from Viber service.
+
+    :param body: request body
+    :param signature: value of X-Viber-Content-Signature header
+    :return: 200, if request is successful
+             400, if request body is not valid
+             403, if request is not allowed
+    """
+    with metrics.timer('viber_webhook_latency_seconds',
+                       event='invalid') as labels, \
+            tracer.trace('webhook') as trace:
+        logger.debug('Received request, post data: %s', body)
+        with tracer.span('verify'):
+            verified = verify_signature(body, signature)
+        if not verified:
+            return 403
+        with tracer.span('parse'):
+            event = parse_event(body)
+        if event is None:
+            return 400
+        if event.get('message_token'):
+            trace.request_id = str(event['message_token'])
+        labels['event'] = webhook_event(event.get('event'))
+        return await handle_event(event)
+
+
+async def handle_event(event):
+    """
+    Handle verified Viber callback event.
+
+    :param event: parsed event
+    :return: 200, if request is successful
+             403, if request is not allowed
+             500, if handling the request fails
+    """
+    if event.get('event') in IGNORED_EVENTS:
+        return 200
+
+    token = event_token(event)
+    try:
+        if event.get('event') == 'message' and \
+                not await check_user_id(event):
+            return 403
+        if token is not None and not await first_token(token):
+            logger.info('Callback %s has already been handled', token)
+            return 200
+        with tracer.span('create_request'):
+            viber_request = create_request(event)
+        async with async_cache.batch():
+            return await handle_request(viber_request)
+    except Exception as e:
+        logger.error('Failed to handle request: %s', e)
+        if token is not None:
+            # Viber sends the callback again.
+            seen_tokens.forget(token)
+            await async_cache.forget_token(token)
+        return 500
+
+
+async def first_token(token):
+    """
+    Check if the callback is received for the first time by any process.
+
+    :param token: message token of the callback
+    :return: True, if the callback should be handled
+    """
+    return seen_tokens.first(token) and await async_cache.first_token(
+        token, config.getint('Viber', 'token_ttl', fallback=3600))
+
+
+async def handle_request(viber_request):
+    """
+    Handle parsed bot request from Viber service.
+
+    :param viber_request: request from Viber service
+    :return: 200, if request is successful
+    """
+    if isinstance(viber_request, ViberConversationStartedRequest):
+        await async_cache.conversation_started(viber_request.user.id,
+                                               viber_request.user.name)
+        await send_message(viber_request.user.id,
+                           'Hello, {}!\n\n{}'.format(
+                               viber_request.user.name, command_help()))
+    elif isinstance(viber_request, ViberMessageRequest):
+        await handle_viber_request(viber_request)
+    elif isinstance(viber_request, ViberSubscribedRequest):
+        logger.info('User "%s" subscribed as user id "%s"',
+                    viber_request.user.name, viber_request.user.id)
+        await async_cache.subscribe_user(viber_request.user.id,
+                                         viber_request.user.name)
+        await send_message(viber_request.user.id,
+                           'Hello, {}!\n\n{}'.format(
+                               viber_request.user.name, command_help()))
+    elif isinstance(viber_request, ViberUnsubscribedRequest):
+        logger.info('User id "%s" un-subscribed', viber_request.user_id)
+        await async_cache.unsubscribe_user(viber_request.user_id)
+    elif isinstance(viber_request, ViberFailedRequest):
+        logger.warning('Client failed receiving message, failure: %s',
+                       viber_request)
+
+    return 200
+
+
+async def check_user_id(event):
+    """
+    Check that the message event comes from a trusted user id. The notify
+    user is told about an un-trusted user id only once.
+
+    :param event: parsed message event
+    :return: True, if event is from trusted user id
+             False, if event comes from un-trusted user id
+    """
+    user_id, name = event_sender(event)
+    if not is_trusted_user(user_id):
+        logger.warning('Received message from un-trusted user "%s" (user id '
+                       '"%s"): %s', name, user_id, event_text(event))
+        if untrusted_users.first(user_id):
+            text = ('Received message from un-trusted user "{}" (user id '
+                    '"{}"): {}'.format(name, user_id, event_text(event)))
+            await send_message(config.get('Viber', 'notify_user_id'), text)
+        return False
+    logger.info('Received message from trusted user "%s" (user id "%s"): '
+                '%s', name, user_id, event_text(event))
+    return True
+
+
+async def handle_viber_request(viber_request):
+    """
+    Checks that Viber request is a command.
+
+    :param viber_request: request from Viber service
+    :return: None
+    """
+    text = viber_request.message.text.strip()
+    await async_cache.refresh_user(viber_request.sender.id,
+                                   viber_request.sender.name)
+    await async_cache.publish(viber_request.sender.id, text,
+                              name=viber_request.sender.name)
+    if text.startswith('/'):
+        await execute_command(viber_request, text[len('/'):].strip())
+
+
+async def execute_command(viber_request, command):
+    """
+    Executes command received in Viber request.
+
+    :param viber_request: request from Viber service
+    :param command: command found in request
+    :return: None
+    """
+    command, destination = split_destination(command)
+    logger.info('Received command "%s" from user "%s"', command,
+                viber_request.sender.name)
+    handler, argument = router.route(command)
+    await handler(viber_request, argument, destination)
+
+
+# Internal command handlers, routed by the INTERNAL_COMMANDS table of
+# viber_command_bot.commands, where the handler interface is documented.
+
+
+async def show_help(viber_request, argument, destination):
+    await send_message(viber_request.sender.id, command_help())
+
+
+async def show_version(viber_request, argument, destination):
+    await send_message(viber_request.sender.id, info)
+
+
+async def show_queue(viber_request, argument, destination):
+    await send_message(viber_request.sender.id,
+                       pool_status_text(command_pool.stats()))
+
+
+async def echo(viber_request, argument, destination):
+    await send_message(viber_request.sender.id, argument or ':-)')
+
+
+async def add_note(viber_request, argument, destination):
+    if await async_cache.add_note(argument) is None:
+        await send_message(viber_request.sender.id, CACHE_NOT_AVAILABLE_TEXT)
+
+
+async def show_note(viber_request, argument, destination):
+    text = await async_cache.show_note(number=note_number(argument))
+    await send_message(viber_request.sender.id,
+                       CACHE_NOT_AVAILABLE_TEXT if text is None else text)
+
+
+async def show_all_notes(viber_request, argument, destination):
+    notes = await async_cache.show_all_notes()
+    await send_message(viber_request.sender.id,
+                       CACHE_NOT_AVAILABLE_TEXT if notes is None else
+                       notes_text(notes))
+
+
+async def remove_note(viber_request, argument, destination):
+    if await async_cache.remove_note(number=note_number(argument)) is None:
+        await send_message(viber_request.sender.id, CACHE_NOT_AVAILABLE_TEXT)
+
+
+async def remove_all_notes(viber_request, argument, destination):
+    if await async_cache.remove_all_notes() is None:
+        await send_message(viber_request.sender.id, CACHE_NOT_AVAILABLE_TEXT)
+
+
+async def show_more(viber_request, argument, destination):
+    if not await send_more(viber_request.sender.id):
+        await send_message(viber_request.sender.id, NO_MORE_TEXT)
+
+
+async def profile(viber_request, argument, destination):
+    if viber_request.sender.id != config.get('Viber', 'notify_user_id'):
+        await unsupported_command(viber_request, 'profile', destination)
+    elif not tracer.profile_directory:
+        await send_message(viber_request.sender.id,
+                           'Profile directory is not configured.')
+    else:
+        count = argument or tracer.profile_requests
+        tracer.profile(count)
+        await send_message(viber_request.sender.id,
+                           'Profiling the next {} requests of worker '
+                           '{}.'.format(count, os.getpid()))
+
+
+async def unsupported_command(viber_request, command, destination):
+    await send_message(viber_request.sender.id,
+                       unsupported_text(command, viber_request.sender.name))
+
+
+async def execute_configured_command(viber_request, options, destination):
+    command = options['name']
+    if options['error']:
+        await send_message(viber_request.sender.id, options['error'])
+        return
+    buckets = command_buckets(viber_request.sender.id, options)
+    if buckets and not admitted(buckets,
+                                await async_cache.take_tokens(buckets)):
+        logger.warning('Command "%s" from user "%s" rejected: rate limited',
+                       command, viber_request.sender.name)
+        await send_message(viber_request.sender.id, RATE_LIMITED_TEXT)
+        return
+    if options['refresh_interval'] and options['output_format'] != 'none' \
+            and await send_refreshed(viber_request.sender.id, options,
+                                     destination):
+        return
+    if options.get('refresh'):
+        # "/name full": the command executors answer with the full output.
+        await async_cache.clear_last_output(viber_request.sender.id, command)
+    if config.getboolean('Viber', 'command_executor', fallback=False):
+        hosts = cache.expand_destination(destination)
+        if gathers_outputs(options, hosts, current_request_id()):
+            # The outputs of the hosts are gathered to one answer in the
+            # command pool.
+            if not command_pool.submit(
+                    command, options['max_concurrency'], gather_task(
+                        viber_request.sender.id, command, hosts,
+                        current_request_id(), options['gather_timeout'])):
+                logger.warning('Command "%s" from user "%s" rejected: '
+                               'command pool is full', command,
+                               viber_request.sender.name)
+                await send_message(viber_request.sender.id, BUSY_TEXT)
+                return
+        # There is another daemon that handles the messages. Just publish
+        # the message.
+        await async_cache.publish(viber_request.sender.id,
+                                  options['execute'],
+                                  destination=destination,
+                                  name=viber_request.sender.name,
+                                  message_type='execute',
+                                  output_format=options['output_format'],
+                                  command=command)
+    elif not command_pool.submit(
+            command, options['max_concurrency'], command_task(
+                options['execute'], options['output_format'],
+                viber_request.sender.id, options=options,
+                request_id=current_request_id())):
+        logger.warning('Command "%s" from user "%s" rejected: command pool '
+                       'is full', command, viber_request.sender.name)
+        await send_message(viber_request.sender.id, BUSY_TEXT)
+
+
+router = CommandRouter()
+router.add_handlers(globals())
+
+
+async def command_task(execute, output_format, user_id, command=None,
+                       options=None, request_id=None):
+    """
+    Local command is run in a background task.
+
+    :param execute: local command to execute
+    :param output_format: expected command output format specified in the bot
+                          configuration
+    :param user_id: user id who will receive the answer
+    :param command: configured command name, used for command options
+    :param options: dict with the command options, default is the options
+                    of the command in the current configuration
+    :param request_id: request id of the webhook request
+    :return: None
+    """
+    if options is None:
+        options = command_options(command)
+    cache_ttl, cache_scope = cache_options(options)
+    with tracer.trace('command', request_id=request_id):
+        text, media = await execute_local_command(
+            execute, output_format, cache_ttl=cache_ttl,
+            cache_scope=cache_scope, limits=process_options(options),
+            command=options.get('name', command))
+        if output_format == 'none':
+            return
+        if options.get('output_mode') == 'diff' and text:
+            text = await delta_text(user_id, options, text)
+        await send_message(user_id, text, media=media)
+
+
+async def gather_task(user_id, command, hosts, request_id, timeout):
+    """
+    Wait for the outputs of the hosts, and send the aggregated answer.
+
+    :param user_id: user id who will receive the answer
+    :param command: configured command name
+    :param hosts: list of destination hosts
+    :param request_id: request id of the published command
+    :param timeout: deadline in seconds
+    :return: None
+    """
+    outputs = await async_cache.gather(request_id, hosts, timeout)
+    await send_message(user_id, aggregate(command, hosts, outputs))
+
+
+async def delta_text(user_id, options, text, host=None):
+    """
+    Get the answer of a command with the diff output mode.
+
+    :param user_id: user id who will receive the answer
+    :param options: dict with the command options
+    :param text: command output
+    :param host: host of the output, default is this host
+    :return: answer text
+    """
+    previous = await async_cache.swap_last_output(
+        user_id, options['name'], text, LAST_OUTPUT_TTL, host=host)
+    if options.get('refresh'):
+        previous = None
+    return create_delta(options['name'], previous, text)
+
+
+async def send_refreshed(user_id, options, destination=None):
+    """
+    Answer with the outputs of the command refreshed ahead. See
+    viber_command_bot.executor.send_refreshed().
+
+    :param user_id: user id who will receive the answer
+    :param options: dict with the command options
+    :param destination: list of addressed hosts and host groups
+    :return: True, if the refreshed outputs were sent
+    """
+    refreshed = await async_cache.get_refreshed(options['name'])
+    hosts = refreshed_hosts(refreshed, options, destination)
+    for host in hosts:
+        output, date = refreshed[host]
+        text, media = format_output(options['execute'],
+                                    options['output_format'], 0, output)
+        if options.get('output_mode') == 'diff' and text:
+            text = await delta_text(user_id, options, text, host=host)
+        await send_message(user_id, refreshed_text(text, date, host),
+                           media=media)
+    return bool(hosts)
+
+
+async def execute_local_command(execute, output_format='text', cache_ttl=0,
+                                cache_scope='process', limits=None,
+                                command=None):
+    """
+    Execute local command in another process, or get the output from the
+    output cache. Concurrent executions of the same command are collapsed.
+
+    :param execute: command found
+    :param output_format: text | json | none
+    :param cache_ttl: time to live of the cached output in seconds
+    :param cache_scope: process | host | global
+    :param limits: dict with process limits, see run_local_command()
+    :param command: configured command name, used for metrics
+    :return: (message text, optional media url)
+    """
+    if limits is None:
+        limits = dict()
+    rc, output = await output_cache.get_async(
+        execute, cache_ttl,
+        lambda: run_local_command(execute, command=command, **limits),
+        scope=cache_scope, shared=async_cache)
+    return format_output(execute, output_format, rc, output)
+
+
+async def run_local_command(execute, timeout=None, cpu_time=None,
+                            memory=None, command=None):
+    """
+    Run local command in another process. The output is read up to the
+    maximum message size, and the command is killed if it produces more
+    output or runs longer than the timeout.
+
+    :param execute: command found
+    :param timeout: timeout in seconds, or None
+    :param cpu_time: maximum CPU time in seconds, or None
+    :param memory: maximum virtual memory in bytes, or None
+    :param command: configured command name, used for metrics
+    :return: (return code, output text or error message)
+    """
+    logger.info('Running command "%s"', execute)
+    start = time.perf_counter()
+    with tracer.span('subprocess'):
+        result = await run_command_async(execute, MAX_OUTPUT_SIZE,
+                                         timeout=timeout, cpu_time=cpu_time,
+                                         memory=memory)
+    record_result(command, result, time.perf_counter() - start)
+    return command_result(execute, result, timeout)
@@ -0,0 +1,55 @@
+"""
+Circuit breaker for the asynchronous Redis client
+"""
+
+import asyncio
+import redis.asyncio
+import redis.exceptions
+from viber_command_bot.breaker import BreakerPipeline, CircuitBreaker
+from viber_command_bot.breaker import PoolExhaustedError, timed
+
+
+class AsyncBreakerConnectionPool(redis.asyncio.BlockingConnectionPool):
+    """
+    Asynchronous blocking connection pool that raises PoolExhaustedError
+    when no connection becomes free in time
+    """
+
+    async def get_connection(self, *args, **kwargs):
+        try:
+            return await super().get_connection(*args, **kwargs)
+        except redis.exceptions.ConnectionError as e:
+            if isinstance(e.__cause__, (asyncio.TimeoutError, TimeoutError)):
+                raise PoolExhaustedError(
+                    'All the {} Redis connections are in use'.format(
+                        self.max_connections)) from e
+            raise
+
+
+class AsyncBreakerPipeline(BreakerPipeline):
+    """
+    Asynchronous pipeline that is executed through the circuit breaker
+    """
+
+    async def execute(self, *args, **kwargs):
+        with self.breaker.call(), timed('pipeline'):
+            return await self.pipeline.execute(*args, **kwargs)
+
+
+class AsyncBreakerRedis(redis.asyncio.StrictRedis):
+    """
+    Asynchronous Redis client that sends the commands through the circuit
+    breaker
+    """
+
+    def __init__(self, *args, breaker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker or CircuitBreaker()
+
+    async def execute_command(self, *args, **options):
+        with self.breaker.call(), timed(args[0]):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        return AsyncBreakerPipeline(super().pipeline(*args, **kwargs),
+                                    self.breaker)
@@ -0,0 +1,593 @@
+"""
+Viber bot cache with asynchronous Redis client
+
+The asynchronous cache uses the same Redis keys, message format and routing
+as the cache used by the Flask application, so that both applications and
+the command executor daemon can share the same Redis.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import redis.asyncio
+import redis.exceptions
+import socket
+import time
+from viber_command_bot.asgi.breaker import AsyncBreakerConnectionPool
+from viber_command_bot.asgi.breaker import AsyncBreakerRedis
+from viber_command_bot.cache import cache, NOTES, NOTE_TEXTS, USERS
+from viber_command_bot.cache import REMOVE_NOTE_SCRIPT, SHOW_NOTE_SCRIPT
+from viber_command_bot.cache import decode_refreshed, note_dict
+from viber_command_bot.cache import STREAM_MAXLEN
+from viber_command_bot.cache import TOKEN_BUCKET_SCRIPT
+from viber_command_bot.config import add_init_listener
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCache(object):
+    """
+    Class for the asynchronous cache
+    """
+
+    def __init__(self):
+        self.redis = None
+        self.blocking = None
+        self.channel = None
+        self.pipeline = contextvars.ContextVar('pipeline', default=None)
+        self.published = contextvars.ContextVar('published', default=None)
+        self.user_names = dict()
+        self.replay_lock = asyncio.Lock()
+        self.show_note_script = None
+        self.remove_note_script = None
+        self.token_bucket_script = None
+
+    def configure(self, config):
+        """
+        Create the Redis clients with the settings of the cache. Called
+        before the cache is used.
+
+        :param config: bot configuration
+        :return: None
+        """
+        pool = AsyncBreakerConnectionPool(
+            host=cache.host, port=cache.port,
+            socket_timeout=cache.socket_timeout,
+            socket_connect_timeout=cache.connect_timeout,
+            max_connections=cache.max_connections,
+            timeout=cache.socket_timeout)
+        # The breaker and the replay buffer are shared with the cache.
+        self.redis = AsyncBreakerRedis(connection_pool=pool,
+                                       breaker=cache.breaker)
+        # Blocking reads wait longer than the socket timeout.
+        self.blocking = redis.asyncio.StrictRedis(
+            host=cache.host, port=cache.port,
+            socket_connect_timeout=cache.connect_timeout)
+        self.channel = cache.channel
+        self.show_note_script = self.redis.register_script(SHOW_NOTE_SCRIPT)
+        self.remove_note_script = self.redis.register_script(
+            REMOVE_NOTE_SCRIPT)
+        self.token_bucket_script = self.redis.register_script(
+            TOKEN_BUCKET_SCRIPT)
+
+    async def close(self):
+        """
+        Close the Redis connections.
+
+        :return: None
+        """
+        await self.redis.close()
+        await self.blocking.close()
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        """
+        Context for batching the cache writes of the current task. See
+        Cache.batch().
+
+        :return: asynchronous context manager
+        """
+        if self.pipeline.get() is not None:
+            yield
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        token = self.pipeline.set(pipeline)
+        published = list()
+        published_token = self.published.set(published)
+        try:
+            yield
+        finally:
+            self.pipeline.reset(token)
+            self.published.reset(published_token)
+            try:
+                await pipeline.execute()
+            except redis.exceptions.ConnectionError:
+                self.user_names.clear()
+                for message, routes in published:
+                    cache.buffer(message, routes)
+
+    async def write(self, method, *args, **kwargs):
+        """
+        Write to Redis, or add the write to the batch pipeline of the current
+        task.
+
+        :param method: name of the Redis command method
+        :param args: positional arguments for the command
+        :param kwargs: keyword arguments for the command
+        :return: None
+        """
+        pipeline = self.pipeline.get()
+        if pipeline is not None:
+            getattr(pipeline, method)(*args, **kwargs)
+            return
+        await getattr(self.redis, method)(*args, **kwargs)
+
+    async def subscribe_user(self, user_id, name):
+        """
+        User is subscribed to the cache.
+
+        :param user_id: Viber bot unique user id
+        :param name: user name
+        :return: None
+        """
+        if self.channel is None:
+            return
+        await self.set_user(user_id, name)
+        await self.publish(user_id, 'Subscribe "{}": {}'.format(
+            name, user_id), name=name)
+
+    async def conversation_started(self, user_id, name):
+        """
+        User conversation is started.
+
+        :param user_id: Viber bot unique user id
+        :param name: user name
+        :return: None
+        """
+        if self.channel is None:
+            return
+        await self.set_user(user_id, name)
+        await self.publish(user_id, 'Conversation started: {}'.format(
+            user_id), name=name)
+
+    async def refresh_user(self, user_id, name):
+        """
+        User is refreshed in the cache. Nothing is written, if the user name
+        is already known to be up to date.
+
+        :param user_id: Viber bot unique user id
+        :param name: user name
+        :return: None
+        """
+        if self.channel is None or self.user_names.get(user_id) == name:
+            return
+        await self.set_user(user_id, name)
+
+    async def set_user(self, user_id, name):
+        """
+        Store user in the user registry hash.
+
+        :param user_id: Viber bot unique user id
+        :param name: user name
+        :return: None
+        """
+        try:
+            await self.write('hset', USERS, user_id, name)
+        except redis.exceptions.ConnectionError:
+            return
+        self.user_names[user_id] = name
+
+    async def unsubscribe_user(self, user_id):
+        """
+        User is un-subscribed from the cache.
+
+        :param user_id: Viber bot unique user id
+        :return: None
+        """
+        if self.channel is None:
+            return
+        self.user_names.pop(user_id, None)
+        try:
+            name = await self.redis.hget(USERS, user_id)
+            if name is None:
+                name = await self.redis.get(
+                    'viber-user-id:{}'.format(user_id))
+            await self.write('hdel', USERS, user_id)
+            await self.write('delete', 'viber-user-id:{}'.format(user_id))
+        except redis.exceptions.ConnectionError:
+            name = None
+        name = name.decode() if name is not None else user_id
+        await self.publish(user_id, 'Un-subscribe "{}": {}'.format(
+            name, user_id), name=name)
+
+    async def publish(self, user_id, text, **kwargs):
+        """
+        Message is published to the cache. See Cache.publish() for the
+        parameters.
+
+        :return: None
+        """
+        if self.channel is None:
+            return
+        message, routes = cache.create_message(user_id, text, **kwargs)
+        if cache.replay:
+            await self.replay_messages()
+        try:
+            for stream, key in routes:
+                if stream:
+                    await self.write('xadd', key, {'message': message},
+                                     maxlen=STREAM_MAXLEN, approximate=True)
+                else:
+                    await self.write('publish', key, message)
+        except redis.exceptions.ConnectionError:
+            cache.buffer(message, routes)
+            return
+        published = self.published.get()
+        if published is not None:
+            published.append((message, routes))
+
+    async def replay_messages(self):
+        """
+        Publish the messages buffered while Redis was not available. See
+        Cache.replay_messages().
+
+        :return: None
+        """
+        if not cache.breaker.closed or self.replay_lock.locked():
+            return
+        async with self.replay_lock:
+            # The buffer is shared with the threads of the cache. The thread
+            # lock is not waited for, so that the event loop is not blocked
+            # while a thread replays.
+            if not cache.replay_lock.acquire(blocking=False):
+                return
+            try:
+                items = list(cache.replay)
+                cache.replay.clear()
+                now = time.monotonic()
+                items = [item for item in items
+                         if now - item[0] <= cache.replay_age]
+                if not items:
+                    return
+                pipeline = self.redis.pipeline(transaction=False)
+                for _, message, routes in items:
+                    cache.write_message(pipeline, message, routes)
+                try:
+                    await pipeline.execute()
+                except redis.exceptions.ConnectionError:
+                    cache.replay.extendleft(reversed(items))
+            finally:
+                cache.replay_lock.release()
+
+    async def get_output(self, key):
+        """
+        Get cached command output.
+
+        :param key: cache key of the command
+        :return: output text, or None if the output is not in the cache
+        """
+        if self.channel is None:
+            return None
+        try:
+            output = await self.redis.get('viber-output:{}'.format(key))
+        except redis.exceptions.ConnectionError:
+            return None
+        if output is None:
+            return None
+        return output.decode()
+
+    async def set_output(self, key, output, ttl):
+        """
+        Add command output to cache.
+
+        :param key: cache key of the command
+        :param output: output text
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        if self.channel is None:
+            return
+        try:
+            await self.redis.setex('viber-output:{}'.format(key),
+                                   int(ttl) or 1, output)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    async def set_more(self, user_id, text, ttl):
+        """
+        Store the text that did not fit in the message sent to the user.
+
+        :param user_id: Viber bot unique user id
+        :param text: rest of the text
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        if self.channel is None:
+            return
+        try:
+            await self.write('setex', 'viber-more:{}'.format(user_id),
+                             int(ttl) or 1, text)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    async def pop_more(self, user_id):
+        """
+        Get and remove the text stored with set_more().
+
+        :param user_id: Viber bot unique user id
+        :return: text, or None if there is no text left
+        """
+        if self.channel is None:
+            return None
+        key = 'viber-more:{}'.format(user_id)
+        pipeline = self.redis.pipeline()
+        pipeline.get(key)
+        pipeline.delete(key)
+        try:
+            text, _ = await pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            return None
+        if text is None:
+            return None
+        return text.decode()
+
+    async def swap_last_output(self, user_id, command, output, ttl,
+                               host=None):
+        """
+        Store the output of the command sent to the user, and get the
+        previous output. See Cache.swap_last_output().
+
+        :param user_id: Viber bot unique user id
+        :param command: configured command name
+        :param output: output text
+        :param ttl: time to live in seconds
+        :param host: host of the output, default is this host
+        :return: previous output text, or None if there is no previous
+                 output
+        """
+        if self.channel is None:
+            return None
+        key = 'viber-last-output:{}:{}'.format(user_id, command)
+        if host is None:
+            host = socket.gethostname()
+        pipeline = self.redis.pipeline()
+        pipeline.hget(key, host)
+        pipeline.hset(key, host, output)
+        pipeline.expire(key, int(ttl) or 1)
+        try:
+            previous, _, _ = await pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            return None
+        if previous is None:
+            return None
+        return previous.decode()
+
+    async def clear_last_output(self, user_id, command):
+        """
+        Forget the outputs of the command sent to the user, so that the next
+        answer has the full output.
+
+        :param user_id: Viber bot unique user id
+        :param command: configured command name
+        :return: None
+        """
+        if self.channel is None:
+            return
+        try:
+            await self.write('delete', 'viber-last-output:{}:{}'.format(
+                user_id, command))
+        except redis.exceptions.ConnectionError:
+            pass
+
+    async def get_refreshed(self, command):
+        """
+        Get the outputs of the command refreshed ahead. See
+        Cache.get_refreshed().
+
+        :param command: configured command name
+        :return: dict {host: (output text, time of the refresh)}
+        """
+        if self.channel is None:
+            return dict()
+        try:
+            values = await self.redis.hgetall('viber-refreshed:{}'.format(
+                command))
+        except redis.exceptions.ConnectionError:
+            return dict()
+        return decode_refreshed(values)
+
+    async def gather(self, request_id, hosts, timeout):
+        """
+        Wait for the outputs of a multi-host command. See Cache.gather().
+
+        :param request_id: request id of the command
+        :param hosts: list of destination hosts
+        :param timeout: timeout in seconds
+        :return: dict {host: output text} of the hosts that answered
+        """
+        if self.channel is None:
+            return dict()
+        key = 'viber-gather:{}'.format(request_id)
+        waiting = set(hosts)
+        deadline = time.monotonic() + timeout
+        try:
+            while waiting:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                item = await self.blocking.blpop(
+                    ['{}:done'.format(key)], timeout=max(0.01, remaining))
+                if item is not None:
+                    waiting.discard(item[1].decode())
+            outputs = await self.blocking.hgetall(key)
+            await self.blocking.delete(key, '{}:done'.format(key))
+        except redis.exceptions.ConnectionError:
+            return dict()
+        return dict((host.decode(), output.decode())
+                    for host, output in outputs.items())
+
+    async def first_token(self, token, ttl):
+        """
+        Mark the message token of a callback handled in any process. See
+        Cache.first_token().
+
+        :param token: message token
+        :param ttl: time to live in seconds
+        :return: True, if the token was not marked before
+        """
+        if self.channel is None:
+            return True
+        try:
+            return bool(await self.redis.set(
+                'viber-token:{}'.format(token), 1, nx=True, ex=int(ttl) or 1))
+        except redis.exceptions.ConnectionError:
+            return True
+
+    async def forget_token(self, token):
+        """
+        Remove the mark of the message token.
+
+        :param token: message token
+        :return: None
+        """
+        if self.channel is None:
+            return
+        try:
+            await self.redis.delete('viber-token:{}'.format(token))
+        except redis.exceptions.ConnectionError:
+            pass
+
+    async def take_tokens(self, buckets):
+        """
+        Take a token from each token bucket. See Cache.take_tokens().
+
+        :param buckets: list of tuples (bucket name, tokens per second,
+                        burst)
+        :return: 0 if the tokens were taken, otherwise the number of the
+                 first empty bucket; None if Redis is not available
+        """
+        if self.channel is None:
+            return None
+        args = list()
+        for _, rate, burst in buckets:
+            args.extend([rate, burst])
+        try:
+            return int(await self.token_bucket_script(
+                keys=['viber-rate:{}'.format(name) for name, _, _ in buckets],
+                args=args))
+        except redis.exceptions.ConnectionError:
+            return None
+
+    async def add_note(self, text):
+        """
+        Add note to cache.
+
+        :param text: text to be copied
+        :return: True, or None if Redis is not available
+        """
+        if self.channel is None:
+            return None
+        try:
+            await self.migrate_notes()
+            note_id = int(time.time() * 1000000)
+            pipeline = self.redis.pipeline()
+            pipeline.zadd(NOTES, {note_id: note_id})
+            pipeline.hset(NOTE_TEXTS, note_id, text)
+            await pipeline.execute()
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to add note: %s', e)
+            return None
+        return True
+
+    async def show_note(self, number=-1):
+        """
+        Show note from cache.
+
+        :param number: note number, 0 is first, 1 is second and so on
+        :return: text found in the cache, or empty string; None if Redis is
+                 not available
+        """
+        if self.channel is None:
+            return None
+        try:
+            await self.migrate_notes()
+            text = await self.show_note_script(keys=[NOTES, NOTE_TEXTS],
+                                               args=[number])
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to show note: %s', e)
+            return None
+        if text:
+            return text.decode()
+        return ''
+
+    async def show_all_notes(self):
+        """
+        Show all notes from cache.
+
+        :return: dict with texts found in the cache, or empty dict; None if
+                 Redis is not available
+        """
+        if self.channel is None:
+            return None
+        try:
+            await self.migrate_notes()
+            pipeline = self.redis.pipeline()
+            pipeline.zrange(NOTES, 0, -1)
+            pipeline.hgetall(NOTE_TEXTS)
+            note_ids, note_texts = await pipeline.execute()
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to show notes: %s', e)
+            return None
+        return note_dict(note_ids, note_texts)
+
+    async def remove_note(self, number=-1):
+        """
+        Remove note from cache.
+
+        :param number: note number, 0 is first, 1 is second and so on
+        :return: True, or None if Redis is not available
+        """
+        if self.channel is None:
+            return None
+        try:
+            await self.migrate_notes()
+            await self.remove_note_script(keys=[NOTES, NOTE_TEXTS],
+                                          args=[number])
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to remove note: %s', e)
+            return None
+        return True
+
+    async def remove_all_notes(self):
+        """
+        Clear all texts from cache.
+
+        :return: True, or None if Redis is not available
+        """
+        if self.channel is None:
+            return None
+        try:
+            await self.migrate_notes()
+            await self.redis.delete(NOTES, NOTE_TEXTS)
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to remove notes: %s', e)
+            return None
+        return True
+
+    async def migrate_notes(self):
+        """
+        Move notes stored in the old keys to the note index. The migration is
+        done by the synchronous cache in a thread, only once.
+
+        :return: None
+        """
+        if cache.notes_migrated:
+            return
+        await asyncio.get_running_loop().run_in_executor(
+            None, cache.migrate_notes)
+
+
+async_cache = AsyncCache()
+add_init_listener(async_cache.configure)
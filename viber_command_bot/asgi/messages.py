@@ -0,0 +1,234 @@
+"""
+Asynchronous sending of Viber bot messages
+
+Messages are queued and sent by a background task, so that the webhook does
+not wait for the Viber API. Sending uses the rate limiter and the retry
+policy of the outbound queue of the Flask application.
+"""
+
+import aiohttp
+import asyncio
+import logging
+from viber_command_bot.asgi.cache import async_cache
+from viber_command_bot.config import config
+from viber_command_bot.messages import create_text_message_list
+from viber_command_bot.metrics import metrics
+from viber_command_bot.outbound import check_response, create_payload
+from viber_command_bot.outbound import outbound, retry_delay
+from viber_command_bot.outbound import RetryableSendError, SendError
+from viber_command_bot.tracing import current_request_id, tracer
+from viberbot.api.messages import URLMessage
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSender(object):
+    """
+    Class for sending messages through the Viber API with a shared HTTP
+    client session.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.queue = None
+        self.worker = None
+
+    async def start(self):
+        """
+        Create the HTTP client session, the message queue and the worker
+        task.
+
+        :return: None
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={'X-Viber-Auth-Token': config.get(
+                    'Viber', 'authentication_token')},
+                timeout=aiohttp.ClientTimeout(total=outbound.timeout))
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=outbound.queue.maxsize)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def close(self, timeout=30):
+        """
+        Send the queued messages, and close the HTTP client session.
+
+        :param timeout: maximum time to wait for the queued messages
+        :return: None
+        """
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.error('Dropped %s queued messages', self.queue.qsize())
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def send(self, user_id, messages):
+        """
+        Queue messages for sending. Messages are sent in the queued order.
+
+        :param user_id: viber user id who will receive the messages
+        :param messages: list of viberbot message objects
+        :return: None
+        """
+        await self.start()
+        try:
+            self.queue.put_nowait((user_id, messages, current_request_id()))
+        except asyncio.QueueFull:
+            metrics.inc('viber_send_failures_total', len(messages),
+                        reason='dropped')
+            logger.error('Outbound queue is full, dropped %s messages to '
+                         'user id "%s"', len(messages), user_id)
+
+    async def run(self):
+        """
+        Worker task sends the queued messages.
+        """
+        while True:
+            user_id, messages, request_id = await self.queue.get()
+            try:
+                with tracer.trace('send', request_id=request_id):
+                    await self.send_messages(user_id, messages)
+            except Exception as e:
+                logger.error('Failed to send message to user id "%s": %s',
+                             user_id, e)
+            finally:
+                self.queue.task_done()
+
+    async def send_messages(self, user_id, messages):
+        """
+        Send messages to Viber user and wait until they have been sent.
+
+        :param user_id: viber user id who will receive the messages
+        :param messages: list of viberbot message objects
+        :return: None
+        :raises SendError: if Viber API does not accept the message
+        """
+        await self.start()
+        for message in messages:
+            await self.send_payload(create_payload(user_id, message))
+
+    async def send_payload(self, payload):
+        """
+        Send one message, retrying with exponential backoff.
+
+        :param payload: message payload
+        :return: None
+        :raises SendError: if sending fails
+        """
+        attempt = 0
+        while True:
+            delay = outbound.limiter.take()
+            while delay:
+                await asyncio.sleep(delay)
+                delay = outbound.limiter.take()
+            try:
+                with metrics.timer('viber_send_latency_seconds'), \
+                        tracer.span('viber_api'):
+                    await self.post(payload)
+                return
+            except RetryableSendError as e:
+                attempt += 1
+                if attempt > outbound.retries:
+                    metrics.inc('viber_send_failures_total', reason='error')
+                    raise
+                delay = retry_delay(attempt)
+                logger.warning('%s; retrying in %.1f seconds', e, delay)
+                await asyncio.sleep(delay)
+            except SendError:
+                metrics.inc('viber_send_failures_total', reason='error')
+                raise
+
+    async def post(self, payload):
+        """
+        Post one message to the Viber API.
+
+        :param payload: message payload
+        :return: None
+        :raises RetryableSendError: if sending may succeed later
+        :raises SendError: if Viber API does not accept the message
+        """
+        try:
+            async with self.session.post(outbound.url,
+                                         json=payload) as response:
+                try:
+                    result = await response.json(content_type=None)
+                except ValueError:
+                    result = None
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RetryableSendError('Failed to send message: {}'.format(e))
+        check_response(status, result)
+
+
+sender = AsyncSender()
+
+
+async def send_message(user_id, text, media=None, wait=False,
+                       all_pages=False):
+    """
+    Send text message. The message is queued to the outbound queue, unless
+    the caller wants to wait until the message has been sent.
+
+    :param user_id: viber user id who will receive the message
+    :param text: text to send
+    :param media: URL to media file
+    :param wait: wait until the message has been sent
+    :param all_pages: send all the pages of the text instead of storing the
+                      rest for the "/more" command
+    :return: None
+    :raises Exception: if message sending fails and wait is True
+    """
+    if not config.getboolean('Viber', 'command_executor', fallback=False):
+        # External command executor daemon is not used.
+        # Publish the answer message.
+        await async_cache.publish(user_id, text, media=media)
+    await send_page(user_id, text, media=media, wait=wait,
+                    all_pages=all_pages)
+
+
+async def send_more(user_id):
+    """
+    Send the next page of the text that did not fit in the previous
+    message.
+
+    :param user_id: viber user id who will receive the message
+    :return: True, if there was text left to send
+    """
+    text = await async_cache.pop_more(user_id)
+    if not text:
+        return False
+    await send_page(user_id, text)
+    return True
+
+
+async def send_page(user_id, text, media=None, wait=False, all_pages=False):
+    """
+    Send the first page of the text. The rest of the text is stored in the
+    cache for the "/more" command.
+
+    :param user_id: viber user id who will receive the message
+    :param text: text to send
+    :param media: URL to media file
+    :param wait: wait until the message has been sent
+    :param all_pages: send all the pages of the text
+    :return: None
+    :raises Exception: if message sending fails and wait is True
+    """
+    messages, rest = create_text_message_list(text, all_pages=all_pages)
+    if rest:
+        await async_cache.set_more(user_id, rest, config.getint(
+            'Outbound', 'page_ttl', fallback=600))
+    if media is not None:
+        messages.append(URLMessage(media=media))
+    if wait or not config.getboolean('Outbound', 'queue', fallback=True):
+        await sender.send_messages(user_id, messages)
+    else:
+        await sender.send(user_id, messages)
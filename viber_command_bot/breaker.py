@@ -0,0 +1,224 @@
+"""
+Circuit breaker for Redis
+
+The webhook writes to Redis while the request is handled. If Redis is slow
+or down, the requests would wait for the socket timeouts one after another
+and Viber would start sending the callbacks again. After repeated failures
+the circuit breaker opens, and the Redis commands fail immediately until
+the reset timeout has passed. Then one command is let through to check if
+Redis has recovered.
+
+The Redis client of the cache runs its commands and pipelines through the
+circuit breaker; the asynchronous client is in viber_command_bot.asgi.
+Socket timeouts are raised as connection errors, so that the cache handles
+both in the same way. Waiting too long for a free connection of the local
+connection pool is not a Redis failure, and it does not open the breaker.
+The clients also record the latency of each command and pipeline sent to
+Redis to the metrics and to the current trace.
+"""
+
+import contextlib
+import logging
+import queue
+import threading
+import time
+import redis
+import redis.exceptions
+from viber_command_bot.metrics import metrics
+from viber_command_bot.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(redis.exceptions.ConnectionError):
+    """
+    Redis is not used, because the circuit breaker is open.
+    """
+    pass
+
+
+class PoolExhaustedError(redis.exceptions.ConnectionError):
+    """
+    All the connections of the connection pool are in use.
+    """
+    pass
+
+
+class BreakerConnectionPool(redis.BlockingConnectionPool):
+    """
+    Blocking connection pool that raises PoolExhaustedError when no
+    connection becomes free in time
+    """
+
+    def get_connection(self, *args, **kwargs):
+        try:
+            return super().get_connection(*args, **kwargs)
+        except redis.exceptions.ConnectionError as e:
+            if isinstance(e.__context__, queue.Empty):
+                raise PoolExhaustedError(
+                    'All the {} Redis connections are in use'.format(
+                        self.max_connections)) from e
+            raise
+
+
+class CircuitBreaker(object):
+    """
+    Class for the circuit breaker
+    """
+
+    def __init__(self, failures=5, reset_timeout=10.0):
+        self.failures = max(1, failures)
+        self.reset_timeout = reset_timeout
+        self.count = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def closed(self):
+        """
+        Redis is in use.
+        """
+        return self.opened is None
+
+    def allow(self):
+        """
+        Check if a Redis command may be sent. When the circuit is open, one
+        command is allowed after the reset timeout.
+
+        :return: True, if the command may be sent
+        """
+        if self.opened is None:
+            return True
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.probing or \
+                    time.monotonic() - self.opened < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        """
+        Redis command succeeded.
+
+        :return: None
+        """
+        if self.opened is None and not self.count:
+            return
+        with self.lock:
+            if self.opened is not None:
+                logger.info('Redis has recovered, circuit breaker closed')
+            self.count = 0
+            self.opened = None
+            self.probing = False
+
+    def release(self):
+        """
+        Redis command was not sent. A probe is allowed again.
+
+        :return: None
+        """
+        if self.probing:
+            with self.lock:
+                self.probing = False
+
+    def failure(self):
+        """
+        Redis command failed.
+
+        :return: None
+        """
+        with self.lock:
+            self.count += 1
+            if self.opened is not None:
+                # Probe failed, wait for another reset timeout.
+                self.opened = time.monotonic()
+                self.probing = False
+            elif self.count >= self.failures:
+                logger.error('Redis failed %s times, circuit breaker opened '
+                             'for %g seconds', self.count, self.reset_timeout)
+                self.opened = time.monotonic()
+
+    @contextlib.contextmanager
+    def call(self):
+        """
+        Context for sending a Redis command through the circuit breaker.
+
+        :return: context manager
+        :raises CircuitOpenError: if the circuit is open
+        :raises PoolExhaustedError: if no connection became free in time
+        :raises redis.exceptions.ConnectionError: if the command fails or
+                                                  times out
+        """
+        if not self.allow():
+            raise CircuitOpenError('Redis circuit breaker is open')
+        try:
+            yield
+        except PoolExhaustedError:
+            # Redis was not used.
+            self.release()
+            raise
+        except redis.exceptions.TimeoutError as e:
+            self.failure()
+            raise redis.exceptions.ConnectionError(
+                'Redis timed out: {}'.format(e)) from e
+        except redis.exceptions.ConnectionError:
+            self.failure()
+            raise
+        except redis.exceptions.RedisError:
+            # Redis answered with an error.
+            self.success()
+            raise
+        self.success()
+
+
+@contextlib.contextmanager
+def timed(operation):
+    """
+    Context for recording the latency of a Redis round trip.
+
+    :param operation: Redis command name, or "pipeline"
+    :return: context manager
+    """
+    operation = str(operation).lower()
+    with metrics.timer('viber_redis_latency_seconds', operation=operation), \
+            tracer.span('redis.{}'.format(operation)):
+        yield
+
+
+class BreakerPipeline(object):
+    """
+    Pipeline that is executed through the circuit breaker
+    """
+
+    def __init__(self, pipeline, breaker):
+        self.pipeline = pipeline
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def execute(self, *args, **kwargs):
+        with self.breaker.call(), timed('pipeline'):
+            return self.pipeline.execute(*args, **kwargs)
+
+
+class BreakerRedis(redis.StrictRedis):
+    """
+    Redis client that sends the commands through the circuit breaker
+    """
+
+    def __init__(self, *args, breaker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker or CircuitBreaker()
+
+    def execute_command(self, *args, **options):
+        with self.breaker.call(), timed(args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        return BreakerPipeline(super().pipeline(*args, **kwargs),
+                               self.breaker)
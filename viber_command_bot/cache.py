@@ -2,12 +2,87 @@
 Viber bot cache with Redis
 """
 
+import collections
+import contextlib
 import datetime
-import pickle
+import json
+import logging
+import os
 import redis
 import redis.exceptions
+import socket
+import threading
 import time
-from viber_command_bot.config import config
+from viber_command_bot.breaker import BreakerConnectionPool, BreakerRedis
+from viber_command_bot.breaker import CircuitBreaker
+from viber_command_bot.config import add_init_listener
+from viber_command_bot.serializers import MessageCodec, SerializerError
+from viber_command_bot.tracing import current_request_id
+
+
+logger = logging.getLogger(__name__)
+
+USERS = 'viber-users'
+NOTES = 'viber-notes'
+NOTE_TEXTS = 'viber-note-texts'
+NOTES_MIGRATED = 'viber-notes-migrated'
+
+TRANSPORTS = ['pubsub', 'streams']
+
+CACHE_NOT_AVAILABLE_TEXT = 'Notes are not available, because the cache ' \
+                           'is not available.'
+CONSUMER_GROUP = 'viber-command-executor'
+STREAM_MAXLEN = 10000
+
+# Get the Nth note from the note index in one round trip.
+SHOW_NOTE_SCRIPT = """
+local ids = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[1])
+if #ids == 0 then
+    return false
+end
+return redis.call('HGET', KEYS[2], ids[1])
+"""
+
+# Remove the Nth note from the note index in one round trip.
+REMOVE_NOTE_SCRIPT = """
+local ids = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[1])
+if #ids == 0 then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ids[1])
+return redis.call('HDEL', KEYS[2], ids[1])
+"""
+
+# Take a token from each token bucket, if every bucket has a token. ARGV has
+# the rate (tokens per second) and the burst of each bucket. Returns 0 if
+# the tokens were taken, otherwise the number of the first empty bucket.
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local available = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    available = math.min(burst, available + math.max(0, now - updated) * rate)
+    if available < 1 then
+        return i
+    end
+    tokens[i] = available
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'updated', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return 0
+"""
 
 
 class CacheError(Exception):
@@ -20,29 +95,229 @@ class Cache(object):
     """
 
     def __init__(self):
-        self.redis = redis.StrictRedis(
-            config.get('Viber', 'redis_host', fallback='localhost'))
+        self.client = None
+        self.blocking_client = None
+        self.replay_lock = threading.Lock()
+        self.pubsub = None
+        self.streams = dict()
+        self.consumer = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.claim_time = 0
+        self.claimed = list()
+        self.local = threading.local()
+        self.user_names = dict()
+        self.notes_migrated = False
+        self.show_note_script = None
+        self.remove_note_script = None
+        self.token_bucket_script = None
+
+    def configure(self, config):
+        """
+        Read the Redis settings from the bot configuration. Called before the
+        cache is used.
+
+        :param config: bot configuration
+        :return: None
+        :raises CacheError: if the Redis transport is not supported
+        """
+        self.host = config.get('Viber', 'redis_host', fallback='localhost')
+        self.port = config.getint('Viber', 'redis_port', fallback=6379)
+        self.socket_timeout = config.getfloat(
+            'Viber', 'redis_socket_timeout', fallback=1.0)
+        self.connect_timeout = config.getfloat(
+            'Viber', 'redis_connect_timeout', fallback=1.0)
+        self.max_connections = config.getint(
+            'Viber', 'redis_max_connections', fallback=10)
+        self.breaker = CircuitBreaker(
+            failures=config.getint('Viber', 'redis_breaker_failures',
+                                   fallback=5),
+            reset_timeout=config.getfloat('Viber', 'redis_breaker_reset',
+                                          fallback=10.0))
+        # Messages that could not be published, replayed when Redis has
+        # recovered.
+        self.replay = collections.deque(maxlen=config.getint(
+            'Viber', 'redis_replay_size', fallback=1000))
+        self.replay_age = config.getfloat('Viber', 'redis_replay_age',
+                                          fallback=60.0)
         self.channel = config.get('Viber', 'redis_channel', fallback=None)
         self.name = config.get('Viber', 'name')
-        self.pubsub = None
+        self.codec = MessageCodec(
+            config.get('Viber', 'redis_serializer', fallback='binary'),
+            accept_pickle=config.getboolean('Viber', 'redis_accept_pickle',
+                                            fallback=True))
+        self.transport = config.get('Viber', 'redis_transport',
+                                    fallback='pubsub')
+        if self.transport not in TRANSPORTS:
+            raise CacheError('Redis transport "{}" is not supported'.format(
+                self.transport))
+        self.host_groups = create_host_groups(config)
+        self.claim_idle = config.getint('Viber', 'redis_claim_idle',
+                                        fallback=60) * 1000
+        self.max_deliveries = config.getint('Viber', 'redis_max_deliveries',
+                                            fallback=3)
 
-    def listen(self):
+    @property
+    def redis(self):
+        """
+        Redis client. The client is created when it is used the first time,
+        so that importing the module has no side effects, and each uWSGI
+        worker process gets its own connection pool. The commands have short
+        socket timeouts and they are sent through the circuit breaker.
+
+        :return: StrictRedis object
+        """
+        if self.client is None:
+            pool = BreakerConnectionPool(
+                host=self.host, port=self.port,
+                socket_timeout=self.socket_timeout,
+                socket_connect_timeout=self.connect_timeout,
+                max_connections=self.max_connections,
+                timeout=self.socket_timeout)
+            client = BreakerRedis(connection_pool=pool, breaker=self.breaker)
+            self.show_note_script = client.register_script(SHOW_NOTE_SCRIPT)
+            self.remove_note_script = client.register_script(
+                REMOVE_NOTE_SCRIPT)
+            self.token_bucket_script = client.register_script(
+                TOKEN_BUCKET_SCRIPT)
+            self.client = client
+        return self.client
+
+    @property
+    def blocking(self):
+        """
+        Redis client for the blocking reads of the command executor and the
+        gathered outputs. The reads wait longer than the socket timeout of
+        the Redis client, so this client has no socket timeout.
+
+        :return: StrictRedis object
+        """
+        if self.blocking_client is None:
+            self.blocking_client = redis.StrictRedis(
+                self.host, self.port,
+                socket_connect_timeout=self.connect_timeout)
+        return self.blocking_client
+
+    def listen(self, commands=False):
         """
         The client that wants to get messages through the cache needs to
         start listening the Redis pubsub channel.
 
+        With the streams transport, the command executor reads the execute
+        messages from Redis streams instead: the common command stream and
+        the command stream of this host. The executors share the work through
+        a consumer group, and the messages must be acknowledged with ack()
+        when they have been handled.
+
+        With the pubsub transport, the command executor listens also to the
+        channel of this host.
+
+        :param commands: listen to the execute messages
         :return: None
         :raises CacheError: if Redis channel is not configured
         """
         if not self.channel:
             raise CacheError('Redis channel is not configured')
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        channels = [self.channel]
+        if commands and self.transport == 'pubsub':
+            host = socket.gethostname()
+            channels.append(self.host_channel(host))
+        elif commands and self.transport == 'streams':
+            self.streams = dict((self.command_stream(host), '>') for host in [
+                None, socket.gethostname()])
+            for stream in self.streams:
+                try:
+                    self.redis.xgroup_create(stream, CONSUMER_GROUP, id='0',
+                                             mkstream=True)
+                except redis.exceptions.ResponseError as e:
+                    if 'BUSYGROUP' not in str(e):
+                        raise CacheError('Could not create consumer group for '
+                                         'Redis stream "{}": {}'.format(
+                                             stream, e))
+                except redis.exceptions.ConnectionError as e:
+                    raise CacheError('Could not read Redis stream "{}": '
+                                     '{}'.format(stream, e))
+            return
+        self.pubsub = self.blocking.pubsub(ignore_subscribe_messages=True)
         try:
-            self.pubsub.subscribe(self.channel)
+            self.pubsub.subscribe(*channels)
         except redis.exceptions.ConnectionError as e:
             raise CacheError('Could not subscribe to Redis channel "{}": '
                              '{}'.format(self.channel, e))
 
+    def host_channel(self, host):
+        """
+        Get the name of the pubsub channel for the commands sent to a host.
+
+        :param host: host name
+        :return: Redis channel name
+        """
+        return '{}:host:{}'.format(self.channel, host)
+
+    def expand_destination(self, destination):
+        """
+        Expand the host groups in the destination.
+
+        :param destination: list of host names and host group names
+        :return: list of host names
+        """
+        hosts = list()
+        for name in destination:
+            for host in self.host_groups.get(name, [name]):
+                if host not in hosts:
+                    hosts.append(host)
+        return hosts
+
+    def command_stream(self, host=None):
+        """
+        Get the name of the command stream.
+
+        :param host: host name, or None for the common command stream
+        :return: Redis stream name
+        """
+        if host is None:
+            return '{}:commands'.format(self.channel)
+        return '{}:commands:{}'.format(self.channel, host)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context for batching the cache writes. The user registry updates and
+        the published messages of the current thread are buffered and sent to
+        Redis in one pipeline when the context exits.
+
+        :return: context manager
+        """
+        if getattr(self.local, 'pipeline', None) is not None or \
+                self.redis is None:
+            # Already batching in this thread.
+            yield
+            return
+        self.local.pipeline = self.redis.pipeline(transaction=False)
+        self.local.published = list()
+        try:
+            yield
+        finally:
+            pipeline, self.local.pipeline = self.local.pipeline, None
+            try:
+                pipeline.execute()
+            except redis.exceptions.ConnectionError:
+                # User registry updates may have been lost.
+                self.user_names.clear()
+                for message, routes in self.local.published:
+                    self.buffer(message, routes)
+            self.local.published = None
+
+    def writer(self):
+        """
+        Get Redis client for writes: the batch pipeline, if the current
+        thread is batching, otherwise the Redis client.
+
+        :return: Redis client or pipeline
+        """
+        pipeline = getattr(self.local, 'pipeline', None)
+        if pipeline is not None:
+            return pipeline
+        return self.redis
+
     def subscribe_user(self, user_id, name):
         """
         User is subscribed to the cache.
@@ -53,7 +328,7 @@ class Cache(object):
         """
         if self.redis is None or self.channel is None:
             return
-        self.redis.set('viber-user-id:{}'.format(user_id), name)
+        self.set_user(user_id, name)
         self.publish(user_id, 'Subscribe "{}": {}'.format(name, user_id),
                      name=name)
 
@@ -67,13 +342,14 @@ class Cache(object):
         """
         if self.redis is None or self.channel is None:
             return
-        self.redis.set('viber-user-id:{}'.format(user_id), name)
+        self.set_user(user_id, name)
         self.publish(user_id, 'Conversation started: {}'.format(user_id),
                      name=name)
 
     def refresh_user(self, user_id, name):
         """
-        User is refreshed in the cache.
+        User is refreshed in the cache. Nothing is written, if the user name
+        is already known to be up to date.
 
         :param user_id: Viber bot unique user id
         :param name: user name
@@ -81,7 +357,23 @@ class Cache(object):
         """
         if self.redis is None or self.channel is None:
             return
-        self.redis.set('viber-user-id:{}'.format(user_id), name)
+        if self.user_names.get(user_id) == name:
+            return
+        self.set_user(user_id, name)
+
+    def set_user(self, user_id, name):
+        """
+        Store user in the user registry hash.
+
+        :param user_id: Viber bot unique user id
+        :param name: user name
+        :return: None
+        """
+        try:
+            self.writer().hset(USERS, user_id, name)
+        except redis.exceptions.ConnectionError:
+            return
+        self.user_names[user_id] = name
 
     def unsubscribe_user(self, user_id):
         """
@@ -92,13 +384,23 @@ class Cache(object):
         """
         if self.redis is None or self.channel is None:
             return
-        name = self.redis.get('viber-user-id:{}'.format(user_id)).decode()
-        self.redis.delete('viber-user-id:{}'.format(user_id))
+        self.user_names.pop(user_id, None)
+        try:
+            name = self.redis.hget(USERS, user_id)
+            if name is None:
+                # User may still be stored in the old registry key.
+                name = self.redis.get('viber-user-id:{}'.format(user_id))
+            writer = self.writer()
+            writer.hdel(USERS, user_id)
+            writer.delete('viber-user-id:{}'.format(user_id))
+        except redis.exceptions.ConnectionError:
+            name = None
+        name = name.decode() if name is not None else user_id
         self.publish(user_id, 'Un-subscribe "{}": {}'.format(name, user_id),
                      name=name)
 
     def publish(self, user_id, text, media=None, destination=None, name=None,
-                message_type='text', output_format='text'):
+                message_type='text', output_format='text', command=None):
         """
         Message is published to the cache.
 
@@ -109,67 +411,597 @@ class Cache(object):
         :param name: name of the user who sends the message
         :param message_type: text | execute
         :param output_format: text | json | none
+        :param command: configured command name for execute messages
         :return: None
         """
         if self.redis is None or self.channel is None:
             return
+        message, routes = self.create_message(
+            user_id, text, media=media, destination=destination, name=name,
+            message_type=message_type, output_format=output_format,
+            command=command)
+        if self.replay:
+            self.replay_messages()
+        writer = self.writer()
+        try:
+            self.write_message(writer, message, routes)
+        except redis.exceptions.ConnectionError:
+            self.buffer(message, routes)
+            return
+        if writer is not self.redis:
+            # Replayed, if the batch fails.
+            self.local.published.append((message, routes))
+
+    @staticmethod
+    def write_message(writer, message, routes):
+        """
+        Write encoded message to the routes.
+
+        :param writer: Redis client or pipeline
+        :param message: encoded message
+        :param routes: list of (is stream, Redis key)
+        :return: None
+        """
+        for stream, key in routes:
+            if stream:
+                writer.xadd(key, {'message': message}, maxlen=STREAM_MAXLEN,
+                            approximate=True)
+            else:
+                writer.publish(key, message)
+
+    def buffer(self, message, routes):
+        """
+        Keep the message that could not be published, so that it can be
+        published when Redis has recovered. The oldest messages are dropped,
+        if the buffer is full.
+
+        :param message: encoded message
+        :param routes: list of (is stream, Redis key)
+        :return: None
+        """
+        self.replay.append((time.monotonic(), message, routes))
+
+    def replay_messages(self):
+        """
+        Publish the buffered messages, if Redis is in use again. Messages
+        older than the replay age are dropped.
+
+        :return: None
+        """
+        if not self.breaker.closed:
+            return
+        # The lock is held until the messages are published or put back, so
+        # that only one thread replays. Messages buffered meanwhile are
+        # appended after the replayed ones, which are put back before them.
+        if not self.replay_lock.acquire(blocking=False):
+            return
+        try:
+            items = list(self.replay)
+            self.replay.clear()
+            now = time.monotonic()
+            items = [item for item in items
+                     if now - item[0] <= self.replay_age]
+            if not items:
+                return
+            pipeline = self.redis.pipeline(transaction=False)
+            for _, message, routes in items:
+                self.write_message(pipeline, message, routes)
+            try:
+                pipeline.execute()
+            except redis.exceptions.ConnectionError:
+                self.replay.extendleft(reversed(items))
+                return
+        finally:
+            self.replay_lock.release()
+        logger.info('Published %s messages buffered while Redis was not '
+                    'available', len(items))
+
+    def create_message(self, user_id, text, media=None, destination=None,
+                       name=None, message_type='text', output_format='text',
+                       command=None):
+        """
+        Create encoded message and the routes where it is published. See
+        publish() for the parameters.
+
+        :return: tuple (encoded message, list of (is stream, Redis key))
+        """
         if destination is None:
             destination = list()
+        destination = self.expand_destination(destination)
         if name is None:
             name = self.name
-        message = pickle.dumps({'user_id': user_id, 'text': text,
-                                'media': media, 'name': name,
-                                'message_type': message_type,
-                                'destination': destination,
-                                'output_format': output_format,
-                                'date': datetime.datetime.now()})
-        try:
-            self.redis.publish(self.channel, message)
-        except redis.exceptions.ConnectionError:
-            pass
+        message = self.codec.dumps({'user_id': user_id, 'text': text,
+                                    'media': media, 'name': name,
+                                    'message_type': message_type,
+                                    'destination': destination,
+                                    'output_format': output_format,
+                                    'command': command,
+                                    'date': datetime.datetime.now(),
+                                    'request_id': current_request_id()})
+        if message_type == 'execute' and self.transport == 'streams':
+            # Command is added to the command stream of each destination
+            # host, or to the common stream if there is no destination.
+            routes = [(True, self.command_stream(host))
+                      for host in destination or [None]]
+        elif message_type == 'execute' and destination:
+            # Command is published once to each addressed host, also when
+            # the host is in several addressed host groups.
+            routes = [(False, self.host_channel(host))
+                      for host in destination]
+        else:
+            routes = [(False, self.channel)]
+        return message, routes
 
     def get_message(self):
         """
-        Get the next message from the cache.
+        Get the next message from the cache. Messages that can not be
+        decoded are logged and skipped.
 
-        :return: message dict
+        :return: message dict, empty if there is no message
+        :raises CacheError: if Redis fails
         """
         if self.redis is None or self.channel is None:
             return dict()
+        if self.streams:
+            return self.get_stream_message()
         try:
             message = self.pubsub.get_message(timeout=10)
         except Exception as e:
             raise CacheError('Could not get message from cache: {}'.format(e))
-        if message:
-            return pickle.loads(message.get('data', dict()))
-        return dict()
+        if not message:
+            return dict()
+        try:
+            return self.decode(message.get('data', b''))
+        except CacheError as e:
+            logger.error('Dropped message: %s', e)
+            return dict()
+
+    def get_stream_message(self):
+        """
+        Get the next message from the command streams. Messages left pending
+        by crashed executors are claimed first. Messages that can not be
+        decoded are logged, acknowledged and skipped.
+
+        :return: message dict, empty if there is no message
+        :raises CacheError: if Redis fails
+        """
+        try:
+            now = time.monotonic()
+            if not self.claimed and \
+                    now - self.claim_time > self.claim_idle / 1000:
+                self.claim_time = now
+                self.claim_pending()
+            if self.claimed:
+                stream, entries = self.claimed.pop(0)
+            else:
+                response = self.blocking.xreadgroup(
+                    CONSUMER_GROUP, self.consumer, self.streams, count=1,
+                    block=10000)
+                if not response:
+                    return dict()
+                stream, entries = response[0]
+        except Exception as e:
+            raise CacheError('Could not get message from cache: {}'.format(e))
+        if isinstance(stream, bytes):
+            stream = stream.decode()
+        entry_id, fields = entries[0]
+        try:
+            message = self.decode(fields.get(b'message', b''))
+        except CacheError as e:
+            # Message can never be handled.
+            logger.error('Dropped message %s of stream "%s": %s',
+                         entry_id, stream, e)
+            self.ack({'stream': stream, 'stream_id': entry_id})
+            return dict()
+        message['stream'] = stream
+        message['stream_id'] = entry_id
+        return message
+
+    def claim_pending(self):
+        """
+        Claim the messages that have been pending too long in other
+        consumers. Messages that have been delivered too many times are
+        acknowledged and dropped.
+
+        :return: None
+        """
+        for stream in self.streams:
+            pending = self.redis.xpending_range(stream, CONSUMER_GROUP, '-',
+                                                '+', 100)
+            for entry in pending:
+                if entry['time_since_delivered'] < self.claim_idle:
+                    continue
+                if entry['times_delivered'] >= self.max_deliveries:
+                    self.redis.xack(stream, CONSUMER_GROUP,
+                                    entry['message_id'])
+                    continue
+                entries = self.redis.xclaim(stream, CONSUMER_GROUP,
+                                            self.consumer, self.claim_idle,
+                                            [entry['message_id']])
+                for claimed in entries:
+                    if claimed[1]:
+                        self.claimed.append((stream, [claimed]))
+
+    def ack(self, message):
+        """
+        Acknowledge that the message has been handled.
+
+        :param message: message dict returned by get_message()
+        :return: None
+        """
+        if self.redis is None or not message.get('stream_id'):
+            return
+        try:
+            self.redis.xack(message['stream'], CONSUMER_GROUP,
+                            message['stream_id'])
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def decode(self, data):
+        """
+        Decode message received from the cache.
+
+        :param data: encoded message
+        :return: message dict
+        :raises CacheError: if the message can not be decoded
+        """
+        try:
+            return self.codec.loads(data)
+        except SerializerError as e:
+            raise CacheError('Could not decode message from cache: '
+                             '{}'.format(e))
+
+    def get_output(self, key):
+        """
+        Get cached command output.
+
+        :param key: cache key of the command
+        :return: output text, or None if the output is not in the cache
+        """
+        if self.redis is None or self.channel is None:
+            return None
+        try:
+            output = self.redis.get('viber-output:{}'.format(key))
+        except redis.exceptions.ConnectionError:
+            return None
+        if output is None:
+            return None
+        return output.decode()
+
+    def set_output(self, key, output, ttl):
+        """
+        Add command output to cache.
+
+        :param key: cache key of the command
+        :param output: output text
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        if self.redis is None or self.channel is None:
+            return
+        try:
+            self.redis.setex('viber-output:{}'.format(key), int(ttl) or 1,
+                             output)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def set_more(self, user_id, text, ttl):
+        """
+        Store the text that did not fit in the message sent to the user.
+
+        :param user_id: Viber bot unique user id
+        :param text: rest of the text
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        if self.redis is None or self.channel is None:
+            return
+        try:
+            self.writer().setex('viber-more:{}'.format(user_id),
+                                int(ttl) or 1, text)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def pop_more(self, user_id):
+        """
+        Get and remove the text stored with set_more().
+
+        :param user_id: Viber bot unique user id
+        :return: text, or None if there is no text left
+        """
+        if self.redis is None or self.channel is None:
+            return None
+        key = 'viber-more:{}'.format(user_id)
+        pipeline = self.redis.pipeline()
+        pipeline.get(key)
+        pipeline.delete(key)
+        try:
+            text, _ = pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            return None
+        if text is None:
+            return None
+        return text.decode()
+
+    def swap_last_output(self, user_id, command, output, ttl, host=None):
+        """
+        Store the output of the command sent to the user, and get the
+        previous output. Outputs are stored per host.
+
+        :param user_id: Viber bot unique user id
+        :param command: configured command name
+        :param output: output text
+        :param ttl: time to live in seconds
+        :param host: host of the output, default is this host
+        :return: previous output text, or None if there is no previous
+                 output
+        """
+        if self.redis is None or self.channel is None:
+            return None
+        key = 'viber-last-output:{}:{}'.format(user_id, command)
+        if host is None:
+            host = socket.gethostname()
+        pipeline = self.redis.pipeline()
+        pipeline.hget(key, host)
+        pipeline.hset(key, host, output)
+        pipeline.expire(key, int(ttl) or 1)
+        try:
+            previous, _, _ = pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            return None
+        if previous is None:
+            return None
+        return previous.decode()
+
+    def clear_last_output(self, user_id, command):
+        """
+        Forget the outputs of the command sent to the user, so that the next
+        answer has the full output.
+
+        :param user_id: Viber bot unique user id
+        :param command: configured command name
+        :return: None
+        """
+        if self.redis is None or self.channel is None:
+            return
+        try:
+            self.writer().delete('viber-last-output:{}:{}'.format(user_id,
+                                                                  command))
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def lock_refresh(self, command, interval):
+        """
+        Take the turn to refresh the output of the command in this host.
+        Only one process in each host gets the turn in each refresh
+        interval.
+
+        :param command: configured command name
+        :param interval: refresh interval in seconds
+        :return: True, if this process should refresh the output
+        """
+        if self.redis is None or self.channel is None:
+            return False
+        try:
+            return bool(self.redis.set(
+                'viber-refresh-lock:{}:{}'.format(command,
+                                                  socket.gethostname()),
+                self.consumer, nx=True, px=max(1, int(interval * 1000))))
+        except redis.exceptions.ConnectionError:
+            return False
+
+    def set_refreshed(self, command, output, date, ttl):
+        """
+        Store the output of the command refreshed ahead in this host. The
+        outputs of all the hosts are stored in one hash.
+
+        :param command: configured command name
+        :param output: output text
+        :param date: time of the refresh, seconds since the epoch
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        if self.redis is None or self.channel is None:
+            return
+        key = 'viber-refreshed:{}'.format(command)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(key, socket.gethostname(), json.dumps(
+            {'output': output, 'date': date, 'expires': date + ttl}))
+        pipeline.expire(key, int(ttl) or 1)
+        try:
+            pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def get_refreshed(self, command):
+        """
+        Get the outputs of the command refreshed ahead.
+
+        :param command: configured command name
+        :return: dict {host: (output text, time of the refresh)} of the
+                 hosts that have a valid output
+        """
+        if self.redis is None or self.channel is None:
+            return dict()
+        try:
+            values = self.redis.hgetall('viber-refreshed:{}'.format(command))
+        except redis.exceptions.ConnectionError:
+            return dict()
+        return decode_refreshed(values)
+
+    def swap_alert(self, command, firing):
+        """
+        Store the alert state of the command in this host, and get the
+        previous state.
+
+        :param command: configured command name
+        :param firing: alert fires now
+        :return: True, if the alert was firing
+        """
+        if self.redis is None or self.channel is None:
+            return False
+        key = 'viber-alert:{}:{}'.format(command, socket.gethostname())
+        try:
+            if firing:
+                return self.redis.getset(key, 1) is not None
+            pipeline = self.redis.pipeline()
+            pipeline.get(key)
+            pipeline.delete(key)
+            return pipeline.execute()[0] is not None
+        except redis.exceptions.ConnectionError:
+            return firing
+
+    def add_gathered(self, request_id, host, output, ttl):
+        """
+        Write the output of a multi-host command for the bot that gathers
+        the outputs.
+
+        :param request_id: request id of the command
+        :param host: host name
+        :param output: output text
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        if self.redis is None or self.channel is None:
+            return
+        key = 'viber-gather:{}'.format(request_id)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(key, host, output)
+        pipeline.expire(key, int(ttl) or 1)
+        pipeline.rpush('{}:done'.format(key), host)
+        pipeline.expire('{}:done'.format(key), int(ttl) or 1)
+        try:
+            pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def gather(self, request_id, hosts, timeout):
+        """
+        Wait for the outputs of a multi-host command until all the hosts have
+        answered or the timeout expires.
+
+        :param request_id: request id of the command
+        :param hosts: list of destination hosts
+        :param timeout: timeout in seconds
+        :return: dict {host: output text} of the hosts that answered
+        """
+        if self.redis is None or self.channel is None:
+            return dict()
+        key = 'viber-gather:{}'.format(request_id)
+        waiting = set(hosts)
+        deadline = time.monotonic() + timeout
+        try:
+            while waiting:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                item = self.blocking.blpop(['{}:done'.format(key)],
+                                           timeout=max(0.01, remaining))
+                if item is not None:
+                    waiting.discard(item[1].decode())
+            outputs = self.blocking.hgetall(key)
+            self.blocking.delete(key, '{}:done'.format(key))
+        except redis.exceptions.ConnectionError:
+            return dict()
+        return dict((host.decode(), output.decode())
+                    for host, output in outputs.items())
+
+    def first_token(self, token, ttl):
+        """
+        Mark the message token of a callback handled in any process.
+
+        :param token: message token
+        :param ttl: time to live in seconds
+        :return: True, if the token was not marked before; also True, if
+                 Redis is not available
+        """
+        if self.redis is None or self.channel is None:
+            return True
+        try:
+            return bool(self.redis.set('viber-token:{}'.format(token), 1,
+                                       nx=True, ex=int(ttl) or 1))
+        except redis.exceptions.ConnectionError:
+            return True
+
+    def forget_token(self, token):
+        """
+        Remove the mark of the message token, so that the callback is handled
+        when it is sent again.
+
+        :param token: message token
+        :return: None
+        """
+        if self.redis is None or self.channel is None:
+            return
+        try:
+            self.redis.delete('viber-token:{}'.format(token))
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def take_tokens(self, buckets):
+        """
+        Take a token from each token bucket, if every bucket has a token.
+        The buckets are shared by all the processes in all the hosts.
+
+        :param buckets: list of tuples (bucket name, tokens per second,
+                        burst)
+        :return: 0 if the tokens were taken, otherwise the number of the
+                 first empty bucket (1 is the first); None if Redis is not
+                 available
+        """
+        if self.redis is None or self.channel is None:
+            return None
+        args = list()
+        for _, rate, burst in buckets:
+            args.extend([rate, burst])
+        try:
+            return int(self.token_bucket_script(
+                keys=['viber-rate:{}'.format(name) for name, _, _ in buckets],
+                args=args))
+        except redis.exceptions.ConnectionError:
+            return None
 
     def add_note(self, text):
         """
         Add note to cache.
 
+        Notes are stored in a sorted set, ordered by the creation time, and
+        the note texts in a hash.
+
         :param text: text to be copied
-        :return: None
+        :return: True, or None if Redis is not available
         """
         if self.redis is None or self.channel is None:
-            return
-        name = int(time.time() * 1000000)
-        self.redis.set('viber-note:{}'.format(name), text)
+            return None
+        try:
+            self.migrate_notes()
+            note_id = int(time.time() * 1000000)
+            pipeline = self.redis.pipeline()
+            pipeline.zadd(NOTES, {note_id: note_id})
+            pipeline.hset(NOTE_TEXTS, note_id, text)
+            pipeline.execute()
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to add note: %s', e)
+            return None
+        return True
 
     def show_note(self, number=-1):
         """
         Show note from cache.
 
         :param number: note number, 0 is first, 1 is second and so on
-        :return: text found in the cache, or empty string
+        :return: text found in the cache, or empty string; None if Redis is
+                 not available
         """
         if self.redis is None or self.channel is None:
-            return ''
-        notes = sorted(self.redis.scan_iter('viber-note:*'))
+            return None
         try:
-            text = self.redis.get(notes[number])
-        except IndexError:
-            return ''
+            self.migrate_notes()
+            text = self.show_note_script(keys=[NOTES, NOTE_TEXTS],
+                                         args=[number])
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to show note: %s', e)
+            return None
         if text:
             return text.decode()
         return ''
@@ -178,41 +1010,131 @@ class Cache(object):
         """
         Show all notes from cache.
 
-        :return: dict with texts found in the cache, or empty dict
+        :return: dict with texts found in the cache, or empty dict; None if
+                 Redis is not available
         """
         if self.redis is None or self.channel is None:
-            return dict()
-        texts = dict()
-        for i, key in enumerate(sorted(self.redis.scan_iter(
-                'viber-note:*')), start=1):
-            texts[i] = self.redis.get(key).decode()
-        return texts
+            return None
+        try:
+            self.migrate_notes()
+            pipeline = self.redis.pipeline()
+            pipeline.zrange(NOTES, 0, -1)
+            pipeline.hgetall(NOTE_TEXTS)
+            note_ids, note_texts = pipeline.execute()
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to show notes: %s', e)
+            return None
+        return note_dict(note_ids, note_texts)
 
     def remove_note(self, number=-1):
         """
         Remove note from cache.
 
         :param number: note number, 0 is first, 1 is second and so on
-        :return: None
+        :return: True, or None if Redis is not available
         """
         if self.redis is None or self.channel is None:
-            return
-        notes = sorted(self.redis.scan_iter('viber-note:*'))
+            return None
         try:
-            self.redis.delete(notes[number])
-        except IndexError:
-            pass
+            self.migrate_notes()
+            self.remove_note_script(keys=[NOTES, NOTE_TEXTS], args=[number])
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to remove note: %s', e)
+            return None
+        return True
 
     def remove_all_notes(self):
         """
         Clear all texts from cache.
 
-        :return: None
+        :return: True, or None if Redis is not available
         """
         if self.redis is None or self.channel is None:
+            return None
+        try:
+            self.migrate_notes()
+            self.redis.delete(NOTES, NOTE_TEXTS)
+        except redis.exceptions.ConnectionError as e:
+            logger.warning('Failed to remove notes: %s', e)
+            return None
+        return True
+
+    def migrate_notes(self):
+        """
+        Move notes stored in the old "viber-note:<timestamp>" keys to the note
+        index. The migration is done only once; it is marked done in Redis.
+
+        :return: None
+        """
+        if self.notes_migrated:
             return
-        for key in self.redis.scan_iter('viber-note:*'):
-            self.redis.delete(key)
+        if self.redis.get(NOTES_MIGRATED) is None:
+            for key in self.redis.scan_iter('viber-note:*'):
+                try:
+                    note_id = int(key.decode()[len('viber-note:'):])
+                except ValueError:
+                    continue
+                text = self.redis.get(key)
+                pipeline = self.redis.pipeline()
+                if text is not None:
+                    pipeline.zadd(NOTES, {note_id: note_id})
+                    pipeline.hset(NOTE_TEXTS, note_id, text)
+                pipeline.delete(key)
+                pipeline.execute()
+            self.redis.set(NOTES_MIGRATED, 1)
+        self.notes_migrated = True
+
+
+def note_dict(note_ids, note_texts):
+    """
+    Number the notes read from the note index and the note texts.
+
+    :param note_ids: note ids in the creation order
+    :param note_texts: dict {note id: text}
+    :return: dict {note number: text}, 1 is the first note
+    """
+    texts = dict()
+    for i, note_id in enumerate(note_ids, start=1):
+        text = note_texts.get(note_id)
+        if text is not None:
+            texts[i] = text.decode()
+    return texts
+
+
+def decode_refreshed(values):
+    """
+    Decode the outputs stored with Cache.set_refreshed(). Outputs that have
+    not been refreshed in time are left out.
+
+    :param values: stored hash {host: value}
+    :return: dict {host: (output text, time of the refresh)}
+    """
+    now = time.time()
+    outputs = dict()
+    for host, value in values.items():
+        try:
+            value = json.loads(value)
+            if value['expires'] > now:
+                outputs[host.decode()] = value['output'], value['date']
+        except (ValueError, KeyError, TypeError):
+            continue
+    return outputs
+
+
+def create_host_groups(config):
+    """
+    Create host groups dict from the bot configuration.
+
+    :param config: bot configuration
+    :return: dict of host group name and list of host names
+    """
+    host_groups = dict()
+    if 'Host groups' not in config:
+        return host_groups
+    for group, hosts in config['Host groups'].items():
+        host_groups[group] = [h.strip() for h in hosts.split(',') if h.strip()]
+    return host_groups
 
 
 cache = Cache()
+add_init_listener(cache.configure)
@@ -0,0 +1,651 @@
+"""
+Viber bot command configuration
+
+The configured commands and the help text are shared by the Flask and the
+ASGI applications and the command executor daemon. The command options are
+validated and the help text is created once, when the configuration is
+loaded. When the configuration is reloaded, a new command set replaces the
+old one. Commands that are already running keep the options they were
+started with.
+"""
+
+import logging
+import operator
+import re
+from viber_command_bot.config import add_init_listener, config_watcher
+from viber_command_bot.messages import MAX_TEXT_SIZE
+from viber_command_bot.output_cache import CACHE_SCOPES
+
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ['text', 'json', 'none']
+OUTPUT_MODES = ['full', 'diff']
+
+# Output beyond what can be sent is not read. One extra byte is read, so
+# that the message is marked truncated.
+MAX_OUTPUT_SIZE = MAX_TEXT_SIZE + 1
+DEFAULT_TIMEOUT = 60
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Alert rule: regular expression, optionally followed by a comparison of the
+# first group of the match, e.g. "(\d+)% /$ > 90".
+ALERT_RULE = re.compile(r'^(?P<pattern>.*?)(\s+(?P<op>[<>]=?)\s+'
+                        r'(?P<threshold>-?\d+(\.\d+)?))?$')
+ALERT_OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt,
+                   '<=': operator.le}
+
+INTERNAL_COMMANDS_HELP = {
+    'echo': 'Echo the text sent to the bot (internal command).',
+    'version': 'Show information about the bot (internal command).',
+    'queue': 'Show command pool status (internal command).',
+    'note': 'Create note or show the last note (internal command).',
+    'notes': 'Show all notes (internal command).',
+    'noteN': 'Show the Nth note (internal command).',
+    'removenote': 'Remove the last note (internal command).',
+    'removenoteN': 'Remove the Nth note (internal command).',
+    'removenotes': 'Remove all notes (internal command).',
+    'more': 'Show the next page of the previous answer (internal command).',
+    'profileN': 'Profile the next N requests, admin only (internal '
+                'command).',
+}
+
+# Internal command handlers. The Flask and the ASGI applications both
+# implement the handlers with these names; the Flask handlers are functions
+# and the ASGI handlers are coroutines. Every handler is called as
+# handler(viber_request, argument, destination), where viber_request is the
+# request from Viber service and destination is the list of destination
+# hosts. The argument depends on how the command was routed:
+#
+#   show_help       send the list of the commands; argument is not used
+#   show_version    send the bot version; argument is not used
+#   show_queue      send the status of the command pool; argument is not
+#                   used
+#   echo            send the text back to the user; argument is the text,
+#                   or None
+#   add_note        add the text to the notes; argument is the note text
+#   show_note       send a note; argument is the note number, 1 is the
+#                   first, or None for the last note
+#   show_all_notes  send all the notes; argument is not used
+#   remove_note     remove a note; argument as in show_note
+#   remove_all_notes
+#                   remove all the notes; argument is not used
+#   show_more       send the next page of the previous answer; argument is
+#                   not used
+#   profile         profile the next requests of the worker process, only
+#                   the notify user may profile; argument is the number of
+#                   requests, or None for the configured number
+#
+#   execute_configured_command
+#                   execute a configured command; argument is the dict with
+#                   the command options
+#   unsupported_command
+#                   tell the user that the command is not supported;
+#                   argument is the command text
+#
+# The handlers raise an exception, if message sending fails.
+#
+# Table entries: (command name, handler name, handler accepts "/name
+# argument", handler accepts "/nameN").
+INTERNAL_COMMANDS = (
+    ('', 'show_help', False, False),
+    ('help', 'show_help', False, False),
+    ('version', 'show_version', False, False),
+    ('queue', 'show_queue', False, False),
+    ('echo', 'echo', False, False),
+    ('echo', 'echo', True, False),
+    ('note', 'show_note', False, False),
+    ('note', 'add_note', True, False),
+    ('note', 'show_note', False, True),
+    ('notes', 'show_all_notes', False, False),
+    ('removenote', 'remove_note', False, False),
+    ('removenote', 'remove_note', False, True),
+    ('removenotes', 'remove_all_notes', False, False),
+    ('more', 'show_more', False, False),
+    ('profile', 'profile', False, False),
+    ('profile', 'profile', False, True),
+)
+
+BUSY_TEXT = 'Bot is busy, try again later.'
+NO_MORE_TEXT = 'No more output.'
+
+
+def split_destination(command):
+    """
+    Split the destination hosts from the command.
+
+    :param command: command found in request, e.g. "uptime@host1,host2"
+    :return: tuple (command, list of destination hosts)
+    """
+    destination = list()
+    if '@' in command:
+        # Destination is a comma separated list of hosts. Clean up the list.
+        command, destination_str = command.split('@', 1)
+        command = command.strip()
+        for d in destination_str.strip().split(','):
+            destination.append(d.strip())
+    return command, destination
+
+
+class CommandRouter(object):
+    """
+    Class for routing the received commands to the command handlers
+
+    Commands are looked up by name from a dict. Internal commands that take
+    an argument (e.g. "/echo text") and numbered internal commands (e.g.
+    "/note2") are registered separately, and configured commands are looked
+    up from the command set.
+    """
+
+    def __init__(self):
+        self.handlers = dict()
+        self.argument_handlers = dict()
+        self.numbered_handlers = dict()
+        self.numbered = None
+        self.configured_handler = None
+        self.unsupported_handler = None
+
+    def add(self, name, handler, argument=False, numbered=False):
+        """
+        Register handler for an internal command.
+
+        :param name: command name
+        :param handler: callable(viber_request, argument, destination)
+        :param argument: handler also accepts "/name argument"
+        :param numbered: handler accepts "/nameN", where N is an integer
+        :return: None
+        """
+        if numbered:
+            self.numbered_handlers[name] = handler
+            self.numbered = re.compile(r'^({})(\d+)$'.format('|'.join(
+                re.escape(n) for n in self.numbered_handlers)))
+        elif argument:
+            self.argument_handlers[name] = handler
+        else:
+            self.handlers[name] = handler
+
+    def add_handlers(self, handlers):
+        """
+        Register the internal commands of INTERNAL_COMMANDS and the handlers
+        for the configured and the unsupported commands.
+
+        :param handlers: dict of the handlers by name, e.g. globals() of the
+                         application module
+        :return: None
+        """
+        for name, handler, argument, numbered in INTERNAL_COMMANDS:
+            self.add(name, handlers[handler], argument=argument,
+                     numbered=numbered)
+        self.configured_handler = handlers['execute_configured_command']
+        self.unsupported_handler = handlers['unsupported_command']
+
+    def route(self, command, commands=None):
+        """
+        Find handler for the command.
+
+        :param command: command found in request, without destination
+        :param commands: CommandSet for the configured commands, default is
+                         the current command set
+        :return: tuple (handler, argument); argument of the configured
+                 command handler is the dict with the command options
+        """
+        if commands is None:
+            commands = command_set
+        handler = self.handlers.get(command)
+        if handler is not None:
+            return handler, None
+        name, _, argument = command.partition(' ')
+        handler = self.argument_handlers.get(name)
+        if handler is not None and argument.strip():
+            return handler, argument.strip()
+        if self.numbered is not None:
+            m = self.numbered.match(command)
+            if m:
+                return self.numbered_handlers[m.group(1)], int(m.group(2))
+        options = commands.options.get(command)
+        if options is not None:
+            return self.configured_handler, options
+        options = commands.options.get(name)
+        if options is not None and argument.strip() == 'full' and \
+                options['output_mode'] == 'diff':
+            # "/name full" answers with the full output instead of the delta.
+            return self.configured_handler, dict(options, refresh=True)
+        return self.unsupported_handler, command
+
+
+class CommandSet(object):
+    """
+    Class for the configured commands
+
+    The command options are parsed and validated when the command set is
+    created. Invalid commands stay in the set with an error, so that the user
+    gets an answer about the configuration error.
+    """
+
+    def __init__(self, config):
+        self.commands = create_bot_commands(config)
+        self.options = dict((name, self.parse_options(name, command)) for
+                            name, command in self.commands.items())
+        self.help_text = self.create_help_text()
+        self.trusted_user_ids = frozenset(
+            i for i in re.split(r'[\s,]+', config.get(
+                'Viber', 'trusted_user_ids', fallback='')) if i)
+        self.user_rate_limits = create_user_rate_limits(config)
+
+    @staticmethod
+    def parse_options(name, command):
+        """
+        Parse and validate the options of a configured command.
+
+        :param name: configured command name
+        :param command: dict with the command options from the configuration
+        :return: dict with the parsed options; "error" is the error text for
+                 the user, or None if the command is properly configured
+        """
+        options = {'name': name,
+                   'execute': command.get('execute'),
+                   'output_format': command.get('output_format', 'text'),
+                   'help': command.get('help'),
+                   'error': None}
+        if options['execute'] is None:
+            logger.error('Execute parameter is not configured for command '
+                         '"%s"', name)
+            options['error'] = 'Command "{}" is not properly ' \
+                               'configured.'.format(name)
+        if options['output_format'] not in OUTPUT_FORMATS:
+            logger.error('Output format parameter is not properly configured '
+                         'for command "%s" ("%s" should be "text", "json" or '
+                         '"none")', name, options['output_format'])
+            options['error'] = 'Command "{}" is not properly ' \
+                               'configured.'.format(name)
+        options['output_mode'] = command.get('output_mode', 'full')
+        if options['output_mode'] not in OUTPUT_MODES:
+            logger.error('Output mode parameter is not properly configured '
+                         'for command "%s" ("%s" should be "full" or "diff")',
+                         name, options['output_mode'])
+            options['output_mode'] = 'full'
+
+        try:
+            options['max_concurrency'] = int(command.get('max_concurrency',
+                                                         0))
+        except ValueError:
+            logger.error('Max concurrency parameter is not properly '
+                         'configured for command "%s"', name)
+            options['max_concurrency'] = 0
+
+        try:
+            options['cache_ttl'] = float(command.get('cache_ttl', 0))
+        except ValueError:
+            logger.error('Cache TTL parameter is not properly configured for '
+                         'command "%s"', name)
+            options['cache_ttl'] = 0
+        options['cache_scope'] = command.get('cache_scope', 'process')
+        if options['cache_scope'] not in CACHE_SCOPES:
+            logger.error('Cache scope parameter is not properly configured '
+                         'for command "%s" ("%s" should be "process", "host" '
+                         'or "global")', name, options['cache_scope'])
+            options['cache_scope'] = 'process'
+
+        try:
+            options['refresh_interval'] = float(command.get(
+                'refresh_interval', 0))
+        except ValueError:
+            logger.error('Refresh interval parameter is not properly '
+                         'configured for command "%s"', name)
+            options['refresh_interval'] = 0
+        try:
+            options['gather_timeout'] = float(command.get('gather_timeout',
+                                                          0))
+        except ValueError:
+            logger.error('Gather timeout parameter is not properly '
+                         'configured for command "%s"', name)
+            options['gather_timeout'] = 0
+        options['rate_limit'] = None
+        if command.get('rate_limit'):
+            try:
+                options['rate_limit'] = parse_rate_limit(
+                    command['rate_limit'])
+            except ValueError:
+                logger.error('Rate limit parameter is not properly '
+                             'configured for command "%s" ("%s" should be '
+                             '"N/seconds")', name, command['rate_limit'])
+        options['alert'] = None
+        if command.get('alert'):
+            try:
+                options['alert'] = parse_alert_rule(command['alert'])
+            except ValueError as e:
+                logger.error('Alert parameter is not properly configured for '
+                             'command "%s": %s', name, e)
+
+        limits = {'timeout': DEFAULT_TIMEOUT, 'cpu_time': None,
+                  'memory': None}
+        for k in limits:
+            value = command.get(k)
+            if value is None:
+                continue
+            try:
+                if k == 'memory':
+                    value = value.strip().upper()
+                    unit = SIZE_UNITS.get(value[-1:], 1)
+                    limits[k] = int(value.rstrip('KMG')) * unit
+                else:
+                    limits[k] = float(value)
+            except ValueError:
+                logger.error('%s parameter is not properly configured for '
+                             'command "%s"', k.capitalize(), name)
+        options['limits'] = limits
+        return options
+
+    def create_help_text(self):
+        """
+        Creates help text for the available commands.
+
+        :return: help text
+        """
+        help_dict = dict((k, v['help']) for k, v in self.options.items())
+        help_dict.update(INTERNAL_COMMANDS_HELP)
+        width = max(len(k) for k in help_dict.keys())
+        text = 'Available commands:\n\n'
+        for k, v in sorted(help_dict.items()):
+            text += '/{:<{width}} -- '.format(k, width=width)
+            if v is not None:
+                text += v
+            else:
+                text += 'Help is not available for command "{}".'.format(k)
+            text += '\n'
+        return text.strip()
+
+
+def is_trusted_user(user_id):
+    """
+    Check that the user id is one of the trusted user ids.
+
+    :param user_id: Viber user id
+    :return: True, if the user id is trusted
+    """
+    return user_id in command_set.trusted_user_ids
+
+
+def command_options(command):
+    """
+    Get the parsed options of a configured command.
+
+    :param command: configured command name
+    :return: dict with the parsed options, or empty dict if the command is
+             not configured
+    """
+    return command_set.options.get(command, dict())
+
+
+def user_rate_limit(user_id):
+    """
+    Get the rate limit of the configured commands of the user.
+
+    :param user_id: Viber user id
+    :return: tuple (tokens per second, burst), or None if there is no limit
+    """
+    limits = command_set.user_rate_limits
+    return limits.get(user_id, limits.get('default'))
+
+
+def parse_rate_limit(value):
+    """
+    Parse rate limit "N/seconds": N executions in the period, also at once.
+
+    :param value: rate limit text
+    :return: tuple (tokens per second, burst)
+    :raises ValueError: if the rate limit is not valid
+    """
+    count, _, seconds = value.partition('/')
+    count = int(count)
+    seconds = float(seconds or 1)
+    if count < 1 or seconds <= 0:
+        raise ValueError('invalid rate limit: {}'.format(value))
+    return count / seconds, count
+
+
+def refresh_commands():
+    """
+    Get the configured commands that are refreshed ahead on an interval.
+
+    :return: list of dicts with the command options
+    """
+    return [options for options in command_set.options.values()
+            if options['refresh_interval'] > 0 and not options['error']]
+
+
+def parse_alert_rule(rule):
+    """
+    Parse alert rule of a command.
+
+    :param rule: regular expression, optionally followed by an operator
+                 (>, >=, < or <=) and a threshold that the first group of the
+                 match is compared to
+    :return: tuple (compiled pattern, operator function or None, threshold)
+    :raises ValueError: if the rule is not valid
+    """
+    m = ALERT_RULE.match(rule.strip())
+    try:
+        pattern = re.compile(m.group('pattern'), re.MULTILINE)
+    except re.error as e:
+        raise ValueError('invalid regular expression: {}'.format(e))
+    if m.group('op') is None:
+        return pattern, None, None
+    if pattern.groups < 1:
+        raise ValueError('regular expression has no group to compare')
+    return (pattern, ALERT_OPERATORS[m.group('op')],
+            float(m.group('threshold')))
+
+
+def alert_lines(rule, output):
+    """
+    Find the output lines that match the alert rule.
+
+    :param rule: alert rule returned by parse_alert_rule()
+    :param output: command output
+    :return: list of matching lines; empty list, if the alert does not fire
+    """
+    pattern, compare, threshold = rule
+    lines = list()
+    for m in pattern.finditer(output):
+        if compare is not None:
+            try:
+                if not compare(float(m.group(1)), threshold):
+                    continue
+            except (TypeError, ValueError):
+                continue
+        start = output.rfind('\n', 0, m.start()) + 1
+        end = output.find('\n', m.end())
+        line = output[start:end if end >= 0 else len(output)]
+        if line not in lines:
+            lines.append(line)
+    return lines
+
+
+def cache_options(options):
+    """
+    Get the output cache options for the command.
+
+    :param options: dict with the command options
+    :return: tuple (time to live in seconds, cache scope)
+    """
+    return options.get('cache_ttl', 0), options.get('cache_scope', 'process')
+
+
+def process_options(options):
+    """
+    Get the process limits for the command.
+
+    :param options: dict with the command options
+    :return: dict with timeout, cpu_time and memory limits
+    """
+    return dict(options.get('limits', {
+        'timeout': DEFAULT_TIMEOUT, 'cpu_time': None, 'memory': None}))
+
+
+def command_result(execute, result, timeout):
+    """
+    Create command result from the process result.
+
+    :param execute: command found
+    :param result: CommandResult
+    :param timeout: timeout in seconds
+    :return: (return code, output text or error message)
+    """
+    output = result.output.decode(errors='replace').strip()
+    if result.timed_out:
+        error_msg = ('Failed to execute command "{}": Command timed out after '
+                     '{:g} seconds'.format(execute, timeout))
+        logger.error(error_msg)
+        return result.returncode, error_msg
+    if result.truncated:
+        logger.warning('Output of command "%s" exceeded %s bytes, command '
+                       'was killed', execute, MAX_OUTPUT_SIZE - 1)
+        return 0, output
+    if result.returncode != 0:
+        error_msg = 'Failed to execute command "{}": {}'.format(
+            execute, result.error.decode(errors='replace').strip())
+        logger.error(error_msg)
+        return result.returncode, error_msg
+    return result.returncode, output
+
+
+def command_help():
+    """
+    Get help text for the available commands.
+
+    :return: help text
+    """
+    return command_set.help_text
+
+
+def note_number(argument):
+    """
+    Get the note index for the note commands.
+
+    :param argument: note number, 1 is the first, or None for the last note
+    :return: note index, -1 is the last note
+    """
+    return -1 if argument is None else argument - 1
+
+
+def notes_text(notes):
+    """
+    Create the text of all the notes.
+
+    :param notes: dict of the note texts by note number
+    :return: notes text
+    """
+    text = ''
+    for k, v in sorted(notes.items()):
+        text += '{}: {}\n'.format(k, v)
+    return text.strip()
+
+
+def unsupported_text(command, user_name):
+    """
+    Create the answer to an unsupported command.
+
+    :param command: command found in request
+    :param user_name: name of the user who sent the command
+    :return: answer text
+    """
+    if command.startswith('removenote'):
+        return ('Invalid "removenote" command, use "removenote" or '
+                '"removenoteN", where "N" is an integer.')
+    if command.startswith('note'):
+        return ('Invalid "note" command, use "note" or "noteN", where "N" '
+                'is an integer.')
+    logger.warning('Un-supported command "%s" from user "%s"', command,
+                   user_name)
+    return 'Command "{}" is not supported, try "/help".'.format(command)
+
+
+def gathers_outputs(options, hosts, request_id):
+    """
+    Check if the outputs of the destination hosts are gathered to one
+    answer.
+
+    :param options: dict with the configured command options
+    :param hosts: list of destination hosts
+    :param request_id: id of the request, None if the request is not traced
+    :return: True, if the outputs are gathered
+    """
+    return bool(len(hosts) > 1 and options['gather_timeout'] and
+                options['output_format'] != 'none' and request_id)
+
+
+def pool_status_text(stats):
+    """
+    Creates status text for the command pool.
+
+    :param stats: dict with the command pool statistics
+    :return: status text
+    """
+    return ('Command pool:\n\n'
+            'Workers: {workers}\n'
+            'Running: {running}\n'
+            'Queue: {queue_depth}/{queue_size}\n'
+            'Submitted: {submitted}\n'
+            'Completed: {completed}\n'
+            'Rejected: {rejected}\n'
+            'Queue wait: {wait_avg:.3f} s average, {wait_max:.3f} s '
+            'maximum'.format(**stats))
+
+
+def create_bot_commands(config):
+    """
+    Create bot commands dict from the bot configuration.
+
+    :param config: parsed bot configuration
+    :return: commands dict
+    """
+    commands = dict()
+    prefix = 'Command '
+    for section in [s for s in config.sections() if s.startswith(prefix)]:
+        commands[section[len(prefix):].strip()] = dict(config[section])
+    return commands
+
+
+def create_user_rate_limits(config):
+    """
+    Create user rate limits dict from the bot configuration.
+
+    :param config: parsed bot configuration
+    :return: dict of user id (or "default") and tuple (tokens per second,
+             burst)
+    """
+    limits = dict()
+    values = [('default', config.get('Viber', 'user_rate_limit',
+                                     fallback=''))]
+    # Comma separated list of "<user id> N/seconds".
+    for value in config.get('Viber', 'user_rate_limits',
+                            fallback='').split(','):
+        user_id, _, value = value.strip().rpartition(' ')
+        values.append((user_id.strip(), value))
+    for user_id, value in values:
+        if not user_id or not value:
+            continue
+        try:
+            limits[user_id] = parse_rate_limit(value)
+        except ValueError:
+            logger.error('Rate limit of user "%s" is not properly configured '
+                         '("%s" should be "N/seconds")', user_id, value)
+    return limits
+
+
+def reload_command_set(config):
+    """
+    Replace the command set with the commands of the initialized or reloaded
+    configuration.
+
+    :param config: bot configuration
+    :return: None
+    """
+    global command_set
+    command_set = CommandSet(config)
+
+
+command_set = None
+add_init_listener(reload_command_set)
+config_watcher.add_listener(reload_command_set)
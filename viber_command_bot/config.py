@@ -1,10 +1,25 @@
 """
 Viber bot configuration parsing
+
+The configuration file is watched for changes by a thread in every process
+that serves requests. A changed file is parsed in the watcher thread and the
+parsed configuration is swapped in at once, so that a request sees either the
+old or the new configuration. A file that fails to parse does not replace the
+working configuration.
+
+Importing the module does not read the configuration file. The scripts and
+the bot applications call init_config() at startup, which parses the file and
+configures the modules that have registered an init listener.
 """
 
 import configparser
+import logging
 import os
-import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
 
 
 class ParseError(Exception):
@@ -26,7 +41,10 @@ def parse(file_path):
     config = configparser.ConfigParser()
     if not os.path.exists(file_path):
         raise ParseError('Configuration file not found: {}'.format(file_path))
-    config.read(file_path)
+    try:
+        config.read(file_path)
+    except configparser.Error as e:
+        raise ParseError('Configuration file is not valid: {}'.format(e))
 
     if 'Viber' not in config:
         raise ParseError('Configuration block "Viber" is missing')
@@ -38,12 +56,190 @@ def parse(file_path):
     return config
 
 
-VIBER_CONF = '/etc/viber/viber-command-bot.conf'
+class Config(object):
+    """
+    Class for the current bot configuration
+
+    Attribute access is passed to the current ConfigParser object. Reloading
+    replaces the object, so the modules that have imported the configuration
+    see the new configuration.
+    """
+
+    def __init__(self, parser=None):
+        self.parser = parser
+
+    def current(self):
+        """
+        Get the current ConfigParser object.
+
+        :return: ConfigParser object
+        :raises ParseError: if the configuration is not initialized
+        """
+        if self.parser is None:
+            raise ParseError('Configuration is not initialized')
+        return self.parser
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.current(), name)
+
+    def __getitem__(self, section):
+        return self.current()[section]
+
+    def __contains__(self, section):
+        return section in self.current()
+
+    def __iter__(self):
+        return iter(self.current())
+
+
+class ConfigWatcher(object):
+    """
+    Class for reloading the configuration when the configuration file changes
+    """
+
+    def __init__(self, config, file_path=None, interval=5.0):
+        self.config = config
+        self.file_path = file_path
+        self.interval = interval
+        self.listeners = list()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.version = self.file_version()
+
+    def watch(self, file_path, interval):
+        """
+        Set the watched configuration file. The current version of the file
+        is the loaded one.
+
+        :param file_path: path to the configuration file
+        :param interval: seconds between the checks, 0 disables reloading
+        :return: None
+        """
+        self.file_path = file_path
+        self.interval = interval
+        self.version = self.file_version()
+
+    def add_listener(self, listener):
+        """
+        Add function that is called with the new configuration after the
+        configuration has been reloaded.
 
+        :param listener: callable(config)
+        :return: None
+        """
+        self.listeners.append(listener)
+
+    def start(self):
+        """
+        Start the watcher thread, if it is not running. The thread is started
+        in the process that serves the requests, so that it survives uWSGI
+        fork.
+
+        :return: None
+        """
+        if self.interval <= 0:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker,
+                                               daemon=True,
+                                               name='config-watcher')
+                self.thread.start()
+
+    def file_version(self):
+        """
+        Get the version of the configuration file.
+
+        :return: tuple (inode, size, modification time), or None if the file
+                 does not exist
+        """
+        if not self.file_path:
+            return None
+        try:
+            st = os.stat(self.file_path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def check(self):
+        """
+        Reload the configuration, if the configuration file has changed.
+
+        :return: True, if the configuration was reloaded
+        """
+        version = self.file_version()
+        if version is None or version == self.version:
+            return False
+        self.version = version
+        try:
+            parser = parse(self.file_path)
+        except ParseError as e:
+            logger.error('Configuration is not reloaded: %s', e)
+            return False
+        self.config.parser = parser
+        logger.info('Configuration reloaded from %s', self.file_path)
+        for listener in self.listeners:
+            try:
+                listener(self.config)
+            except Exception as e:
+                logger.error('Failed to apply reloaded configuration: %s', e)
+        return True
+
+    def _worker(self):
+        """
+        Worker thread checks the configuration file periodically.
+        """
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+
+def add_init_listener(listener):
+    """
+    Add function that configures a module when the configuration is
+    initialized. If the configuration is already initialized, the function is
+    called at once.
+
+    :param listener: callable(config)
+    :return: None
+    """
+    with init_lock:
+        init_listeners.append(listener)
+        if config.parser is not None:
+            listener(config)
+
+
+def init_config(file_path=None):
+    """
+    Parse the bot configuration file and configure the modules. The
+    configuration is parsed only once; later calls return the parsed
+    configuration.
+
+    :param file_path: path to the configuration file, default is the
+                      VIBER_CONF environment variable or
+                      /etc/viber/viber-command-bot.conf
+    :return: parsed configuration
+    :raises ParseError: if the configuration file is not valid
+    """
+    with init_lock:
+        if config.parser is not None:
+            return config
+        file_path = file_path or os.getenv('VIBER_CONF', VIBER_CONF)
+        config.parser = parse(file_path)
+        config_watcher.watch(file_path, config.getfloat(
+            'Viber', 'config_reload_interval', fallback=5.0))
+        for listener in list(init_listeners):
+            listener(config)
+    return config
+
+
+VIBER_CONF = '/etc/viber/viber-command-bot.conf'
 
-try:
-    config = parse(os.getenv('VIBER_CONF', VIBER_CONF))
-except ParseError as e:
-    # Configuration parsing error is fatal.
-    print('FATAL: {}'.format(e))
-    sys.exit(1)
+config = Config()
+config_watcher = ConfigWatcher(config)
+init_listeners = list()
+init_lock = threading.RLock()
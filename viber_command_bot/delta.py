@@ -0,0 +1,51 @@
+"""
+Delta replies for repeated monitoring commands
+
+Commands configured with "output_mode = diff" answer with the lines that
+changed since the previous answer to the same user. The previous output is
+kept in the cache per user, command and host, so that the answers of the
+Flask application, the ASGI application and the command executor daemons
+are compared against the right output.
+"""
+
+import difflib
+
+
+# Seconds the previous output is kept in the cache.
+LAST_OUTPUT_TTL = 24 * 60 * 60
+
+
+def create_delta(command, previous, text):
+    """
+    Create the answer with the lines that differ from the previous output.
+    Added lines are marked with "+", removed lines with "-" and changed
+    lines with "~".
+
+    :param command: configured command name
+    :param previous: previous output, or None if there is no previous output
+    :param text: new output
+    :return: answer text; the new output, if there is no previous output or
+             the delta would not be shorter
+    """
+    if previous is None:
+        return text
+    if previous == text:
+        return 'No changes since the previous "/{}".'.format(command)
+    old = previous.splitlines()
+    new = text.splitlines()
+    lines = ['Changes since the previous "/{}", send "/{} full" for the '
+             'full output:'.format(command, command)]
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        removed = old[i1:i2]
+        added = new[j1:j2]
+        changed = min(len(removed), len(added))
+        lines.extend('~ {}'.format(line) for line in added[:changed])
+        lines.extend('- {}'.format(line) for line in removed[changed:])
+        lines.extend('+ {}'.format(line) for line in added[changed:])
+    delta = '\n'.join(lines)
+    if len(delta) >= len(text):
+        return text
+    return delta
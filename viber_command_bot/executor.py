@@ -0,0 +1,243 @@
+"""
+Execution of the configured commands on the local host
+
+The commands are executed by the Flask application and by the command
+executor daemon. The module does not depend on Flask, so that the daemon
+does not need to load the web application.
+"""
+
+import json
+import logging
+import socket
+import time
+from viber_command_bot.cache import cache
+from viber_command_bot.commands import cache_options, command_options
+from viber_command_bot.commands import command_result, process_options
+from viber_command_bot.commands import MAX_OUTPUT_SIZE
+from viber_command_bot.config import config
+from viber_command_bot.delta import create_delta, LAST_OUTPUT_TTL
+from viber_command_bot.gather import GATHER_TTL
+from viber_command_bot.messages import send_message
+from viber_command_bot.metrics import metrics
+from viber_command_bot.output_cache import output_cache
+from viber_command_bot.process import run_command
+from viber_command_bot.tracing import current_request_id, tracer
+
+
+logger = logging.getLogger(__name__)
+
+
+def command_thread_target(execute, output_format, user_id, destination,
+                          pretext=None, command=None, options=None):
+    """
+    Local command is run in a separate thread.
+
+    :param execute: local command to execute
+    :param output_format: expected command output format specified in the bot
+                          configuration
+    :param user_id: user id who will receive the answer
+    :param destination: destination for the command
+    :param pretext: text added to the beginning of message
+    :param command: configured command name, used for command options
+    :param options: dict with the command options, default is the options
+                    of the command in the current configuration
+    :return: None
+    :raises Exception: if message sending fails
+    """
+    if destination and socket.gethostname() not in destination:
+        # Command is not for this host.
+        return
+    if options is None:
+        options = command_options(command)
+    cache_ttl, cache_scope = cache_options(options)
+    with tracer.trace('command'):
+        text, media = execute_local_command(
+            execute, output_format, cache_ttl=cache_ttl,
+            cache_scope=cache_scope, limits=process_options(options),
+            command=options.get('name', command))
+        if output_format == 'none':
+            return
+        request_id = current_request_id()
+        if len(destination or []) > 1 and options.get('gather_timeout') and \
+                request_id:
+            # The bot that published the command gathers the outputs of the
+            # hosts to one answer.
+            cache.add_gathered(request_id, socket.gethostname(),
+                               text if text is not None else media or '',
+                               options['gather_timeout'] + GATHER_TTL)
+            return
+        if options.get('output_mode') == 'diff' and text:
+            text = delta_text(user_id, options, text)
+        if isinstance(pretext, str):
+            text = pretext + text
+        send_message(user_id, text, media=media)
+
+
+def delta_text(user_id, options, text, host=None):
+    """
+    Get the answer of a command with the diff output mode.
+
+    :param user_id: user id who will receive the answer
+    :param options: dict with the command options
+    :param text: command output
+    :param host: host of the output, default is this host
+    :return: answer text
+    """
+    previous = cache.swap_last_output(user_id, options['name'], text,
+                                      LAST_OUTPUT_TTL, host=host)
+    if options.get('refresh'):
+        previous = None
+    return create_delta(options['name'], previous, text)
+
+
+def send_refreshed(user_id, options, destination=None):
+    """
+    Answer with the outputs of the command refreshed ahead.
+
+    :param user_id: user id who will receive the answer
+    :param options: dict with the command options
+    :param destination: list of addressed hosts and host groups
+    :return: True, if the refreshed outputs were sent
+    :raises Exception: if message sending fails
+    """
+    refreshed = cache.get_refreshed(options['name'])
+    hosts = refreshed_hosts(refreshed, options, destination)
+    for host in hosts:
+        output, date = refreshed[host]
+        text, media = format_output(options['execute'],
+                                    options['output_format'], 0, output)
+        if options.get('output_mode') == 'diff' and text:
+            text = delta_text(user_id, options, text, host=host)
+        send_message(user_id, refreshed_text(text, date, host), media=media)
+    return bool(hosts)
+
+
+def refreshed_hosts(refreshed, options, destination=None):
+    """
+    Get the hosts whose refreshed outputs answer the command: the addressed
+    hosts, this host when the command executor is not used, and otherwise
+    the hosts whose command executors would answer.
+
+    :param refreshed: dict {host: (output text, time of the refresh)}
+    :param options: dict with the command options
+    :param destination: list of addressed hosts and host groups
+    :return: list of host names, empty if the command must be executed
+    """
+    if destination:
+        hosts = cache.expand_destination(destination)
+        if len(hosts) > 1 and options.get('gather_timeout'):
+            # The outputs are gathered to one answer.
+            return list()
+    elif not config.getboolean('Viber', 'command_executor', fallback=False):
+        hosts = [socket.gethostname()]
+    elif cache.transport == 'streams':
+        # One of the command executors would answer.
+        hosts = sorted(refreshed, key=lambda host: refreshed[host][1])[-1:]
+    else:
+        hosts = sorted(refreshed)
+    if not hosts or any(host not in refreshed for host in hosts):
+        return list()
+    return hosts
+
+
+def refreshed_text(text, date, host):
+    """
+    Add the time of the refresh and the host to the answer.
+
+    :param text: answer text
+    :param date: time of the refresh, seconds since the epoch
+    :param host: host of the output
+    :return: answer text
+    """
+    if not text:
+        return text
+    return '{}\n<updated {} on {}>'.format(text, time.strftime(
+        '%H:%M:%S', time.localtime(date)), host)
+
+
+def execute_local_command(execute, output_format='text', cache_ttl=0,
+                          cache_scope='process', limits=None, command=None):
+    """
+    Execute local command in another process, or get the output from the
+    output cache.
+
+    :param execute: command found
+    :param output_format: text | json | none
+    :param cache_ttl: time to live of the cached output in seconds
+    :param cache_scope: process | host | global
+    :param limits: dict with process limits, see run_local_command()
+    :param command: configured command name, used for metrics
+    :return: (message text, optional media url)
+    """
+    if limits is None:
+        limits = dict()
+    rc, output = output_cache.get(execute, cache_ttl,
+                                  lambda: run_local_command(
+                                      execute, command=command, **limits),
+                                  scope=cache_scope)
+    return format_output(execute, output_format, rc, output)
+
+
+def format_output(execute, output_format, rc, output):
+    """
+    Create the answer from the command result.
+
+    :param execute: command found
+    :param output_format: text | json | none
+    :param rc: return code
+    :param output: output text or error message
+    :return: (message text, optional media url)
+    """
+    if rc != 0:
+        return output, None
+    if output_format == 'json':
+        try:
+            message = json.loads(output)
+        except ValueError:
+            logger.error('Command "%s" output was not JSON: %s',
+                         execute, output)
+            return ('Failed to execute command "{}": Command output '
+                    'was not JSON'.format(execute), None)
+        return message.get('text'), message.get('media')
+    return output, None
+
+
+def run_local_command(execute, timeout=None, cpu_time=None, memory=None,
+                      command=None):
+    """
+    Run local command in another process. The output is read up to the
+    maximum message size, and the command is killed if it produces more
+    output or runs longer than the timeout.
+
+    :param execute: command found
+    :param timeout: timeout in seconds, or None
+    :param cpu_time: maximum CPU time in seconds, or None
+    :param memory: maximum virtual memory in bytes, or None
+    :param command: configured command name, used for metrics
+    :return: (return code, output text or error message)
+    """
+    logger.info('Running command "%s"', execute)
+    start = time.perf_counter()
+    with tracer.span('subprocess'):
+        result = run_command(execute, MAX_OUTPUT_SIZE, timeout=timeout,
+                             cpu_time=cpu_time, memory=memory)
+    record_result(command, result, time.perf_counter() - start)
+    return command_result(execute, result, timeout)
+
+
+def record_result(command, result, runtime):
+    """
+    Record the metrics of the command process.
+
+    :param command: configured command name
+    :param result: CommandResult
+    :param runtime: runtime in seconds
+    :return: None
+    """
+    command = command or ''
+    metrics.observe('viber_command_runtime_seconds', runtime,
+                    command=command)
+    metrics.inc('viber_command_exit_total', command=command,
+                code='timeout' if result.timed_out else result.returncode)
+    metrics.inc('viber_command_output_bytes_total', len(result.output),
+                command=command)
@@ -4,13 +4,8 @@
 Viber command bot Flask application
 """
 
-import json
-import logging
-import re
-import socket
-import subprocess
-import threading
-from logging.handlers import SysLogHandler
+import os
+import sys
 
 from flask import Flask, request, Response
 from viberbot.api.viber_requests import ViberConversationStartedRequest
@@ -18,20 +13,45 @@ from viberbot.api.viber_requests import ViberFailedRequest
 from viberbot.api.viber_requests import ViberMessageRequest
 from viberbot.api.viber_requests import ViberSubscribedRequest
 from viberbot.api.viber_requests import ViberUnsubscribedRequest
+from viberbot.api.viber_requests import create_request
 
 from viber_command_bot.info import info
-from viber_command_bot.messages import send_message
-from viber_command_bot.cache import cache
-from viber_command_bot.config import config
-from viber_command_bot.viber import viber
-
-
-NOTE = re.compile('^note(?P<n>\d+)$')
-REMOVENOTE = re.compile('^removenote(?P<n>\d+)$')
+from viber_command_bot.messages import send_message, send_more
+from viber_command_bot.admission import admitted, command_buckets
+from viber_command_bot.admission import RATE_LIMITED_TEXT
+from viber_command_bot.cache import cache, CACHE_NOT_AVAILABLE_TEXT
+from viber_command_bot.commands import command_help, CommandRouter
+from viber_command_bot.commands import gathers_outputs, is_trusted_user
+from viber_command_bot.commands import note_number, notes_text
+from viber_command_bot.commands import pool_status_text, split_destination
+from viber_command_bot.commands import unsupported_text
+from viber_command_bot.commands import BUSY_TEXT, NO_MORE_TEXT
+from viber_command_bot.config import config, config_watcher, init_config
+from viber_command_bot.config import ParseError
+from viber_command_bot.executor import command_thread_target, send_refreshed
+from viber_command_bot.gather import gather_thread_target
+from viber_command_bot.logger import init_logging, logger
+from viber_command_bot.metrics import metrics, webhook_event
+from viber_command_bot.pool import command_pool, PoolBusyError
+from viber_command_bot.scheduler import refresh_scheduler
+from viber_command_bot.tracing import current_request_id, tracer
+from viber_command_bot.webhook import event_sender, event_text, event_token
+from viber_command_bot.webhook import parse_event, seen_tokens
+from viber_command_bot.webhook import untrusted_users
+from viber_command_bot.webhook import verify_signature, IGNORED_EVENTS
 
 
 app = Flask(__name__)
 
+# The application module is loaded by uWSGI at startup.
+try:
+    init_config()
+except ParseError as e:
+    # Configuration parsing error is fatal.
+    print('FATAL: {}'.format(e))
+    sys.exit(1)
+init_logging()
+
 
 @app.route('/', methods=['POST'])
 def bot_request():
@@ -39,19 +59,90 @@ def bot_request():
     Receive bot request from Viber service.
 
     :return: Response(status=200), if request is successful
+             Response(status=400), if request body is not valid
              Response(status=403), if request is not allowed
     :raises Exception: if message sending fails
     """
 
-    logger.debug('Received request, post data: {0}'.format(
-        request.get_data()))
+    # Configuration is reloaded by a thread in each worker process.
+    config_watcher.start()
+    metrics.start_server()
+    if not config.getboolean('Viber', 'command_executor', fallback=False):
+        refresh_scheduler.start()
+
+    with metrics.timer('viber_webhook_latency_seconds',
+                       event='invalid') as labels, \
+            tracer.trace('webhook', profile=True) as trace:
+        body = request.get_data()
+        logger.debug('Received request, post data: %s', body)
+        with tracer.span('verify'):
+            verified = verify_signature(body, request.headers.get(
+                'X-Viber-Content-Signature'))
+        if not verified:
+            return Response(status=403)
+        with tracer.span('parse'):
+            event = parse_event(body)
+        if event is None:
+            return Response(status=400)
+        if event.get('message_token'):
+            trace.request_id = str(event['message_token'])
+        labels['event'] = webhook_event(event.get('event'))
+        return handle_event(event)
+
 
-    if not viber.verify_signature(request.get_data(), request.headers.get(
-            'X-Viber-Content-Signature')):
+def handle_event(event):
+    """
+    Handle verified Viber callback event.
+
+    :param event: parsed event
+    :return: Response(status=200), if request is successful
+             Response(status=403), if request is not allowed
+    :raises Exception: if message sending fails
+    """
+    if event.get('event') in IGNORED_EVENTS:
+        return Response(status=200)
+    if event.get('event') == 'message' and not check_user_id(event):
         return Response(status=403)
 
-    viber_request = viber.parse_request(request.get_data())
+    token = event_token(event)
+    if token is not None and not first_token(token):
+        logger.info('Callback %s has already been handled', token)
+        return Response(status=200)
+
+    try:
+        with tracer.span('create_request'):
+            viber_request = create_request(event)
+
+        # Cache writes are sent to Redis in one pipeline per request.
+        with cache.batch():
+            return handle_request(viber_request)
+    except Exception:
+        if token is not None:
+            # Viber sends the callback again.
+            seen_tokens.forget(token)
+            cache.forget_token(token)
+        raise
+
+
+def first_token(token):
+    """
+    Check if the callback is received for the first time by any process.
+
+    :param token: message token of the callback
+    :return: True, if the callback should be handled
+    """
+    return seen_tokens.first(token) and cache.first_token(
+        token, config.getint('Viber', 'token_ttl', fallback=3600))
+
+
+def handle_request(viber_request):
+    """
+    Handle parsed bot request from Viber service.
 
+    :param viber_request: request from Viber service
+    :return: Response(status=200), if request is successful
+    :raises Exception: if message sending fails
+    """
     if isinstance(viber_request, ViberConversationStartedRequest):
         cache.conversation_started(viber_request.user.id,
                                    viber_request.user.name)
@@ -59,45 +150,46 @@ def bot_request():
                      'Hello, {}!\n\n{}'.format(
                          viber_request.user.name, command_help()))
     elif isinstance(viber_request, ViberMessageRequest):
-        if not check_user_id(viber_request):
-            return Response(status=403)
         handle_viber_request(viber_request)
     elif isinstance(viber_request, ViberSubscribedRequest):
-        logger.info('User "{}" subscribed as user id "{}"'.format(
-            viber_request.user.name, viber_request.user.id))
+        logger.info('User "%s" subscribed as user id "%s"',
+                    viber_request.user.name, viber_request.user.id)
         cache.subscribe_user(viber_request.user.id, viber_request.user.name)
         send_message(viber_request.user.id,
                      'Hello, {}!\n\n{}'.format(
                          viber_request.user.name, command_help()))
     elif isinstance(viber_request, ViberUnsubscribedRequest):
-        logger.info('User id "{}" un-subscribed'.format(viber_request.user_id))
+        logger.info('User id "%s" un-subscribed', viber_request.user_id)
         cache.unsubscribe_user(viber_request.user_id)
     elif isinstance(viber_request, ViberFailedRequest):
-        logger.warning('Client failed receiving message, failure: '
-                       '{0}'.format(viber_request))
+        logger.warning('Client failed receiving message, failure: %s',
+                       viber_request)
 
     return Response(status=200)
 
 
-def check_user_id(viber_request):
+def check_user_id(event):
     """
-    Check that the request comes from a trusted user id.
+    Check that the message event comes from a trusted user id. The notify
+    user is told about an un-trusted user id only once, so that messages
+    from un-trusted users do not cause outbound traffic.
 
-    :param viber_request: request from Viber service
-    :return: True, if request is from trusted user id
-             False, if request comes from un-trusted user id
+    :param event: parsed message event
+    :return: True, if event is from trusted user id
+             False, if event comes from un-trusted user id
     :raises Exception: if message sending fails
     """
-    if viber_request.sender.id not in config.get('Viber', 'trusted_user_ids'):
-        text = ('Received message from un-trusted user "{}" (user id "{}"): '
-                '{}'.format(viber_request.sender.name, viber_request.sender.id,
-                            viber_request.message.text))
-        logger.warning(text)
-        send_message(config.get('Viber', 'notify_user_id'), text)
+    user_id, name = event_sender(event)
+    if not is_trusted_user(user_id):
+        logger.warning('Received message from un-trusted user "%s" (user id '
+                       '"%s"): %s', name, user_id, event_text(event))
+        if untrusted_users.first(user_id):
+            text = ('Received message from un-trusted user "{}" (user id '
+                    '"{}"): {}'.format(name, user_id, event_text(event)))
+            send_message(config.get('Viber', 'notify_user_id'), text)
         return False
-    logger.info('Received message from trusted user "{}" (user id "{}"): '
-                '{}'.format(viber_request.sender.name, viber_request.sender.id,
-                            viber_request.message.text))
+    logger.info('Received message from trusted user "%s" (user id "%s"): '
+                '%s', name, user_id, event_text(event))
     return True
 
 
@@ -126,221 +218,143 @@ def execute_command(viber_request, command):
     :return: None
     :raises Exception: if message sending fails
     """
-    destination = list()
-    if '@' in command:
-        # Destination is a comma separated list of hosts. Clean up the list.
-        command, destination_str = command.split('@', 1)
-        command = command.strip()
-        for d in destination_str.strip().split(','):
-            destination.append(d.strip())
-    logger.info('Received command "{}" from user "{}"'.format(
-        command, viber_request.sender.name))
-    if not command or command == 'help':
-        send_message(viber_request.sender.id, command_help())
-    elif command == 'version':
-        send_message(viber_request.sender.id, info)
-    elif command == 'echo':
-        send_message(viber_request.sender.id, ':-)')
-    elif command.startswith('echo '):
-        send_message(viber_request.sender.id, command[len('echo '):])
-    elif command.startswith('note '):
-        cache.add_note(command[len('note '):].strip())
-    elif command == 'note':
-        send_message(viber_request.sender.id, cache.show_note(number=-1))
-    elif command == 'notes':
-        text = ''
-        for k, v in sorted(cache.show_all_notes().items()):
-            text += '{}: {}\n'.format(k, v)
-        send_message(viber_request.sender.id, text.strip())
-    elif command.startswith('note'):
-        m = NOTE.match(command)
-        if m:
-            send_message(viber_request.sender.id,
-                         cache.show_note(number=int(m.group('n')) - 1))
-        else:
-            send_message(viber_request.sender.id,
-                         'Invalid "note" command, use "note" or "noteN", '
-                         'where "N" is an integer.')
-    elif command == 'removenotes':
-        cache.remove_all_notes()
-    elif command == 'removenote':
-        cache.remove_note(number=-1)
-    elif command.startswith('removenote'):
-        m = REMOVENOTE.match(command)
-        if m:
-            cache.remove_note(number=int(m.group('n') - 1))
-        else:
-            send_message(viber_request.sender.id,
-                         'Invalid "removenote" command, use "removenote" or '
-                         '"removenoteN", where "N" is an integer.')
-    elif command not in bot_commands:
-        logger.warning('Un-supported command "{}" from user "{}"'.format(
-            command, viber_request.sender.name))
-        send_message(viber_request.sender.id,
-                     'Command "{}" is not supported, '
-                     'try "/help".'.format(command))
-    elif 'execute' not in bot_commands[command]:
-        logger.error('Execute parameter is not configured for command '
-                     '"{}"'.format(command))
-        send_message(viber_request.sender.id,
-                     'Command "{}" is not properly '
-                     'configured.'.format(command))
-    elif bot_commands[command].get('output_format', 'text') not in [
-            'text', 'json', 'none']:
-        logger.error('Output format parameter is not properly configured for '
-                     'command "{}" ("{}" should be "text" or "json")'.format(
-                        command, bot_commands[command].get('output_format')))
-        send_message(viber_request.sender.id,
-                     'Command "{}" is not properly '
-                     'configured.'.format(command))
-    elif config.getboolean('Viber', 'command_executor', fallback=False):
-        # There is another daemon that handles the messages. Just publish
-        # the message.
-        cache.refresh_user(viber_request.sender.id, viber_request.sender.name)
-        cache.publish(viber_request.sender.id,
-                      bot_commands[command].get('execute'),
-                      destination=destination,
-                      name=viber_request.sender.name,
-                      message_type='execute',
-                      output_format=bot_commands[command].get(
-                          'output_format', 'text'))
-    else:
-        # Viber bot API expects responses to be quick. The local command
-        # might take longer that allowed, so execute them in another thread.
-        # The answer is sent when the command is ready.
-        command_thread = threading.Thread(
-            target=command_thread_target,
-            args=(bot_commands[command].get('execute'),
-                  bot_commands[command].get('output_format', 'text'),
-                  viber_request.sender.id,))
-        command_thread.start()
+    command, destination = split_destination(command)
+    logger.info('Received command "%s" from user "%s"', command,
+                viber_request.sender.name)
+    handler, argument = router.route(command)
+    handler(viber_request, argument, destination)
 
 
-def command_help():
-    """
-    Creates help text for the available commands.
+# Internal command handlers, routed by the INTERNAL_COMMANDS table of
+# viber_command_bot.commands, where the handler interface is documented.
 
-    :return: help text
-    """
-    help_dict = dict((k, bot_commands[k].get('help')) for k in
-                     bot_commands.keys())
-    help_dict['echo'] = 'Echo the text sent to the bot (internal command).'
-    help_dict['version'] = 'Show information about the bot (internal command).'
-    help_dict['note'] = 'Create note or show the last note (internal command).'
-    help_dict['notes'] = 'Show all notes (internal command).'
-    help_dict['noteN'] = 'Show the Nth note (internal command).'
-    help_dict['removenote'] = 'Remove the last note (internal command).'
-    help_dict['removenoteN'] = 'Remove the Nth note (internal command).'
-    help_dict['removenotes'] = 'Remove all notes (internal command).'
-    width = max(len(k) for k in help_dict.keys())
-    text = 'Available commands:\n\n'
-    for k, v in sorted(help_dict.items()):
-        text += '/{:<{width}} -- '.format(k, width=width)
-        if v is not None:
-            text += v
-        else:
-            text += 'Help is not available for command "{}".'.format(k)
-        text += '\n'
-    return text.strip()
-
-
-def command_thread_target(execute, output_format, user_id, destination,
-                          pretext=None):
-    """
-    Local command is run in a separate thread.
-
-    :param execute: local command to execute
-    :param output_format: expected command output format specified in the bot
-                          configuration
-    :param user_id: user id who will receive the answer
-    :param destination: destination for the command
-    :param pretext: text added to the beginning of message
-    :return: None
-    :raises Exception: if message sending fails
-    """
-    if destination and socket.gethostname() not in destination:
-        # Command is not for this host.
-        return
-    text, media = execute_local_command(execute, output_format)
-    if output_format == 'none':
-        return
-    if isinstance(pretext, str):
-        text = pretext + text
-    send_message(user_id, text, media=media)
 
+def show_help(viber_request, argument, destination):
+    send_message(viber_request.sender.id, command_help())
 
-def execute_local_command(execute, output_format='text'):
-    """
-    Execute local command in another process.
 
-    :param execute: command found
-    :param output_format: text | json | none
-    :return: (message text, optional media url)
-    """
-    logger.info('Running command "{}"'.format(execute))
-    p = subprocess.Popen(execute, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE, shell=True)
-    output, error = p.communicate()
-    rc = p.returncode
-    if rc != 0:
-        error_msg = 'Failed to execute command "{}": {}'.format(
-            execute, error.decode().strip())
-        logger.error(error_msg)
-        return error_msg, None
-    if output_format == 'json':
-        try:
-            message = json.loads(output.decode().strip())
-        except ValueError:
-            logger.error('Command "{}" output was not JSON: {}'.format(
-                execute, output.decode().strip()))
-            return ('Failed to execute command "{}": Command output '
-                    'was not JSON'.format(execute), None)
-        return message.get('text'), message.get('media')
-    return output.decode().strip(), None
+def show_version(viber_request, argument, destination):
+    send_message(viber_request.sender.id, info)
 
 
-def create_bot_commands():
-    """
-    Create bot commands dict from the bot configuration.
+def show_queue(viber_request, argument, destination):
+    send_message(viber_request.sender.id,
+                 pool_status_text(command_pool.stats()))
 
-    :return: commands dict
-    """
-    commands = dict()
-    prefix = 'Command '
-    for section in [s for s in config.sections() if s.startswith(prefix)]:
-        commands[section[len(prefix):].strip()] = dict(config[section])
-    return commands
-
-
-bot_commands = create_bot_commands()
-
-log_level = config.get('Logger', 'level', fallback='INFO').upper()
-use_syslog = config.getboolean('Logger', 'syslog', fallback=True)
-log_file = config.get('Logger', 'file', fallback=None)
-log_stdout = config.getboolean('Logger', 'stdout', fallback=False)
-
-logger = logging.getLogger()
-logger.setLevel(log_level)
-
-if use_syslog:
-    handler = logging.handlers.SysLogHandler(address='/dev/log')
-    formatter = logging.Formatter('viber-bot: %(levelname)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-if log_file:
-    handler = logging.FileHandler(log_file)
-    formatter = logging.Formatter('%(asctime)s: %(levelname)s: '
-                                  '%(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-if log_stdout:
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s: %(levelname)s: '
-                                  '%(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+def echo(viber_request, argument, destination):
+    send_message(viber_request.sender.id, argument or ':-)')
+
+
+def add_note(viber_request, argument, destination):
+    if cache.add_note(argument) is None:
+        send_message(viber_request.sender.id, CACHE_NOT_AVAILABLE_TEXT)
+
+
+def show_note(viber_request, argument, destination):
+    text = cache.show_note(number=note_number(argument))
+    send_message(viber_request.sender.id,
+                 CACHE_NOT_AVAILABLE_TEXT if text is None else text)
+
+
+def show_all_notes(viber_request, argument, destination):
+    notes = cache.show_all_notes()
+    send_message(viber_request.sender.id,
+                 CACHE_NOT_AVAILABLE_TEXT if notes is None else
+                 notes_text(notes))
+
+
+def remove_note(viber_request, argument, destination):
+    if cache.remove_note(number=note_number(argument)) is None:
+        send_message(viber_request.sender.id, CACHE_NOT_AVAILABLE_TEXT)
+
+
+def remove_all_notes(viber_request, argument, destination):
+    if cache.remove_all_notes() is None:
+        send_message(viber_request.sender.id, CACHE_NOT_AVAILABLE_TEXT)
+
+
+def show_more(viber_request, argument, destination):
+    if not send_more(viber_request.sender.id):
+        send_message(viber_request.sender.id, NO_MORE_TEXT)
+
+
+def profile(viber_request, argument, destination):
+    if viber_request.sender.id != config.get('Viber', 'notify_user_id'):
+        unsupported_command(viber_request, 'profile', destination)
+    elif not tracer.profile_directory:
+        send_message(viber_request.sender.id,
+                     'Profile directory is not configured.')
+    else:
+        count = argument or tracer.profile_requests
+        tracer.profile(count)
+        send_message(viber_request.sender.id,
+                     'Profiling the next {} requests of worker {}.'.format(
+                         count, os.getpid()))
+
+
+def unsupported_command(viber_request, command, destination):
+    send_message(viber_request.sender.id,
+                 unsupported_text(command, viber_request.sender.name))
+
+
+def execute_configured_command(viber_request, options, destination):
+    command = options['name']
+    if options['error']:
+        send_message(viber_request.sender.id, options['error'])
+        return
+    buckets = command_buckets(viber_request.sender.id, options)
+    if buckets and not admitted(buckets, cache.take_tokens(buckets)):
+        logger.warning('Command "%s" from user "%s" rejected: rate limited',
+                       command, viber_request.sender.name)
+        send_message(viber_request.sender.id, RATE_LIMITED_TEXT)
+        return
+    if options['refresh_interval'] and options['output_format'] != 'none' \
+            and send_refreshed(viber_request.sender.id, options, destination):
+        return
+    if options.get('refresh'):
+        # "/name full": the command executors answer with the full output.
+        cache.clear_last_output(viber_request.sender.id, command)
+    if config.getboolean('Viber', 'command_executor', fallback=False):
+        hosts = cache.expand_destination(destination)
+        if gathers_outputs(options, hosts, current_request_id()):
+            # The outputs of the hosts are gathered to one answer in the
+            # command pool.
+            try:
+                command_pool.submit(
+                    command, options['max_concurrency'],
+                    gather_thread_target, viber_request.sender.id, command,
+                    hosts, current_request_id(), options['gather_timeout'])
+            except PoolBusyError as e:
+                logger.warning('Command "%s" from user "%s" rejected: %s',
+                               command, viber_request.sender.name, e)
+                send_message(viber_request.sender.id, BUSY_TEXT)
+                return
+        # There is another daemon that handles the messages. Just publish
+        # the message. The user is already refreshed in the cache.
+        cache.publish(viber_request.sender.id, options['execute'],
+                      destination=destination,
+                      name=viber_request.sender.name,
+                      message_type='execute',
+                      output_format=options['output_format'],
+                      command=command)
+    else:
+        # Viber bot API expects responses to be quick. The local command
+        # might take longer that allowed, so execute them in the command
+        # pool. The answer is sent when the command is ready.
+        try:
+            command_pool.submit(
+                command, options['max_concurrency'], command_thread_target,
+                options['execute'], options['output_format'],
+                viber_request.sender.id, None, options=options)
+        except PoolBusyError as e:
+            logger.warning('Command "%s" from user "%s" rejected: %s',
+                           command, viber_request.sender.name, e)
+            send_message(viber_request.sender.id, BUSY_TEXT)
+
+
+router = CommandRouter()
+router.add_handlers(globals())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+"""
+Scatter-gather answers for multi-host commands
+
+Commands configured with "gather_timeout" and sent to several hosts, e.g.
+"/uptime@host1,host2", get one answer instead of one answer per host. The
+command is published once with the request id. The command executors write
+their outputs to the cache under the request id instead of answering, and
+the bot waits for the outputs until the deadline. The answer groups the hosts
+with identical outputs and lists the hosts that did not answer in time.
+"""
+
+import logging
+from viber_command_bot.cache import cache
+from viber_command_bot.messages import send_message
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds the outputs are kept in the cache after the deadline.
+GATHER_TTL = 60
+
+
+def gather_thread_target(user_id, command, hosts, request_id, timeout):
+    """
+    Wait for the outputs of the hosts in a separate thread, and send the
+    aggregated answer.
+
+    :param user_id: user id who will receive the answer
+    :param command: configured command name
+    :param hosts: list of destination hosts
+    :param request_id: request id of the published command
+    :param timeout: deadline in seconds
+    :return: None
+    :raises Exception: if message sending fails
+    """
+    outputs = cache.gather(request_id, hosts, timeout)
+    send_message(user_id, aggregate(command, hosts, outputs))
+
+
+def aggregate(command, hosts, outputs):
+    """
+    Create one answer from the outputs of the hosts.
+
+    :param command: configured command name
+    :param hosts: list of destination hosts
+    :param outputs: dict {host: output text}
+    :return: answer text
+    """
+    groups = dict()
+    for host in hosts:
+        if host in outputs:
+            groups.setdefault(outputs[host], list()).append(host)
+    missing = [host for host in hosts if host not in outputs]
+    lines = ['/{}: {} of {} hosts answered'.format(
+        command, len(hosts) - len(missing), len(hosts))]
+    # Largest groups first, so that the common output is on top.
+    for output, group in sorted(groups.items(),
+                                key=lambda item: -len(item[1])):
+        lines.append('')
+        lines.append('{}:'.format(', '.join(group)))
+        lines.append(output)
+    if missing:
+        lines.append('')
+        lines.append('No answer: {}'.format(', '.join(missing)))
+    return '\n'.join(lines)
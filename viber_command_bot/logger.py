@@ -0,0 +1,213 @@
+"""
+Viber bot logging configuration
+
+The log records are put to a queue, and a listener thread writes them to
+syslog, file and stdout, so that a slow log destination does not slow down
+the webhook. The listener thread is started in each process when the first
+record is logged, because uWSGI workers are forked after the handlers are
+installed.
+
+Importing the module does not install the handlers. The scripts and the bot
+applications call init_logging() after the configuration is initialized.
+"""
+
+import atexit
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from viber_command_bot.config import config
+from viber_command_bot.tracing import current_request_id
+
+
+# Number of debug messages whose records are counted for sampling.
+MAX_SAMPLE_MESSAGES = 1024
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds the request id of the current trace to the log records
+    """
+
+    def filter(self, record):
+        record.request_id = current_request_id()
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """
+    Passes one of every N debug records of each message, and all records of
+    the other levels
+
+    The counters of the least recently logged messages are dropped, when
+    there are more than MAX_SAMPLE_MESSAGES of them, so that the messages
+    created from variable data do not grow the counters without limit.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.counters = collections.OrderedDict()
+        self.counters_lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate == 1 or record.levelno != logging.DEBUG:
+            return True
+        with self.counters_lock:
+            count = self.counters.pop(record.msg, 0)
+            self.counters[record.msg] = count + 1
+            if len(self.counters) > MAX_SAMPLE_MESSAGES:
+                self.counters.popitem(last=False)
+        return count % self.rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats the log records as JSON objects
+    """
+
+    def __init__(self, prefix=''):
+        super().__init__()
+        self.prefix = prefix
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'level': record.levelname,
+                'logger': record.name, 'message': record.getMessage()}
+        request_id = getattr(record, 'request_id', None)
+        if request_id is not None:
+            data['request_id'] = request_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return self.prefix + json.dumps(data, default=str)
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """
+    Puts the log records to a queue, which is emptied by a listener thread
+    """
+
+    def __init__(self, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self.listener = None
+        self.pid = None
+
+    def prepare(self, record):
+        """
+        The message is formatted by the listener thread. Only the exception
+        is formatted here, while the traceback is still valid.
+
+        :param record: log record
+        :return: log record
+        """
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put_nowait(record)
+
+    def start(self):
+        """
+        Start the listener thread in this process. The handler lock is held
+        while the records are emitted, so the thread is started only once.
+
+        :return: None
+        """
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        """
+        Write the queued records and stop the listener thread.
+
+        :return: None
+        """
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+
+
+def create_formatter(log_format, prefix, text_format):
+    """
+    Create formatter for a log destination.
+
+    :param log_format: configured log format, "text" or "json"
+    :param prefix: text before the JSON record
+    :param text_format: format of the text records
+    :return: Formatter object
+    """
+    if log_format == 'json':
+        return JsonFormatter(prefix)
+    return logging.Formatter(text_format)
+
+
+def create_handlers():
+    """
+    Create the log handlers of the bot configuration.
+
+    :return: list of handlers
+    """
+    log_format = config.get('Logger', 'format', fallback='text').lower()
+    handlers = list()
+    if config.getboolean('Logger', 'syslog', fallback=True):
+        handler = logging.handlers.SysLogHandler(address='/dev/log')
+        handler.setFormatter(create_formatter(
+            log_format, 'viber-bot: ',
+            'viber-bot: %(levelname)s: %(message)s'))
+        handlers.append(handler)
+    log_file = config.get('Logger', 'file', fallback=None)
+    if log_file:
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(create_formatter(
+            log_format, '',
+            '%(asctime)s: %(levelname)s: %(name)s: %(message)s'))
+        handlers.append(handler)
+    if config.getboolean('Logger', 'stdout', fallback=False):
+        handler = logging.StreamHandler()
+        handler.setFormatter(create_formatter(
+            log_format, '',
+            '%(asctime)s: %(levelname)s: %(name)s: %(message)s'))
+        handlers.append(handler)
+    if config.getboolean('Logger', 'queue', fallback=True) and handlers:
+        handlers = [QueueLogHandler(handlers)]
+        atexit.register(handlers[0].stop)
+    return handlers
+
+
+def init_logging():
+    """
+    Install the configured log handlers to the root logger. The handlers are
+    installed only once; later calls return the root logger.
+
+    :return: root logger
+    """
+    global initialized
+    with init_lock:
+        if initialized:
+            return logger
+        logger.setLevel(config.get('Logger', 'level',
+                                   fallback='INFO').upper())
+        debug_sample = config.getint('Logger', 'debug_sample', fallback=1)
+        for handler in create_handlers():
+            # Filters are run in the thread that logs the record.
+            handler.addFilter(SampleFilter(debug_sample))
+            handler.addFilter(RequestIdFilter())
+            logger.addHandler(handler)
+        initialized = True
+    return logger
+
+
+logger = logging.getLogger()
+initialized = False
+init_lock = threading.Lock()
@@ -4,51 +4,153 @@ Utility functions for Viber bot messages
 
 from viber_command_bot.cache import cache
 from viber_command_bot.config import config
-from viber_command_bot.viber import viber
+from viber_command_bot.outbound import outbound
 from viberbot.api.messages import URLMessage
 from viberbot.api.messages.text_message import TextMessage
 
 
 MAX_TEXT_MESSAGE_SIZE = 7000  # Limit in Viber API
-NUMBER_OF_TEXT_MESSAGES = 20
+NUMBER_OF_TEXT_MESSAGES = 100
 MAX_TEXT_SIZE = NUMBER_OF_TEXT_MESSAGES * MAX_TEXT_MESSAGE_SIZE
 
+# Room left in the last message of a page for the "/more" notice.
+MORE_NOTICE_SIZE = 100
 
-def create_text_message_list(text):
+
+def text_chunks(text, size=MAX_TEXT_MESSAGE_SIZE):
+    """
+    Split text lazily into chunks that fit in one text message. The text is
+    split on line boundaries, and lines longer than the chunk are split on
+    character boundaries. The chunks are consecutive slices of the text.
+
+    :param text: original text
+    :param size: maximum size of the chunk in UTF-8 bytes
+    :return: generator yielding the chunks
     """
-    Split text into a list of text messages. Also, limit the number of the
-    text messages.
+    chunk = list()
+    length = 0
+    for line in text.splitlines(keepends=True):
+        line_length = len(line.encode())
+        if chunk and length + line_length > size:
+            yield ''.join(chunk)
+            chunk = list()
+            length = 0
+        while line_length > size:
+            head = line.encode()[:size].decode(errors='ignore')
+            yield head
+            line = line[len(head):]
+            line_length = len(line.encode())
+        if line:
+            chunk.append(line)
+            length += line_length
+    if chunk:
+        yield ''.join(chunk)
+
+
+def text_pages(text, messages=1):
+    """
+    Split text lazily into pages of text message chunks. Only the pages that
+    are consumed are split.
 
     :param text: original text
-    :return: list of TextMessage objects
+    :param messages: number of text messages on a page
+    :return: generator yielding lists of chunks
+    """
+    page = list()
+    for chunk in text_chunks(text, MAX_TEXT_MESSAGE_SIZE - MORE_NOTICE_SIZE):
+        page.append(chunk)
+        if len(page) >= messages:
+            yield page
+            page = list()
+    if page:
+        yield page
+
+
+def create_text_message_list(text, all_pages=False):
+    """
+    Create the text messages of the first page of the text. The rest of the
+    text is returned, so that it can be sent with the "/more" command.
+
+    :param text: original text
+    :param all_pages: create the messages of all the pages, so that there
+                      is no rest of the text
+    :return: tuple (list of TextMessage objects, rest of the text)
     """
     messages = list()
     if not text:
-        return messages
-    truncated_text = text[:MAX_TEXT_SIZE]
-    for chunk in [truncated_text[i:i + MAX_TEXT_MESSAGE_SIZE] for i in range(
-            0, len(truncated_text), MAX_TEXT_MESSAGE_SIZE)]:
-        messages.append(TextMessage(text=chunk))
-    if truncated_text != text:
-        messages.append(TextMessage(text='<truncated>'))
-    return messages
+        return messages, ''
+    if all_pages:
+        for chunk in text_chunks(text):
+            messages.append(TextMessage(text=chunk.rstrip('\n') or chunk))
+        return messages, ''
+    page = next(text_pages(text, config.getint(
+        'Outbound', 'page_messages', fallback=1)))
+    rest = text[sum(len(chunk) for chunk in page):]
+    if rest:
+        page[-1] = '{}\n<{} characters more, send "/more">'.format(
+            page[-1].rstrip('\n'), len(rest))
+    for chunk in page:
+        messages.append(TextMessage(text=chunk.rstrip('\n') or chunk))
+    return messages, rest
 
 
-def send_message(user_id, text, media=None):
+def send_message(user_id, text, media=None, wait=False, all_pages=False):
     """
-    Send text message.
+    Send text message. The message is queued to the outbound queue, unless
+    the caller wants to wait until the message has been sent.
 
     :param user_id: viber user id who will receive the message
     :param text: text to send
     :param media: URL to media file
+    :param wait: wait until the message has been sent
+    :param all_pages: send all the pages of the text instead of storing the
+                      rest for the "/more" command, e.g. when there is no
+                      user to send it
     :return: None
-    :raises Exception: if message sending fails
+    :raises Exception: if message sending fails and wait is True
     """
     if not config.getboolean('Viber', 'command_executor', fallback=False):
         # External command executor daemon is not used.
         # Publish the answer message.
         cache.publish(user_id, text, media=media)
-    messages = create_text_message_list(text)
+    send_page(user_id, text, media=media, wait=wait, all_pages=all_pages)
+
+
+def send_more(user_id):
+    """
+    Send the next page of the text that did not fit in the previous
+    message.
+
+    :param user_id: viber user id who will receive the message
+    :return: True, if there was text left to send
+    """
+    text = cache.pop_more(user_id)
+    if not text:
+        return False
+    send_page(user_id, text)
+    return True
+
+
+def send_page(user_id, text, media=None, wait=False, all_pages=False):
+    """
+    Send the first page of the text. The rest of the text is stored in the
+    cache for the "/more" command.
+
+    :param user_id: viber user id who will receive the message
+    :param text: text to send
+    :param media: URL to media file
+    :param wait: wait until the message has been sent
+    :param all_pages: send all the pages of the text
+    :return: None
+    :raises Exception: if message sending fails and wait is True
+    """
+    messages, rest = create_text_message_list(text, all_pages=all_pages)
+    if rest:
+        cache.set_more(user_id, rest, config.getint(
+            'Outbound', 'page_ttl', fallback=600))
     if media is not None:
         messages.append(URLMessage(media=media))
-    viber.send_messages(user_id, messages)
+    if wait or not config.getboolean('Outbound', 'queue', fallback=True):
+        outbound.send_now(user_id, messages)
+    else:
+        outbound.send(user_id, messages)
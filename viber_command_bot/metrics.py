@@ -0,0 +1,485 @@
+"""
+Metrics of the bot in Prometheus text format
+
+Metrics are recorded to per-thread shards, so that recording does not take
+locks. Each process writes a snapshot of its metrics to the metrics
+directory periodically, and the metrics endpoint sums the snapshots of all
+the processes on the host: the uWSGI workers and the command executor.
+
+Metrics are not recorded unless they are enabled in the configuration.
+"""
+
+import atexit
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from viber_command_bot.config import add_init_listener
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Metric name: (type, help text, histogram buckets)
+METRICS = {
+    'viber_webhook_latency_seconds': (
+        'histogram', 'Webhook request latency by event type.',
+        LATENCY_BUCKETS),
+    'viber_command_queue_wait_seconds': (
+        'histogram', 'Time commands wait in the queue before execution.',
+        LATENCY_BUCKETS),
+    'viber_command_runtime_seconds': (
+        'histogram', 'Runtime of the command processes.', LATENCY_BUCKETS),
+    'viber_command_exit_total': (
+        'counter', 'Command process exit codes.', None),
+    'viber_command_output_bytes_total': (
+        'counter', 'Bytes of command output read.', None),
+    'viber_redis_latency_seconds': (
+        'histogram', 'Latency of the Redis commands and pipelines.',
+        LATENCY_BUCKETS),
+    'viber_send_latency_seconds': (
+        'histogram', 'Latency of the Viber API send requests.',
+        LATENCY_BUCKETS),
+    'viber_send_failures_total': (
+        'counter', 'Messages that could not be sent to the Viber API.', None),
+    'viber_rate_limited_total': (
+        'counter', 'Commands rejected by the user and command rate limits.',
+        None),
+    'viber_threads': (
+        'gauge', 'Active threads.', None),
+    'viber_pool_running': (
+        'gauge', 'Commands running in the command pool.', None),
+    'viber_pool_queue_depth': (
+        'gauge', 'Commands queued in the command pool.', None),
+}
+
+# Webhook events that get their own label value.
+WEBHOOK_EVENTS = ['message', 'delivered', 'seen', 'failed', 'subscribed',
+                  'unsubscribed', 'conversation_started', 'webhook']
+
+ARCHIVE = 'archive.json'
+
+
+class Metrics(object):
+    """
+    Class for recording and exposing the metrics
+    """
+
+    def __init__(self, enabled=False, directory=None, flush_interval=10.0,
+                 port=0, address=''):
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.port = port
+        self.address = address
+        self.collectors = list()
+        self.lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """
+        Forget the metrics of the parent process after fork.
+        """
+        self.local = threading.local()
+        self.shards = list()
+        self.thread = None
+        self.server = None
+        self.pid = os.getpid()
+
+    def _shard(self):
+        """
+        Get the metrics shard of the current thread.
+        """
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = dict()
+            with self.lock:
+                self.shards.append(shard)
+                self._start_writer()
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment counter.
+
+        :param name: metric name
+        :param value: increment
+        :param labels: metric labels
+        :return: None
+        """
+        if not self.enabled:
+            return
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Record value to histogram.
+
+        :param name: metric name
+        :param value: observed value
+        :param labels: metric labels
+        :return: None
+        """
+        if not self.enabled:
+            return
+        buckets = METRICS[name][2]
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        counts = shard.get(key)
+        if counts is None:
+            # Bucket counts, +Inf bucket, sum and count.
+            counts = shard[key] = [0] * (len(buckets) + 3)
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Context for recording the duration of a block to histogram. The
+        labels dict is yielded, so that the block can set the labels.
+
+        :param name: metric name
+        :param labels: metric labels
+        :return: context manager
+        """
+        if not self.enabled:
+            yield labels
+            return
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        """
+        Add function that returns gauge values when the metrics are
+        collected.
+
+        :param collector: callable returning list of tuples (name, labels
+                          dict, value)
+        :return: None
+        """
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """
+        Get the metrics of this process.
+
+        :return: dict {(name, labels): value}
+        """
+        with self.lock:
+            shards = list(self.shards)
+        values = dict()
+        for shard in shards:
+            merge(values, dict(shard))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                values[(name, tuple(sorted(labels.items())))] = value
+        return values
+
+    def flush(self):
+        """
+        Write the snapshot of this process to the metrics directory.
+
+        :return: None
+        """
+        if not self.enabled or not self.directory:
+            return
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            write_values(path, self.snapshot())
+        except OSError as e:
+            logger.error('Failed to write metrics: %s', e)
+
+    def collect(self):
+        """
+        Get the metrics of all the processes.
+
+        :return: dict {(name, labels): value}
+        """
+        values = self.snapshot()
+        if not self.directory:
+            return values
+        with self.directory_lock():
+            archive = os.path.join(self.directory, ARCHIVE)
+            archived = read_values(archive)
+            compact = False
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == archive:
+                    continue
+                try:
+                    pid = int(os.path.basename(path)[:-len('.json')])
+                except ValueError:
+                    continue
+                if pid == os.getpid():
+                    continue
+                if process_alive(pid):
+                    merge(values, read_values(path))
+                else:
+                    # Counters of the exited processes are kept in the
+                    # archive, so that the totals do not go down.
+                    merge(archived, read_values(path), gauges=False)
+                    os.unlink(path)
+                    compact = True
+            if compact:
+                write_values(archive, archived)
+            merge(values, archived, gauges=False)
+        return values
+
+    @contextlib.contextmanager
+    def directory_lock(self):
+        """
+        Context for locking the metrics directory between the processes.
+        """
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def render(self):
+        """
+        Render the metrics of all the processes in Prometheus text format.
+
+        :return: metrics text
+        """
+        values = self.collect()
+        lines = list()
+        for name in sorted(METRICS):
+            kind, help_text, buckets = METRICS[name]
+            series = sorted((labels, value) for (n, labels), value in
+                            values.items() if n == name)
+            if not series:
+                continue
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, format_labels(labels),
+                                                  format_value(value)))
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets + ['+Inf'], value[:-2]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (
+                            ('le', format_value(le)),)), cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, format_labels(labels), format_value(value[-2])))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self):
+        """
+        Serve the metrics from the configured port, if the metrics are
+        enabled and the port is configured. The server is started in the
+        process that serves the requests, so that it survives uWSGI fork, and
+        the processes on the host share the port.
+
+        :return: None
+        """
+        if not self.enabled or not self.port or self.server is not None:
+            return
+        with self.lock:
+            if self.server is not None:
+                return
+            try:
+                self.server = self.serve(self.port, self.address)
+            except OSError as e:
+                self.server = False
+                logger.error('Could not serve metrics from port %s: %s',
+                             self.port, e)
+
+    def serve(self, port, address=''):
+        """
+        Serve the metrics over HTTP in a background thread.
+
+        :param port: TCP port
+        :param address: listen address
+        :return: HTTP server
+        """
+        import http.server
+        metrics = self
+
+        class Server(http.server.ThreadingHTTPServer):
+            allow_reuse_port = True
+            daemon_threads = True
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = Server((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name='metrics-server').start()
+        return server
+
+    def _start_writer(self):
+        """
+        Start the thread that writes the snapshots, if it is not running.
+        Must be called with the lock held.
+        """
+        if not self.directory or self.flush_interval <= 0:
+            return
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._writer, daemon=True,
+                                           name='metrics-writer')
+            self.thread.start()
+
+    def _writer(self):
+        """
+        Writer thread writes the snapshot of this process periodically.
+        """
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+def merge(values, other, gauges=True):
+    """
+    Add metric values to the values.
+
+    :param values: dict {(name, labels): value}, updated
+    :param other: dict {(name, labels): value}
+    :param gauges: merge also the gauges
+    :return: None
+    """
+    for key, value in other.items():
+        if not gauges and METRICS.get(key[0], ('gauge',))[0] == 'gauge':
+            continue
+        current = values.get(key)
+        if current is None:
+            values[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(current, list):
+            for i, v in enumerate(value):
+                current[i] += v
+        else:
+            values[key] = current + value
+
+
+def read_values(path):
+    """
+    Read metric values written by write_values().
+    """
+    try:
+        with open(path) as f:
+            return dict(((name, tuple(tuple(l) for l in labels)), value)
+                        for name, labels, value in json.load(f))
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_values(path, values):
+    """
+    Write metric values atomically.
+    """
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump([[name, labels, value] for (name, labels), value in
+                   values.items()], f)
+    os.rename(tmp, path)
+
+
+def process_alive(pid):
+    """
+    Check if the process is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for k, v in labels))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def webhook_event(event):
+    """
+    Get the label value for the webhook event type.
+
+    :param event: event type from the request
+    :return: label value
+    """
+    return event if event in WEBHOOK_EVENTS else 'other'
+
+
+def default_directory(port):
+    """
+    Get the metrics directory of the processes that share the metrics port.
+
+    :param port: metrics port
+    :return: directory path
+    """
+    return os.path.join(tempfile.gettempdir(),
+                        'viber-command-bot-metrics-{}-{}'.format(
+                            os.getuid(), port))
+
+
+def thread_count():
+    return [('viber_threads', dict(), threading.active_count())]
+
+
+def configure_metrics(config):
+    """
+    Configure the metrics from the bot configuration.
+
+    :param config: bot configuration
+    :return: None
+    """
+    metrics.enabled = config.getboolean('Metrics', 'enabled', fallback=False)
+    metrics.directory = config.get('Metrics', 'directory', fallback=None)
+    metrics.flush_interval = config.getfloat('Metrics', 'flush_interval',
+                                             fallback=10.0)
+    metrics.port = config.getint('Metrics', 'port', fallback=0)
+    metrics.address = config.get('Metrics', 'address', fallback='')
+    if metrics.port and not metrics.directory:
+        # The processes share the port, so each of them must answer with
+        # the metrics of all of them.
+        metrics.directory = default_directory(metrics.port)
+
+
+metrics = Metrics()
+metrics.add_collector(thread_count)
+atexit.register(metrics.flush)
+add_init_listener(configure_metrics)
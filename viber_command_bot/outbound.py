@@ -0,0 +1,311 @@
+"""
+Outbound delivery of Viber bot messages
+
+Messages are queued and sent by a worker thread through a persistent HTTP
+session, so that the webhook does not wait for the Viber API. Sending is
+rate limited, and failed requests are retried with exponential backoff.
+"""
+
+import logging
+import queue
+import random
+import threading
+import time
+
+import requests
+from viber_command_bot.config import add_init_listener, config
+from viber_command_bot.metrics import metrics
+from viber_command_bot.tracing import current_request_id, tracer
+
+
+logger = logging.getLogger(__name__)
+
+SEND_MESSAGE_URL = 'https://chatapi.viber.com/pa/send_message'
+
+# Viber API status codes that are worth retrying: too many requests.
+RETRY_STATUSES = [12]
+
+
+class SendError(Exception):
+    """
+    Viber API did not accept the message.
+    """
+    pass
+
+
+class RetryableSendError(SendError):
+    """
+    Sending failed, but it may succeed later.
+    """
+    pass
+
+
+def create_payload(user_id, message):
+    """
+    Create Viber API payload for sending the message.
+
+    :param user_id: viber user id who will receive the message
+    :param message: viberbot message object
+    :return: payload dict
+    """
+    payload = message.to_dict()
+    payload.update({'receiver': user_id,
+                    'sender': {'name': config.get('Viber', 'name'),
+                               'avatar': config.get('Viber', 'avatar')}})
+    return payload
+
+
+def check_response(status_code, result):
+    """
+    Check the Viber API response to a sent message.
+
+    :param status_code: HTTP status code
+    :param result: response dict, or None if the response is not valid JSON
+    :return: None
+    :raises RetryableSendError: if sending may succeed later
+    :raises SendError: if Viber API does not accept the message
+    """
+    if status_code == 429 or status_code >= 500:
+        raise RetryableSendError('Failed to send message: HTTP status '
+                                 '{}'.format(status_code))
+    if not isinstance(result, dict):
+        raise SendError('Failed to send message: invalid response')
+    if result.get('status') in RETRY_STATUSES:
+        raise RetryableSendError('Failed to send message: {}'.format(
+            result.get('status_message')))
+    if result.get('status') != 0:
+        raise SendError('Failed to send message: {}'.format(
+            result.get('status_message')))
+
+
+def retry_delay(attempt):
+    """
+    Get the exponential backoff delay, with jitter, before retrying.
+
+    :param attempt: number of the failed attempt, 1 is the first
+    :return: delay in seconds
+    """
+    delay = min(30.0, 0.5 * 2 ** (attempt - 1))
+    return delay + random.uniform(0, delay / 2)
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter. Rate 0 means no limit.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = max(0.0, rate)
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token, if a token is available.
+
+        :return: 0 if the token was taken, otherwise the number of seconds
+                 until a token is available
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Wait until a token is available and take it.
+
+        :return: None
+        """
+        while True:
+            delay = self.take()
+            if not delay:
+                return
+            time.sleep(delay)
+
+
+class Outbound(object):
+    """
+    Class for the outbound message queue
+    """
+
+    def __init__(self, queue_size=1000, rate=10.0, burst=10, retries=3,
+                 timeout=10.0, url=SEND_MESSAGE_URL):
+        self.configure(queue_size, rate, burst, retries, timeout, url)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def configure(self, queue_size, rate, burst, retries, timeout, url):
+        """
+        Set the queue size and the sending parameters. Called before the
+        queue is used.
+
+        :param queue_size: number of messages that can wait for sending
+        :param rate: messages per second, 0 is no limit
+        :param burst: number of messages that can be sent at once
+        :param retries: number of retries of a failed request
+        :param timeout: HTTP request timeout in seconds
+        :param url: Viber API send message URL
+        :return: None
+        """
+        self.url = url
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.limiter = RateLimiter(rate, burst)
+        self.retries = retries
+        self.timeout = timeout
+
+    def send(self, user_id, messages):
+        """
+        Queue messages for sending. Messages are sent in the queued order.
+
+        :param user_id: viber user id who will receive the messages
+        :param messages: list of viberbot message objects
+        :return: None
+        """
+        self._start_worker()
+        try:
+            self.queue.put_nowait((user_id, messages, current_request_id()))
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('viber_send_failures_total', len(messages),
+                        reason='dropped')
+            logger.error('Outbound queue is full, dropped %s messages to '
+                         'user id "%s"', len(messages), user_id)
+
+    def send_now(self, user_id, messages):
+        """
+        Send messages and wait until they have been sent.
+
+        :param user_id: viber user id who will receive the messages
+        :param messages: list of viberbot message objects
+        :return: None
+        :raises SendError: if sending fails
+        """
+        for message in messages:
+            self._send(create_payload(user_id, message))
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued messages have been sent.
+
+        :param timeout: maximum time to wait in seconds, None waits forever
+        :return: None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return
+            time.sleep(0.05)
+
+    def _start_worker(self):
+        """
+        Start the worker thread, if it is not running. The thread is started
+        in the process that sends, so that it survives uWSGI fork.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker,
+                                               daemon=True, name='outbound')
+                self.thread.start()
+
+    def _worker(self):
+        """
+        Worker thread sends the queued messages.
+        """
+        while True:
+            user_id, messages, request_id = self.queue.get()
+            try:
+                with tracer.trace('send', request_id=request_id):
+                    self.send_now(user_id, messages)
+            except Exception as e:
+                logger.error('Failed to send message to user id "%s": %s',
+                             user_id, e)
+            finally:
+                self.queue.task_done()
+
+    def _session(self):
+        """
+        Get the HTTP session of the current thread. Sessions keep the
+        connections to the Viber API alive between the requests.
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.headers['X-Viber-Auth-Token'] = config.get(
+                'Viber', 'authentication_token')
+        return session
+
+    def _send(self, payload):
+        """
+        Send one message, retrying with exponential backoff.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                with metrics.timer('viber_send_latency_seconds'), \
+                        tracer.span('viber_api'):
+                    self._post(payload)
+                self.sent += 1
+                return
+            except RetryableSendError as e:
+                attempt += 1
+                if attempt > self.retries:
+                    self.failed += 1
+                    metrics.inc('viber_send_failures_total', reason='error')
+                    raise
+                delay = retry_delay(attempt)
+                logger.warning('%s; retrying in %.1f seconds', e, delay)
+                time.sleep(delay)
+            except SendError:
+                self.failed += 1
+                metrics.inc('viber_send_failures_total', reason='error')
+                raise
+
+    def _post(self, payload):
+        """
+        Post one message to the Viber API.
+        """
+        try:
+            response = self._session().post(self.url, json=payload,
+                                            timeout=self.timeout)
+        except requests.RequestException as e:
+            raise RetryableSendError('Failed to send message: {}'.format(e))
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        check_response(response.status_code, result)
+
+
+def configure_outbound(config):
+    """
+    Configure the outbound queue from the bot configuration.
+
+    :param config: bot configuration
+    :return: None
+    """
+    outbound.configure(
+        queue_size=config.getint('Outbound', 'queue_size', fallback=1000),
+        rate=config.getfloat('Outbound', 'rate', fallback=10.0),
+        burst=config.getint('Outbound', 'burst', fallback=10),
+        retries=config.getint('Outbound', 'retries', fallback=3),
+        timeout=config.getfloat('Outbound', 'timeout', fallback=10.0),
+        url=config.get('Outbound', 'url', fallback=SEND_MESSAGE_URL))
+
+
+outbound = Outbound()
+add_init_listener(configure_outbound)
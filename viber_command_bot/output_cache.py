@@ -0,0 +1,187 @@
+"""
+Command output cache with single-flight execution
+"""
+
+import asyncio
+import collections
+import hashlib
+import socket
+import threading
+import time
+from viber_command_bot.cache import cache
+
+
+CACHE_SCOPES = ['process', 'host', 'global']
+
+
+class _Flight(object):
+    """
+    Command execution that is in progress.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class OutputCache(object):
+    """
+    Class for the command output cache
+
+    Command results are kept in an in-process LRU for the configured time to
+    live. With scope "host" or "global" the results are also shared through
+    Redis with the other workers in the same host or with all the hosts.
+    Concurrent requests for the same command are collapsed so that only one
+    of them executes the command and the others wait for its result.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.flights = dict()
+        self.async_flights = dict()
+        self.lock = threading.Lock()
+
+    def get(self, execute, ttl, run, scope='process'):
+        """
+        Get command result from the cache, or run the command.
+
+        :param execute: command to be executed, used as the cache key
+        :param ttl: time to live of the result in seconds, 0 disables caching
+                    but concurrent requests are still collapsed
+        :param run: callable that executes the command and returns a tuple
+                    (return code, output text); only successful results
+                    (return code 0) are cached
+        :param scope: process | host | global
+        :return: tuple (return code, output text)
+        """
+        key = self.key(execute, scope)
+        with self.lock:
+            result = self.get_local(key)
+            if result is not None:
+                return result
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            flight.event.wait()
+            if flight.result is None:
+                # The leader failed, run the command ourselves.
+                return run()
+            return flight.result
+        try:
+            result = None
+            if ttl > 0 and scope != 'process':
+                output = cache.get_output(key)
+                if output is not None:
+                    result = (0, output)
+            if result is None:
+                result = run()
+                if ttl > 0 and result[0] == 0 and scope != 'process':
+                    cache.set_output(key, result[1], ttl)
+            flight.result = result
+        finally:
+            with self.lock:
+                if ttl > 0 and flight.result is not None and \
+                        flight.result[0] == 0:
+                    self.set_local(key, flight.result, ttl)
+                del self.flights[key]
+            flight.event.set()
+        return result
+
+    async def get_async(self, execute, ttl, run, scope='process',
+                        shared=None):
+        """
+        Get command result from the cache, or run the command, in the event
+        loop of the ASGI application. See get(). Concurrent requests in the
+        event loop are collapsed; if the execution fails, the waiting
+        requests run the command themselves.
+
+        :param execute: command to be executed, used as the cache key
+        :param ttl: time to live of the result in seconds
+        :param run: coroutine function that executes the command and returns
+                    a tuple (return code, output text)
+        :param scope: process | host | global
+        :param shared: asynchronous cache for the scopes host and global
+        :return: tuple (return code, output text)
+        """
+        key = self.key(execute, scope)
+        with self.lock:
+            result = self.get_local(key)
+        if result is not None:
+            return result
+        flight = self.async_flights.get(key)
+        if flight is not None:
+            result = await asyncio.shield(flight)
+            if result is None:
+                # The leader failed, run the command ourselves.
+                return await run()
+            return result
+        flight = self.async_flights[key] = \
+            asyncio.get_running_loop().create_future()
+        try:
+            if ttl > 0 and scope != 'process':
+                output = await shared.get_output(key)
+                if output is not None:
+                    result = (0, output)
+            if result is None:
+                result = await run()
+                if ttl > 0 and result[0] == 0 and scope != 'process':
+                    await shared.set_output(key, result[1], ttl)
+        finally:
+            if ttl > 0 and result is not None and result[0] == 0:
+                with self.lock:
+                    self.set_local(key, result, ttl)
+            del self.async_flights[key]
+            # The waiters get None, if the execution failed.
+            flight.set_result(result)
+        return result
+
+    def get_local(self, key):
+        """
+        Get fresh result from the LRU. Must be called with the lock held.
+
+        :param key: cache key
+        :return: tuple (return code, output text), or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return result
+
+    def set_local(self, key, result, ttl):
+        """
+        Add result to the LRU. Must be called with the lock held.
+
+        :param key: cache key
+        :param result: tuple (return code, output text)
+        :param ttl: time to live in seconds
+        :return: None
+        """
+        self.entries[key] = (time.monotonic() + ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def key(execute, scope):
+        """
+        Create cache key for the command.
+
+        :param execute: command to be executed
+        :param scope: process | host | global
+        :return: cache key
+        """
+        digest = hashlib.sha1(execute.encode()).hexdigest()
+        if scope == 'global':
+            return digest
+        return '{}:{}'.format(socket.gethostname(), digest)
+
+
+output_cache = OutputCache()
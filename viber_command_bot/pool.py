@@ -0,0 +1,172 @@
+"""
+Bounded pool of worker threads for executing bot commands
+"""
+
+import contextvars
+import logging
+import queue
+import threading
+import time
+from viber_command_bot.config import add_init_listener
+from viber_command_bot.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolBusyError(Exception):
+    """
+    Command could not be queued because the pool is full.
+    """
+    pass
+
+
+class CommandPool(object):
+    """
+    Class for the command pool
+
+    Commands are queued to a bounded queue and executed by a fixed number of
+    worker threads. The worker threads are started when the first command is
+    submitted, so that they are created in the uWSGI worker process and not
+    in the master process before fork.
+    """
+
+    def __init__(self, workers=4, queue_size=20):
+        self.configure(workers, queue_size)
+        self.lock = threading.Lock()
+        self.threads = list()
+        self.pending = dict()
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def configure(self, workers, queue_size):
+        """
+        Set the pool size. Called before the pool is used.
+
+        :param workers: number of worker threads
+        :param queue_size: number of commands that can wait for a worker
+        :return: None
+        """
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+
+    def submit(self, name, limit, target, *args, **kwargs):
+        """
+        Submit command to the pool.
+
+        :param name: command name, used for per-command concurrency limit
+        :param limit: maximum number of queued or running executions of the
+                      command, None or 0 means no limit
+        :param target: callable to execute
+        :param args: positional arguments for the callable
+        :param kwargs: keyword arguments for the callable
+        :return: None
+        :raises PoolBusyError: if the queue or the command limit is full
+        """
+        with self.lock:
+            self._start_workers()
+            if limit and self.pending.get(name, 0) >= limit:
+                self.rejected += 1
+                raise PoolBusyError('Command "{}" has already {} executions '
+                                    'pending'.format(name, limit))
+            try:
+                # The command runs in the context of the submitter, so
+                # that it has the same request id.
+                self.queue.put_nowait((name, time.monotonic(),
+                                       contextvars.copy_context(), target,
+                                       args, kwargs))
+            except queue.Full:
+                self.rejected += 1
+                raise PoolBusyError('Command queue is full ({} '
+                                    'commands)'.format(self.queue.maxsize))
+            self.pending[name] = self.pending.get(name, 0) + 1
+            self.submitted += 1
+
+    def stats(self):
+        """
+        Get pool statistics.
+
+        :return: dict with pool statistics
+        """
+        with self.lock:
+            return {'workers': self.workers,
+                    'queue_size': self.queue.maxsize,
+                    'queue_depth': self.queue.qsize(),
+                    'running': self.running,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'rejected': self.rejected,
+                    'wait_avg': (self.wait_total / self.completed
+                                 if self.completed else 0.0),
+                    'wait_max': self.wait_max}
+
+    def gauges(self):
+        """
+        Get pool gauges for the metrics.
+
+        :return: list of tuples (name, labels, value)
+        """
+        return [('viber_pool_running', dict(), self.running),
+                ('viber_pool_queue_depth', dict(), self.queue.qsize())]
+
+    def _start_workers(self):
+        """
+        Start the worker threads, if they are not running. Must be called
+        with the lock held.
+        """
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True,
+                                      name='command-pool-{}'.format(
+                                          len(self.threads)))
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        """
+        Worker thread executes the queued commands.
+        """
+        while True:
+            name, queued, context, target, args, kwargs = self.queue.get()
+            wait = time.monotonic() - queued
+            with self.lock:
+                self.running += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            logger.debug('Command "%s" waited %.3f seconds in queue', name,
+                         wait)
+            metrics.observe('viber_command_queue_wait_seconds', wait,
+                            command=name)
+            try:
+                context.run(target, *args, **kwargs)
+            except Exception as e:
+                logger.error('Command "%s" failed: %s', name, e)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.pending[name] -= 1
+                    if not self.pending[name]:
+                        del self.pending[name]
+                self.queue.task_done()
+
+
+def configure_pool(config):
+    """
+    Configure the command pool from the bot configuration.
+
+    :param config: bot configuration
+    :return: None
+    """
+    command_pool.configure(
+        workers=config.getint('Pool', 'workers', fallback=4),
+        queue_size=config.getint('Pool', 'queue_size', fallback=20))
+
+
+command_pool = CommandPool()
+metrics.add_collector(command_pool.gauges)
+add_init_listener(configure_pool)
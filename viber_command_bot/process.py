@@ -0,0 +1,172 @@
+"""
+Execution of local commands with bounded output and resource limits
+
+The command output is read incrementally. The command is killed, with all
+the processes it has started, when the output exceeds the output limit or
+the command runs longer than the timeout.
+"""
+
+import asyncio
+import collections
+import os
+import selectors
+import signal
+import subprocess
+import time
+
+
+# Maximum number of bytes read from the standard error.
+MAX_ERROR_SIZE = 4096
+READ_SIZE = 65536
+
+CommandResult = collections.namedtuple(
+    'CommandResult', ['returncode', 'output', 'error', 'truncated',
+                      'timed_out'])
+
+
+def command_line(execute, cpu_time=None, memory=None):
+    """
+    Create shell command line with resource limits.
+
+    :param execute: command to be executed
+    :param cpu_time: maximum CPU time in seconds, or None
+    :param memory: maximum virtual memory in bytes, or None
+    :return: shell command line
+    """
+    limits = list()
+    if cpu_time:
+        limits.append('ulimit -t {}'.format(int(cpu_time)))
+    if memory:
+        limits.append('ulimit -v {}'.format(max(1, int(memory) // 1024)))
+    if not limits:
+        return execute
+    return '{}; {}'.format('; '.join(limits), execute)
+
+
+def kill(p):
+    """
+    Kill the process group of the command.
+
+    :param p: Popen object or asyncio Process
+    :return: None
+    """
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_command(execute, max_output, timeout=None, cpu_time=None,
+                memory=None):
+    """
+    Run command in a new process group and read its output.
+
+    :param execute: command to be executed through shell
+    :param max_output: maximum number of output bytes read
+    :param timeout: timeout in seconds, or None
+    :param cpu_time: maximum CPU time in seconds, or None
+    :param memory: maximum virtual memory in bytes, or None
+    :return: CommandResult
+    """
+    p = subprocess.Popen(command_line(execute, cpu_time, memory),
+                         stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, shell=True,
+                         start_new_session=True)
+    deadline = None if not timeout else time.monotonic() + timeout
+    buffers = {p.stdout: bytearray(), p.stderr: bytearray()}
+    limits = {p.stdout: max_output, p.stderr: MAX_ERROR_SIZE}
+    truncated = timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for f in buffers:
+            selector.register(f, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+            for key, _ in selector.select(remaining):
+                data = os.read(key.fd, READ_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                # Output beyond the limit is discarded.
+                buf = buffers[key.fileobj]
+                buf += data[:max(0, limits[key.fileobj] - len(buf))]
+                if key.fileobj is p.stdout and len(buf) >= max_output:
+                    truncated = True
+                    break
+            if truncated:
+                break
+    if not truncated and not timed_out:
+        # Command may have closed its output and still be running.
+        try:
+            p.wait(None if deadline is None
+                   else max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+    if truncated or timed_out:
+        kill(p)
+    p.stdout.close()
+    p.stderr.close()
+    p.wait()
+    return CommandResult(p.returncode, bytes(buffers[p.stdout]),
+                         bytes(buffers[p.stderr]), truncated, timed_out)
+
+
+async def run_command_async(execute, max_output, timeout=None, cpu_time=None,
+                            memory=None):
+    """
+    Run command in a new process group and read its output asynchronously.
+    See run_command() for the parameters.
+
+    :return: CommandResult
+    """
+    p = await asyncio.create_subprocess_shell(
+        command_line(execute, cpu_time, memory),
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    deadline = None if not timeout else time.monotonic() + timeout
+    output = bytearray()
+    error = bytearray()
+    truncated = timed_out = False
+
+    async def read_output():
+        nonlocal truncated
+        while len(output) < max_output:
+            data = await p.stdout.read(READ_SIZE)
+            if not data:
+                return
+            output.extend(data[:max_output - len(output)])
+        truncated = True
+
+    async def read_error():
+        # The rest is drained, so that the command does not block.
+        while True:
+            data = await p.stderr.read(READ_SIZE)
+            if not data:
+                return
+            error.extend(data[:MAX_ERROR_SIZE - len(error)])
+
+    error_task = asyncio.ensure_future(read_error())
+    try:
+        await asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+    if not truncated and not timed_out:
+        # Command may have closed its output and still be running.
+        try:
+            await asyncio.wait_for(p.wait(), None if deadline is None
+                                   else max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            timed_out = True
+    if truncated or timed_out:
+        kill(p)
+    try:
+        await asyncio.wait_for(error_task, 1)
+    except asyncio.TimeoutError:
+        pass
+    await p.wait()
+    return CommandResult(p.returncode, bytes(output), bytes(error),
+                         truncated, timed_out)
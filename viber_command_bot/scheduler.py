@@ -0,0 +1,141 @@
+"""
+Refresh-ahead scheduler for slow commands
+
+Commands configured with "refresh_interval" are run in the background on the
+interval, and the latest output is stored in the cache with the time of the
+refresh. The command is then answered immediately from the stored output.
+The scheduler runs in the command executor daemon, and in the Flask and
+ASGI applications when the command executor is not used. The outputs are
+stored per host. The processes of each host take turns through a lock in
+Redis, so that each command is run once per interval in each host.
+
+If the command has an "alert" rule, the notify user gets a message when the
+output of a host starts to match the rule, and another one when it does not
+match any more.
+"""
+
+import logging
+import socket
+import threading
+import time
+from viber_command_bot.cache import cache
+from viber_command_bot.commands import alert_lines, process_options
+from viber_command_bot.commands import refresh_commands
+from viber_command_bot.config import config
+from viber_command_bot.executor import run_local_command
+from viber_command_bot.messages import send_message
+from viber_command_bot.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the checks for the commands to refresh.
+TICK = 1.0
+
+
+class RefreshScheduler(object):
+    """
+    Class for refreshing the command outputs ahead of the requests
+    """
+
+    def __init__(self):
+        self.next_run = dict()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the scheduler thread, if it is not running and there are
+        commands to refresh.
+
+        :return: None
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if not refresh_commands():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='refresh-scheduler')
+                self.thread.start()
+
+    def run(self):
+        """
+        Scheduler thread refreshes the commands whose interval has passed.
+        The commands are refreshed one at a time.
+        """
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error('Failed to refresh commands: %s', e)
+            time.sleep(TICK)
+
+    def tick(self, now=None):
+        """
+        Refresh the commands whose interval has passed.
+
+        :param now: monotonic time, default is now
+        :return: None
+        """
+        if now is None:
+            now = time.monotonic()
+        for options in refresh_commands():
+            name = options['name']
+            if self.next_run.get(name, 0) > now:
+                continue
+            self.next_run[name] = now + options['refresh_interval']
+            if cache.lock_refresh(name, options['refresh_interval']):
+                with tracer.trace('refresh'):
+                    self.refresh(options)
+
+    @staticmethod
+    def refresh(options):
+        """
+        Run the command and store the output.
+
+        :param options: dict with the command options
+        :return: None
+        """
+        name = options['name']
+        rc, output = run_local_command(options['execute'], command=name,
+                                       **process_options(options))
+        if rc != 0:
+            logger.error('Failed to refresh command "%s": %s', name, output)
+            return
+        # The output is answered until two refreshes have been missed.
+        cache.set_refreshed(name, output, time.time(),
+                            2 * options['refresh_interval'])
+        if options['alert'] is not None:
+            check_alert(name, options['alert'], output)
+
+
+def check_alert(name, rule, output):
+    """
+    Notify the notify user when the alert of the command starts or stops.
+
+    :param name: configured command name
+    :param rule: alert rule of the command
+    :param output: command output
+    :return: None
+    """
+    lines = alert_lines(rule, output)
+    was_firing = cache.swap_alert(name, bool(lines))
+    host = socket.gethostname()
+    if lines and not was_firing:
+        text = 'ALERT: "/{}" output on {} matches the alert rule:\n\n' \
+               '{}'.format(name, host, '\n'.join(lines))
+    elif was_firing and not lines:
+        text = 'RESOLVED: "/{}" output on {} does not match the alert rule ' \
+               'any more.'.format(name, host)
+    else:
+        return
+    logger.warning(text)
+    try:
+        send_message(config.get('Viber', 'notify_user_id'), text)
+    except Exception as e:
+        logger.error('Failed to send alert of command "%s": %s', name, e)
+
+
+refresh_scheduler = RefreshScheduler()
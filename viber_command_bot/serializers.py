@@ -0,0 +1,299 @@
+"""
+Serializers for the messages published through the cache
+
+The default serializer uses a compact, schema versioned binary encoding:
+
+    magic (1 byte) | version (1 byte) | field 1 | field 2 | ...
+
+The fields of each schema version are listed in FIELDS; a new version may
+only append fields. Strings are encoded as a varint (length + 1, 0 meaning
+None) followed by UTF-8 bytes, string lists as a varint count followed by
+the strings, and dates as signed 64-bit microseconds since the epoch.
+Messages with fields that are not in the schema are not encoded.
+
+The binary messages are about half the size of pickle, and decoding them
+can not run code. Pickle is implemented in C, so decoding a binary message
+takes about twice as long; see benchmarks/serializers.py.
+"""
+
+import datetime
+import json
+import pickle
+import struct
+
+
+class SerializerError(Exception):
+    """
+    Message could not be serialized or de-serialized.
+    """
+    pass
+
+
+MAGIC = b'V'
+VERSION = 2
+
+FIELDS = [('user_id', 'str'),
+          ('text', 'str'),
+          ('media', 'str'),
+          ('name', 'str'),
+          ('message_type', 'str'),
+          ('output_format', 'str'),
+          ('command', 'str'),
+          ('destination', 'list'),
+          ('date', 'date'),
+          ('request_id', 'str'), ]
+
+# Number of fields in each schema version.
+VERSION_FIELDS = {1: 9, 2: 10}
+
+FIELD_NAMES = frozenset(name for name, _ in FIELDS)
+SCHEMAS = dict((version, tuple(FIELDS[:count]))
+               for version, count in VERSION_FIELDS.items())
+
+DATE = struct.Struct('>q')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _encode_varint(value, out):
+    if value < 0x80:
+        out.append(value)
+        return
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data, pos):
+    if pos < len(data) and data[pos] < 0x80:
+        return data[pos], pos + 1
+    value = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise SerializerError('Truncated message')
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode_str(value, out):
+    if value is None:
+        out.append(0)
+        return
+    encoded = str(value).encode()
+    _encode_varint(len(encoded) + 1, out)
+    out += encoded
+
+
+def _decode_str(data, pos):
+    length, pos = _decode_varint(data, pos)
+    if length == 0:
+        return None, pos
+    end = pos + length - 1
+    if end > len(data):
+        raise SerializerError('Truncated message')
+    try:
+        return data[pos:end].decode(), end
+    except UnicodeDecodeError as e:
+        raise SerializerError('Invalid string: {}'.format(e))
+
+
+def _encode_list(value, out):
+    value = value or list()
+    _encode_varint(len(value), out)
+    for item in value:
+        _encode_str(item, out)
+
+
+def _decode_list(data, pos):
+    count, pos = _decode_varint(data, pos)
+    value = list()
+    for _ in range(count):
+        item, pos = _decode_str(data, pos)
+        value.append(item)
+    return value, pos
+
+
+def _encode_date(value, out):
+    if value is None:
+        value = datetime.datetime.now()
+    delta = value - EPOCH
+    out += DATE.pack((delta.days * 86400 + delta.seconds) * 1000000 +
+                     delta.microseconds)
+
+
+def _decode_date(data, pos):
+    end = pos + DATE.size
+    if end > len(data):
+        raise SerializerError('Truncated message')
+    microseconds, = DATE.unpack_from(data, pos)
+    return EPOCH + datetime.timedelta(0, 0, microseconds), end
+
+
+ENCODERS = {'str': _encode_str, 'list': _encode_list, 'date': _encode_date}
+DECODERS = {'str': _decode_str, 'list': _decode_list, 'date': _decode_date}
+
+
+class BinarySerializer(object):
+    """
+    Compact, schema versioned binary serializer
+    """
+
+    name = 'binary'
+
+    @staticmethod
+    def accepts(data):
+        return data[:1] == MAGIC
+
+    @staticmethod
+    def dumps(message):
+        unknown = message.keys() - FIELD_NAMES
+        if unknown:
+            raise SerializerError('Fields {} are not in the binary '
+                                  'schema'.format(', '.join(sorted(unknown))))
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        for name, field_type in SCHEMAS[VERSION]:
+            ENCODERS[field_type](message.get(name), out)
+        return bytes(out)
+
+    @staticmethod
+    def loads(data):
+        if len(data) < 2 or data[:1] != MAGIC:
+            raise SerializerError('Not a binary message')
+        fields = SCHEMAS.get(data[1])
+        if fields is None:
+            raise SerializerError('Unsupported message version {}'.format(
+                data[1]))
+        message = dict()
+        pos = 2
+        size = len(data)
+        view = memoryview(data)
+        try:
+            for name, field_type in fields:
+                if field_type != 'str':
+                    message[name], pos = DECODERS[field_type](data, pos)
+                    continue
+                # Strings are decoded inline, they are most of the fields.
+                length = data[pos]
+                if length & 0x80:
+                    length, pos = _decode_varint(data, pos)
+                else:
+                    pos += 1
+                if not length:
+                    message[name] = None
+                    continue
+                end = pos + length - 1
+                if end > size:
+                    raise SerializerError('Truncated message')
+                message[name] = str(view[pos:end], 'utf-8')
+                pos = end
+        except IndexError:
+            raise SerializerError('Truncated message')
+        except UnicodeDecodeError as e:
+            raise SerializerError('Invalid string: {}'.format(e))
+        return message
+
+
+class JsonSerializer(object):
+    """
+    JSON serializer, for consumers that are not written in Python
+    """
+
+    name = 'json'
+
+    @staticmethod
+    def accepts(data):
+        return data[:1] == b'{'
+
+    @staticmethod
+    def dumps(message):
+        message = dict(message)
+        if isinstance(message.get('date'), datetime.datetime):
+            message['date'] = message['date'].strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')
+        return json.dumps(message, separators=(',', ':')).encode()
+
+    @staticmethod
+    def loads(data):
+        try:
+            message = json.loads(data.decode())
+            if message.get('date'):
+                message['date'] = datetime.datetime.strptime(
+                    message['date'], '%Y-%m-%dT%H:%M:%S.%f')
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            raise SerializerError('Invalid JSON message: {}'.format(e))
+        return message
+
+
+class PickleSerializer(object):
+    """
+    Pickle serializer, the message format of the earlier versions
+    """
+
+    name = 'pickle'
+
+    @staticmethod
+    def accepts(data):
+        return data[:1] == b'\x80'
+
+    @staticmethod
+    def dumps(message):
+        return pickle.dumps(message)
+
+    @staticmethod
+    def loads(data):
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            raise SerializerError('Invalid pickle message: {}'.format(e))
+
+
+SERIALIZERS = dict((s.name, s) for s in [BinarySerializer, JsonSerializer,
+                                         PickleSerializer])
+
+
+class MessageCodec(object):
+    """
+    Class for encoding and decoding the messages
+
+    Messages are always encoded with the configured serializer. Decoding
+    detects the serializer from the message, so that the format can be changed
+    without stopping all the publishers and subscribers at the same time.
+    """
+
+    def __init__(self, name='binary', accept_pickle=True):
+        if name not in SERIALIZERS:
+            raise SerializerError('Unknown serializer "{}"'.format(name))
+        self.serializer = SERIALIZERS[name]
+        self.decoders = [BinarySerializer, JsonSerializer]
+        if accept_pickle or name == 'pickle':
+            self.decoders.append(PickleSerializer)
+
+    def dumps(self, message):
+        """
+        Encode message.
+
+        :param message: message dict
+        :return: encoded message bytes
+        :raises SerializerError: if the message can not be encoded
+        """
+        return self.serializer.dumps(message)
+
+    def loads(self, data):
+        """
+        Decode message.
+
+        :param data: encoded message bytes
+        :return: message dict
+        :raises SerializerError: if the message format is not accepted
+        """
+        for decoder in self.decoders:
+            if decoder.accepts(data):
+                return decoder.loads(data)
+        raise SerializerError('Unsupported message format')
@@ -0,0 +1,195 @@
+"""
+Request tracing and on-demand profiling
+
+Each webhook request, command execution and executor message is handled in
+a trace. The trace has a request id that is carried to the command pool
+threads, to the outbound queue and, through Cache.publish, to the command
+executor daemon, so that the log lines of one request can be correlated.
+When tracing is enabled, the durations of the stages of the request are
+recorded as spans and logged when the trace ends.
+
+Profiling is turned on for the next N traces with profile() (admin command
+"/profile N" or SIGUSR2 in the command executor daemon). The cProfile
+statistics of each profiled trace are written to the profile directory and
+can be read with "python -m pstats".
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import logging
+import os
+import threading
+import time
+import uuid
+from viber_command_bot.config import add_init_listener
+
+
+logger = logging.getLogger(__name__)
+
+current = contextvars.ContextVar('viber_trace', default=None)
+
+
+class Trace(object):
+    """
+    Class for the spans of one request
+    """
+
+    def __init__(self, name, request_id=None):
+        self.name = name
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.spans = list()
+
+    def text(self):
+        """
+        Create log text of the trace.
+
+        :return: text
+        """
+        total = (time.perf_counter() - self.start) * 1000
+        spans = ', '.join('{} {:.2f} ms'.format(name, duration * 1000)
+                          for name, duration in self.spans)
+        return 'Trace {} {}: {:.2f} ms{}'.format(
+            self.name, self.request_id, total,
+            '; {}'.format(spans) if spans else '')
+
+
+class Tracer(object):
+    """
+    Class for tracing and profiling the requests
+    """
+
+    def __init__(self, enabled=False, slow=0.5, profile_directory=None,
+                 profile_requests=10):
+        self.enabled = enabled
+        self.slow = slow
+        self.profile_directory = profile_directory
+        self.profile_requests = profile_requests
+        self.profile_count = 0
+        # Re-entrant, profile() may be called from a signal handler.
+        self.lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def trace(self, name, request_id=None, profile=False):
+        """
+        Context for handling a request in a trace.
+
+        :param name: trace name, e.g. "webhook"
+        :param request_id: request id, default is the request id of the
+                           current trace or a new request id
+        :param profile: profile the trace, if profiling is turned on
+        :return: context manager yielding Trace
+        """
+        if request_id is None:
+            request_id = current_request_id()
+        trace = Trace(name, request_id)
+        token = current.set(trace)
+        profiler = self._start_profile() if profile else None
+        try:
+            yield trace
+        finally:
+            if profiler is not None:
+                self._stop_profile(profiler, trace)
+            current.reset(token)
+            if self.enabled:
+                duration = time.perf_counter() - trace.start
+                level = logging.INFO if duration >= self.slow else \
+                    logging.DEBUG
+                if logger.isEnabledFor(level):
+                    logger.log(level, trace.text())
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Context for recording a span to the current trace.
+
+        :param name: span name, e.g. "verify"
+        :return: context manager
+        """
+        trace = current.get()
+        if not self.enabled or trace is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            trace.spans.append((name, time.perf_counter() - start))
+
+    def profile(self, count=None):
+        """
+        Profile the next traces.
+
+        :param count: number of traces to profile, default is the configured
+                      number of requests
+        :return: None
+        """
+        if count is None:
+            count = self.profile_requests
+        with self.lock:
+            self.profile_count = max(0, count)
+        logger.info('Profiling the next %s requests', count)
+
+    def _start_profile(self):
+        """
+        Start profiler, if profiling is turned on.
+        """
+        if not self.profile_count or not self.profile_directory:
+            return None
+        with self.lock:
+            if not self.profile_count:
+                return None
+            self.profile_count -= 1
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is active in this process.
+            logger.warning('Failed to start profiler: %s', e)
+            return None
+        return profiler
+
+    def _stop_profile(self, profiler, trace):
+        """
+        Stop profiler and write the statistics to the profile directory.
+        """
+        profiler.disable()
+        path = os.path.join(self.profile_directory, '{}-{}-{}-{}.prof'.format(
+            time.strftime('%Y%m%d%H%M%S'), trace.name, os.getpid(),
+            trace.request_id))
+        try:
+            os.makedirs(self.profile_directory, exist_ok=True)
+            profiler.dump_stats(path)
+            logger.info('Profile written to %s', path)
+        except OSError as e:
+            logger.error('Failed to write profile: %s', e)
+
+
+def current_request_id():
+    """
+    Get the request id of the current trace.
+
+    :return: request id, or None if there is no trace
+    """
+    trace = current.get()
+    return trace.request_id if trace is not None else None
+
+
+def configure_tracer(config):
+    """
+    Configure the tracer from the bot configuration.
+
+    :param config: bot configuration
+    :return: None
+    """
+    tracer.enabled = config.getboolean('Tracing', 'enabled', fallback=False)
+    tracer.slow = config.getfloat('Tracing', 'slow_request', fallback=0.5)
+    tracer.profile_directory = config.get('Tracing', 'profile_directory',
+                                          fallback=None)
+    tracer.profile_requests = config.getint('Tracing', 'profile_requests',
+                                            fallback=10)
+
+
+tracer = Tracer()
+add_init_listener(configure_tracer)
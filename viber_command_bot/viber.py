@@ -3,15 +3,43 @@ Viber bot API configuration
 
 It is possible to change bot configuration file by setting VIBER_CONF
 environment variable.
+
+The Api object is created when it is used the first time, so that importing
+the module does not load the Viber bot API.
 """
 
-import os
-import sys
-from viberbot import Api
-from viberbot.api.bot_configuration import BotConfiguration
+import threading
 from viber_command_bot.config import config
 
 
-viber = Api(BotConfiguration(
-    auth_token=config['Viber']['authentication_token'],
-    name=config['Viber']['name'], avatar=config['Viber']['avatar']))
+def create_api():
+    """
+    Create Viber bot API object.
+
+    :return: Api object
+    """
+    from viberbot import Api
+    from viberbot.api.bot_configuration import BotConfiguration
+    return Api(BotConfiguration(
+        auth_token=config['Viber']['authentication_token'],
+        name=config['Viber']['name'], avatar=config['Viber']['avatar']))
+
+
+class LazyApi(object):
+    """
+    Class that creates the Viber bot API object on first use
+    """
+
+    def __init__(self):
+        self.api = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.api is None:
+            with self.lock:
+                if self.api is None:
+                    self.api = create_api()
+        return getattr(self.api, name)
+
+
+viber = LazyApi()
@@ -0,0 +1,171 @@
+"""
+Viber webhook request parsing
+
+The request body is read and parsed once. The event type and the sender are
+checked from the parsed JSON before the viberbot request objects are
+created, so that uninteresting callbacks and messages from un-trusted users
+are dropped without Redis traffic or outbound messages.
+"""
+
+import hashlib
+import collections
+import hmac
+import json
+import threading
+from viber_command_bot.config import config
+
+
+# Callbacks that the bot does not act on.
+IGNORED_EVENTS = ['delivered', 'seen', 'webhook']
+
+# Maximum number of un-trusted user ids remembered per process.
+MAX_UNTRUSTED_USERS = 1000
+
+# Callbacks that are handled only once, even if Viber sends them again.
+DEDUPLICATED_EVENTS = ['message', 'subscribed', 'unsubscribed',
+                       'conversation_started']
+
+# Maximum number of message tokens remembered per process.
+MAX_SEEN_TOKENS = 10000
+
+
+def verify_signature(body, signature):
+    """
+    Verify the signature of the request body.
+
+    :param body: request body bytes
+    :param signature: value of X-Viber-Content-Signature header
+    :return: True, if the signature is valid
+    """
+    if not signature:
+        return False
+    key = config.get('Viber', 'authentication_token').encode('ascii')
+    expected = hmac.new(key, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def parse_event(body):
+    """
+    Parse the request body.
+
+    :param body: request body bytes
+    :return: event dict, or None if the body is not a JSON object
+    """
+    try:
+        event = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(event, dict):
+        return None
+    return event
+
+
+def event_sender(event):
+    """
+    Get the sender of a message event.
+
+    :param event: event dict
+    :return: tuple (sender id, sender name), or (None, None) if the event
+             has no sender
+    """
+    sender = event.get('sender')
+    if not isinstance(sender, dict):
+        return None, None
+    return sender.get('id'), sender.get('name')
+
+
+def event_text(event):
+    """
+    Get the text of a message event.
+
+    :param event: event dict
+    :return: message text, or None if the message has no text
+    """
+    message = event.get('message')
+    if not isinstance(message, dict):
+        return None
+    return message.get('text')
+
+
+class UntrustedUsers(object):
+    """
+    Class for remembering the un-trusted users that have been reported
+    """
+
+    def __init__(self, size=MAX_UNTRUSTED_USERS):
+        self.size = size
+        self.user_ids = set()
+        self.lock = threading.Lock()
+
+    def first(self, user_id):
+        """
+        Check if the user id is reported for the first time.
+
+        :param user_id: Viber user id
+        :return: True, if the user id has not been reported before
+        """
+        with self.lock:
+            if user_id in self.user_ids:
+                return False
+            if len(self.user_ids) >= self.size:
+                self.user_ids.clear()
+            self.user_ids.add(user_id)
+            return True
+
+
+class SeenTokens(object):
+    """
+    Class for remembering the message tokens of the handled callbacks
+
+    Viber sends the callback again if the webhook does not answer in time.
+    The tokens are remembered in an LRU in each process, and in Redis for
+    the retries that are received by another process.
+    """
+
+    def __init__(self, size=MAX_SEEN_TOKENS):
+        self.size = size
+        self.tokens = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def first(self, token):
+        """
+        Check if the token is seen for the first time in this process.
+
+        :param token: message token
+        :return: True, if the token has not been seen before
+        """
+        with self.lock:
+            if token in self.tokens:
+                return False
+            self.tokens[token] = None
+            if len(self.tokens) > self.size:
+                self.tokens.popitem(last=False)
+            return True
+
+    def forget(self, token):
+        """
+        Forget the token, so that the callback is handled when it is sent
+        again.
+
+        :param token: message token
+        :return: None
+        """
+        with self.lock:
+            self.tokens.pop(token, None)
+
+
+def event_token(event):
+    """
+    Get the message token of a callback that is handled only once.
+
+    :param event: event dict
+    :return: message token, or None if the callback is not deduplicated
+    """
+    if event.get('event') not in DEDUPLICATED_EVENTS:
+        return None
+    token = event.get('message_token')
+    return str(token) if token is not None else None
+
+
+untrusted_users = UntrustedUsers()
+seen_tokens = SeenTokens()